@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+    
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+    
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+    
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+    
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import textwrap
+import time
+from os.path import join, dirname, abspath, exists
+from tempfile import mkdtemp
+from typing import Dict, List
+
+from privex.helpers import ErrHelpParser
+
+BASE_DIR = dirname(abspath(__file__))
+
+HELP_TEXT = textwrap.dedent('''\
+
+Runs the full './run.py build' pipeline against locally generated fixture git repos (cloned via file://) and a fake
+'yarn' executable - so it needs no network access, and the results only depend on CDN Builder itself.
+
+Each scenario is a combination of the number of libraries (--libs), the size of each library's bundle (--sizes),
+and whether the caches are cold or warm (--caches):
+
+    cold       - empty output / git mirror / node_modules caches, as on a brand new server
+    warm       - caches primed by a previous build, then rebuilt with --force (e.g. after a new upstream commit)
+    unchanged  - caches primed, and nothing changed upstream - every library should be skipped
+
+The wall time of each run, plus the time spent in each stage (download, build, identify, copy etc. - from the run
+report written by cdnbuilder.metrics) are saved as JSON. Pass --baseline to compare against previously saved results.
+
+Examples:
+
+    ./benchmark.py -o baseline.json
+    ./benchmark.py --libs 1 --sizes small --caches cold,warm --baseline baseline.json
+
+''')
+
+SIZES = dict(small=10 * 1024, large=10 * 1024 * 1024)
+"""Size of the main JS bundle generated by the fake yarn for each bundle size name (in bytes)"""
+
+FAKE_YARN = '''#!{python}
+# Fake 'yarn' for benchmark.py - 'install' creates a node_modules folder, any other command generates the bundles
+import json, os, sys, time
+
+args = sys.argv[1:]
+if args[:1] == ['install']:
+    time.sleep(float(os.getenv('BENCH_INSTALL_TIME', 0)))
+    for i in range(int(os.getenv('BENCH_DEPS', 20))):
+        os.makedirs(f'node_modules/dep-{{i}}', exist_ok=True)
+        with open(f'node_modules/dep-{{i}}/index.js', 'w') as fp:
+            fp.write('module.exports = %d;\\n' % i * 200)
+    sys.exit(0)
+
+time.sleep(float(os.getenv('BENCH_BUILD_TIME', 0)))
+with open('package.json') as fp:
+    pkg = json.load(fp)
+size = int(os.getenv('BENCH_BUNDLE_SIZE', 10240))
+os.makedirs('dist', exist_ok=True)
+with open(f'dist/{{pkg["name"]}}.js', 'w') as fp:
+    fp.write(f'/*! {{pkg["name"]}} v{{pkg["version"]}} | MIT License */\\n')
+    line, written = 0, 0
+    while written < size:
+        chunk = f'function f{{line}}(a,b){{{{return a*{{line}}+b-"{{pkg["name"]}}".length}}}}\\n'
+        fp.write(chunk)
+        line, written = line + 1, written + len(chunk)
+with open(f'dist/{{pkg["name"]}}.css', 'w') as fp:
+    fp.write(f'/*! {{pkg["name"]}} v{{pkg["version"]}} */\\n' + ''.join(f'.c{{i}}{{{{margin:{{i}}px}}}}\\n' for i in range(500)))
+'''
+
+LIB_MODULE = '''from os.path import join
+from cdnbuilder.libs.base import BaseLib
+
+
+class BenchLib(BaseLib):
+    builder = 'YarnBuilder'
+    lib_name = {name!r}
+    url = {url!r}
+    args = dict(yarn_args=['run', 'build'])
+    
+    def identify(self, folder: str, package: str = None):
+        files = [join(folder, 'dist', f'{{self.lib_name}}.js'), join(folder, 'dist', f'{{self.lib_name}}.css')]
+        _, ver = self.find_banner(files[0], r'([a-z0-9-]+) v([0-9.]+)')
+        return package, ver, files
+
+
+export = BenchLib
+'''
+
+
+def git(*args, cwd=None):
+    subprocess.run(
+        ['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost', '-c', 'init.defaultBranch=master',
+         *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+class Fixtures:
+    """Generates the fixture git repos, library modules and fake yarn used by the benchmark in ``workdir``"""
+    def __init__(self, workdir: str):
+        self.workdir = workdir
+        self.repos = join(workdir, 'repos')
+        self.modules = join(workdir, 'modules')
+        self.bin = join(workdir, 'bin')
+        for d in (self.repos, join(self.modules, 'benchlibs'), self.bin):
+            os.makedirs(d, exist_ok=True)
+        open(join(self.modules, 'benchlibs', '__init__.py'), 'w').close()
+        yarn = join(self.bin, 'yarn')
+        with open(yarn, 'w') as fp:
+            fp.write(FAKE_YARN.format(python=sys.executable))
+        os.chmod(yarn, 0o755)
+
+    def lib(self, i: int) -> str:
+        """Create the fixture repo + library module for library number ``i`` (if needed), returning the module name"""
+        name = f'bench-{i:03d}'
+        repo = join(self.repos, name)
+        if not exists(repo):
+            os.makedirs(repo)
+            git('init', '-q', cwd=repo)
+            with open(join(repo, 'package.json'), 'w') as fp:
+                json.dump(dict(name=name, version='1.0.0', scripts=dict(build='fake')), fp)
+            with open(join(repo, 'yarn.lock'), 'w') as fp:
+                fp.write(f'# yarn lockfile v1\n\n"dep@^1.0.0":\n  version "1.0.{i}"\n')
+            git('add', '-A', cwd=repo)
+            git('commit', '-q', '-m', 'Initial commit', cwd=repo)
+        mod = f'bench_{i:03d}'
+        with open(join(self.modules, 'benchlibs', f'{mod}.py'), 'w') as fp:
+            fp.write(LIB_MODULE.format(name=name, url=f'file://{repo}'))
+        return f'benchlibs.{mod}'
+
+
+def run_build(env: dict, libs: List[str], force: bool, args) -> dict:
+    """Run './run.py build' for ``libs``, returning the wall time and the run report written by cdnbuilder.metrics"""
+    cmd = [sys.executable, join(BASE_DIR, 'run.py'), 'build', '-j', str(args.jobs), '-e', args.engine]
+    if force:
+        cmd.append('--force')
+    env = dict(env, BUILD_LIBS=','.join(libs))
+    start = time.perf_counter()
+    res = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - start
+    if res.returncode != 0:
+        raise RuntimeError(f'Build failed (exit code {res.returncode}):\n{res.stdout.decode(errors="replace")[-4000:]}')
+    with open(env['METRICS_REPORT']) as fp:
+        report = json.load(fp)
+    failed = [b['lib'] for b in report['builds'] if b['status'] == 'failed']
+    if len(failed) > 0:
+        raise RuntimeError(f'Libraries failed to build: {", ".join(failed)}\n{res.stdout.decode(errors="replace")[-4000:]}')
+    return dict(wall=wall, report=report)
+
+
+def summarise(runs: List[dict]) -> dict:
+    """Combine several runs of a scenario: median wall time, and the median of each stage summed over all libraries"""
+    stages = {}
+    for r in runs:
+        totals = {}
+        for b in r['report']['builds']:
+            for stage, secs in b['stages'].items():
+                totals[stage] = totals.get(stage, 0) + secs
+        for stage, secs in totals.items():
+            stages.setdefault(stage, []).append(secs)
+    builds = runs[-1]['report']['builds']
+    return dict(
+        wall=round(statistics.median(r['wall'] for r in runs), 4),
+        wall_min=round(min(r['wall'] for r in runs), 4),
+        runs=len(runs),
+        stages={s: round(statistics.median(v), 4) for s, v in stages.items()},
+        built=sum(1 for b in builds if b['status'] == 'built'),
+        skipped=sum(1 for b in builds if b['status'] == 'skipped'),
+        files_published=sum(b['counters'].get('files_published', 0) for b in builds),
+        bytes_published=sum(b['counters'].get('bytes_published', 0) for b in builds),
+    )
+
+
+def run_scenario(fix: Fixtures, n_libs: int, size: str, cache: str, args) -> dict:
+    libs = [fix.lib(i) for i in range(n_libs)]
+    runs = []
+    for _ in range(args.repeat):
+        # Every repetition starts with fresh output + caches, so 'cold' really is cold
+        state = mkdtemp(prefix='state-', dir=fix.workdir)
+        env = dict(
+            os.environ, PATH=f'{fix.bin}{os.pathsep}{os.environ.get("PATH", "")}',
+            PYTHONPATH=os.pathsep.join([fix.modules, BASE_DIR, os.environ.get('PYTHONPATH', '')]),
+            OUT_FOLDER=join(state, 'output'), CACHE_FOLDER=join(state, 'cache'), BUILD_FOLDER=join(state, 'build'),
+            METRICS_REPORT=join(state, 'report.json'), METRICS_PROM_FILE='', LOG_LEVEL='WARNING',
+            BENCH_BUNDLE_SIZE=str(SIZES[size]), BENCH_BUILD_TIME=str(args.yarn_time),
+            BENCH_INSTALL_TIME=str(args.yarn_time), GIT_TERMINAL_PROMPT='0',
+        )
+        os.makedirs(env['BUILD_FOLDER'])
+        try:
+            if cache in ('warm', 'unchanged'):
+                run_build(env, libs, True, args)
+            runs.append(run_build(env, libs, cache != 'unchanged', args))
+        finally:
+            shutil.rmtree(state, ignore_errors=True)
+    return summarise(runs)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """Print a comparison of ``results`` against ``baseline``, returning the scenarios which regressed"""
+    regressed = []
+    print(f'\n{"Scenario":<32} {"Baseline":>10} {"Current":>10} {"Change":>9}')
+    for name, cur in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            print(f'{name:<32} {"-":>10} {cur["wall"]:>9.3f}s {"new":>9}')
+            continue
+        change = (cur['wall'] - base['wall']) / base['wall'] * 100 if base['wall'] > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressed.append(name)
+            flag = '  <-- REGRESSION'
+        print(f'{name:<32} {base["wall"]:>9.3f}s {cur["wall"]:>9.3f}s {change:>+8.1f}%{flag}')
+    return regressed
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def csv(value: str) -> List[str]:
+    return [v.strip() for v in value.split(',') if v.strip() != '']
+
+
+def main():
+    parser = ErrHelpParser(
+        description='CDN Builder - offline end-to-end benchmarks',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=HELP_TEXT
+    )
+    parser.add_argument('--libs', type=csv, default=['1', '50'], help='Numbers of libraries to build (default: 1,50)')
+    parser.add_argument('--sizes', type=csv, default=['small', 'large'],
+                        help='Bundle sizes: small (10 KB) and/or large (10 MB) (default: small,large)')
+    parser.add_argument('--caches', type=csv, default=['cold', 'warm'],
+                        help='Cache states: cold, warm and/or unchanged (default: cold,warm)')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Libraries to build in parallel (default: 4)')
+    parser.add_argument('-e', '--engine', choices=['process', 'async'], default='process', help='Build engine')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Times to run each scenario (median is used)')
+    parser.add_argument('--yarn-time', type=float, default=0.0,
+                        help='Seconds the fake yarn sleeps for each install / build command (default: 0)')
+    parser.add_argument('-o', '--output', default='benchmark-results.json', help='File to write the results to')
+    parser.add_argument('-b', '--baseline', default=None, help='Previous results file to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Exit with status 2 if any scenario is this %% slower than the baseline (default: 10)')
+    parser.add_argument('--workdir', default=None, help='Folder for the fixtures (default: a temporary folder)')
+    args = parser.parse_args()
+    
+    for s in args.sizes:
+        if s not in SIZES:
+            parser.error(f'Unknown size "{s}" - valid sizes: {", ".join(SIZES)}')
+    for c in args.caches:
+        if c not in ('cold', 'warm', 'unchanged'):
+            parser.error(f'Unknown cache state "{c}" - valid states: cold, warm, unchanged')
+    
+    workdir = mkdtemp(prefix='cdnbuilder-bench-') if args.workdir is None else abspath(args.workdir)
+    fix = Fixtures(workdir)
+    results = dict(
+        created_at=time.time(), revision=git_revision(), python=platform.python_version(),
+        platform=platform.platform(), cpus=os.cpu_count(), jobs=args.jobs, engine=args.engine,
+        repeat=args.repeat, yarn_time=args.yarn_time, scenarios={}
+    )   # type: Dict[str, any]
+    try:
+        for n in args.libs:
+            for size in args.sizes:
+                for cache in args.caches:
+                    name = f'{n}-libs/{size}/{cache}'
+                    print(f'Running {name} ...', end=' ', flush=True)
+                    res = results['scenarios'][name] = run_scenario(fix, int(n), size, cache, args)
+                    print(f'{res["wall"]:.3f}s ({res["built"]} built, {res["skipped"]} skipped, '
+                          f'{res["bytes_published"]} bytes published)')
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print(f'\nResults written to {args.output}')
+    
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            regressed = compare(results, json.load(fp), args.threshold)
+        if len(regressed) > 0:
+            print(f'\n{len(regressed)} scenario(s) are more than {args.threshold}% slower than the baseline')
+            sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import logging
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from fnmatch import fnmatchcase
+from os import makedirs
+from os.path import join
+from typing import List, Union, Dict, Tuple
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.build import record_build
+from cdnbuilder.cache import GitMirror
+from cdnbuilder.core import CommandHelper, load_lib, version_key
+from cdnbuilder.downloaders.GitDownloader import GitDownloader
+from cdnbuilder.exceptions import DownloadError
+from cdnbuilder.files import file_lock
+from cdnbuilder.libs.base import BaseLib
+from cdnbuilder.manifest import BuildManifest
+from cdnbuilder.metrics import BuildMetrics, write_reports
+from cdnbuilder.publish import publish_lib
+
+log = logging.getLogger(__name__)
+
+WORKTREE_LOCK = 'cdnbuilder-worktree.lock'
+"""Lock file (inside of the base repo's ``.git`` folder) held while adding / removing worktrees"""
+
+
+def match_versions(tags: List[str], versions: Union[str, List[str]]) -> List[str]:
+    """
+    Select the tags matching ``versions`` - a comma separated string (or list) of tag names and / or glob patterns.
+    The matching tags are returned oldest first (see :func:`.version_key`).
+
+        >>> match_versions(['v1.0.0', 'v1.1.0', 'v2.0.0', 'v2.1.0'], 'v1.*,v2.1.0')
+        ['v1.0.0', 'v1.1.0', 'v2.1.0']
+
+    :raises DownloadError: When an exact tag name (not a pattern) doesn't exist
+    """
+    versions = [v.strip() for v in versions.split(',')] if isinstance(versions, str) else versions
+    matched = set()
+    for v in versions:
+        if empty(v):
+            continue
+        if any(c in v for c in '*?['):
+            matched.update(t for t in tags if fnmatchcase(t, v))
+        elif v in tags:
+            matched.add(v)
+        else:
+            raise DownloadError(f'Tag "{v}" does not exist')
+    return sorted(matched, key=version_key)
+
+
+class _Worktree(CommandHelper):
+    cmd_exc = DownloadError
+    default_command = 'git'
+
+    def __init__(self, base: str, log_file: str = None):
+        self.out_dir = base
+        self.log_file = log_file
+
+    def add(self, tag: str, destination: str):
+        # Git doesn't expect several worktrees to be added to the same repo at once
+        with file_lock(join(self.out_dir, '.git', WORKTREE_LOCK)):
+            self._call('worktree', 'add', '-q', '--detach', destination, tag)
+
+    def remove(self, destination: str):
+        with file_lock(join(self.out_dir, '.git', WORKTREE_LOCK)):
+            shutil.rmtree(destination, ignore_errors=True)
+            self._call('worktree', 'prune')
+
+
+def _backfill_worker(name: str, base: str, tag: str, force=False) -> Tuple[bool, dict]:
+    """
+    Build and publish the tag ``tag`` of library ``name``, from a new worktree of the repo ``base``.
+    Runs inside of a worker process - exceptions are logged rather than raised (like :func:`.scheduler._build_worker`)
+    """
+    lib = load_lib(name)()     # type: BaseLib
+    metrics = lib.metrics = BuildMetrics(f'{lib.lib_name}@{tag}')
+    dl = lib.downloader
+    if lib.log_file is not None:
+        lib.log_file = dl.log_file = join(settings.BUILD_LOG_FOLDER, f"{lib.lib_name}@{re.sub(r'[^a-zA-Z0-9._-]', '_', tag)}.log")
+    wt = _Worktree(base, lib.log_file)
+    folder = join(lib.temp_dir, 'src')
+    try:
+        with metrics.stage('download'):
+            wt.add(tag, folder)
+        # The source is already checked out, so the library's download stage is skipped
+        lib.ref = dl.ref = tag
+        dl.out_dir = dl.folder = folder
+        dl.downloaded = True
+        published = publish_lib(lib, lib.iter_build(), force=force)
+        with metrics.stage('record'):
+            record_build(lib, published, set_last=False)
+        metrics.finish('built')
+        return True, metrics.to_dict()
+    except Exception:
+        log.exception('Unexpected error while building tag "%s" of library "%s"...', tag, name)
+        metrics.finish('failed')
+        return False, metrics.to_dict()
+    finally:
+        # A failed cleanup mustn't replace the build's result (or exception) - the worktree is pruned on the next run
+        try:
+            wt.remove(folder)
+        except Exception:
+            log.exception('Failed to remove the worktree for tag "%s" of library "%s"', tag, name)
+        lib.temp_dir_obj.cleanup()
+
+
+class Backfill(CommandHelper):
+    """
+    Builds many historical versions (tags) of a library in parallel.
+
+    The repo is cloned once (from the local mirror if ``GIT_MIRROR`` is enabled), then each tag is checked out into
+    it's own ``git worktree`` and built + published by a worker process. Tags which were already built (according to
+    the library's :class:`.BuildManifest`) are skipped.
+
+    Tags are grouped by their dependency lockfiles: the first tag of each group is built before the rest of it's group,
+    so the other tags can reuse it's ``node_modules`` from the :class:`.NodeModulesCache` instead of installing them.
+
+    The ``latest`` symlinks only ever move forwards (see :func:`.update_latest`), so publishing old versions never
+    replaces a newer version as ``latest``.
+
+    Example:
+
+        >>> res = Backfill('eosjs', 'v20.*,v21.0.0', jobs=4).run()
+        >>> res
+        {'v20.0.0': True, 'v20.0.1': True, 'v21.0.0': False}
+
+    """
+    cmd_exc = DownloadError
+    default_command = 'git'
+
+    def __init__(self, name: str, versions: Union[str, List[str]], jobs: int = None, force=False):
+        """
+        :param str name: The library module to build, e.g. ``eosjs``
+        :param versions: Tags to build - a comma separated string (or list) of tag names / glob patterns
+        :param int jobs: Number of tags to build in parallel (default: :py:attr:`.settings.BUILD_JOBS`)
+        :param bool force: Rebuild tags which were already built, replacing their published versions
+        """
+        self.name, self.versions, self.force = name, versions, force
+        self.jobs = settings.BUILD_JOBS if empty(jobs) else int(jobs)
+        self.lib = load_lib(name)()     # type: BaseLib
+        if not isinstance(self.lib.downloader, GitDownloader):
+            raise DownloadError(f'Cannot backfill library "{name}" - only libraries downloaded with Git have tags')
+        self.log_file = self.lib.log_file
+        # The base repo is inside of the library's temporary build folder, so it's cleaned up along with it
+        self.out_dir = join(self.lib.temp_dir, 'repo')
+
+    def clone(self):
+        """Clone the library's repo (without checking out any files) into :py:attr:`.out_dir`"""
+        url = self.lib.url
+        if settings.GIT_MIRROR:
+            mirror = GitMirror(url)
+            mirror.log_file = self.log_file
+            mirror.update()
+            mirror.clone(self.out_dir, '--no-checkout')
+        else:
+            # Commands run inside of out_dir, so it has to exist before we can clone into it
+            makedirs(self.out_dir, exist_ok=True)
+            self._call_raw('git', 'clone', '-q', '--no-checkout', url, self.out_dir)
+
+    def tags(self) -> List[str]:
+        stdout, _, _ = self._call('tag', '-l', capture=True)
+        return stdout.decode().split()
+
+    def commit(self, tag: str) -> str:
+        stdout, _, _ = self._call('rev-parse', f'{tag}^{{commit}}', capture=True)
+        return stdout.decode().strip()
+
+    def lockfile_key(self, tag: str) -> str:
+        """The blob hashes of :py:attr:`.BaseLib.lock_files` at ``tag`` - tags with the same key share dependencies"""
+        stdout, _, _ = self._call('ls-tree', tag, '--', *self.lib.lock_files, capture=True)
+        return stdout.decode().strip()
+
+    def plan(self) -> Dict[str, List[str]]:
+        """
+        Clone the repo, then find the tags which need building
+
+        :return dict groups: Maps each lockfile key to the tags which need building with those dependencies
+        """
+        self.clone()
+        tags = match_versions(self.tags(), self.versions)
+        manifest, groups = BuildManifest(self.lib.lib_name), {}
+        for tag in tags:
+            if not self.force and manifest.is_built(self.lib.build_key(self.commit(tag))):
+                log.info('Tag "%s" of library "%s" is already built. Skipping.', tag, self.lib.lib_name)
+                continue
+            groups.setdefault(self.lockfile_key(tag), []).append(tag)
+        return groups
+
+    def run(self) -> Dict[str, bool]:
+        """
+        Build and publish every tag matching :py:attr:`.versions` which isn't built yet
+
+        :return dict results: Maps each tag which was built to ``True`` (built OK) or ``False`` (failed)
+        """
+        try:
+            groups = self.plan()
+            total = sum(len(g) for g in groups.values())
+            log.info('Building %d tags of library "%s" (%d different lockfiles) with up to %d parallel jobs',
+                     total, self.lib.lib_name, len(groups), self.jobs)
+            results, builds = {}, []
+            if total == 0:
+                return results
+            with ProcessPoolExecutor(max_workers=max(1, min(self.jobs, total))) as pool:
+                def submit(tag):
+                    return pool.submit(_backfill_worker, self.name, self.out_dir, tag, self.force)
+
+                # Build the first tag of each group, then the rest of the group once it's node_modules are cached
+                pending = {submit(g[0]): (g[0], g[1:]) for g in groups.values()}
+                while len(pending) > 0:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        tag, rest = pending.pop(fut)
+                        try:
+                            results[tag], m = fut.result()
+                        except Exception:
+                            log.exception('Worker process crashed while building tag "%s"...', tag)
+                            results[tag], m = False, BuildMetrics(f'{self.lib.lib_name}@{tag}')
+                            m.finish('failed')
+                        builds.append(m)
+                        for t in rest:
+                            pending[submit(t)] = (t, [])
+            write_reports(builds)
+        finally:
+            self.lib.temp_dir_obj.cleanup()
+        failed = [t for t, ok in results.items() if not ok]
+        if len(failed) > 0:
+            log.error('%d of %d tags failed to build: %s', len(failed), len(results), ', '.join(failed))
+        return results
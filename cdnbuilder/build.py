@@ -0,0 +1,101 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import logging
+from typing import List
+
+from cdnbuilder.core import load_lib
+from cdnbuilder.libs.base import BaseLib
+from cdnbuilder.manifest import BuildManifest
+from cdnbuilder.metrics import BuildMetrics
+from cdnbuilder.publish import publish_lib
+
+log = logging.getLogger(__name__)
+
+
+def is_up_to_date(lib: BaseLib, commit: str = None) -> bool:
+    """
+    Returns ``True`` if ``lib`` was already built from the same upstream commit (with the same builder and args),
+    and the files it published are still in the output folder. See :class:`.BuildManifest`
+    
+    :param str commit: (Optional) The upstream commit, if it's already known - otherwise it's looked up
+    """
+    key = lib.build_key(commit)
+    if key is not None and BuildManifest(lib.lib_name).is_built(key):
+        log.info('Library "%s" is already up to date (commit %s). Skipping build.', lib.lib_name, key['commit'])
+        return True
+    return False
+
+
+def record_build(lib: BaseLib, published: List[str], set_last=True):
+    """Record a successful build of ``lib`` (which published the files ``published``) into it's build manifest"""
+    key = lib.build_key()
+    if key is not None:
+        BuildManifest(lib.lib_name).record(key, files=published, set_last=set_last,
+                                           lockfile=lib.lockfile_hash(lib.downloader.folder))
+
+
+def build_lib(l, force=False, metrics: BuildMetrics = None, revision: str = None):
+    """
+    Download, build and then copy the distribution files for the library ``l`` into :py:attr:`.settings.OUT_FOLDER`
+    
+    If the library was already built from the same upstream commit (with the same builder and args), and the
+    output files are still there, the library is skipped entirely - unless ``force`` is True.
+    
+    :param str l: The name of the library module to build, e.g. ``eosjs``
+    :param bool force: Rebuild the library even if it's up to date, and overwrite any existing output files
+    :param BuildMetrics metrics: (Optional) Record the stage timings / counters of the build into this object
+    :param str revision: (Optional) The upstream revision, if the caller already looked it up (e.g. :class:`.Watcher`)
+                         - saves checking the remote again
+    :return bool built: ``True`` if the library was built, ``False`` if it was skipped as it's up to date
+    """
+    metrics = BuildMetrics(l) if metrics is None else metrics
+    try:
+        # Load the library helper class and build it
+        lib = load_lib(l)()
+        lib.metrics = metrics
+        with metrics.stage('check'):
+            up_to_date = not force and is_up_to_date(lib, revision)
+        if up_to_date:
+            metrics.finish('skipped')
+            return False
+        # Each file is staged for publishing as soon as it's identified, instead of waiting for every (sub-)package
+        published = publish_lib(lib, lib.iter_build(), force=force)
+        with metrics.stage('record'):
+            record_build(lib, published)
+    except BaseException:
+        metrics.finish('failed')
+        raise
+    metrics.finish('built')
+    return True
@@ -33,7 +33,9 @@ Copyright::
 
 """
 from typing import Type, List
+from cdnbuilder import settings
 from cdnbuilder.builders.base import BaseBuilder
+from cdnbuilder.cache import NodeModulesCache
 from cdnbuilder.core import CommandHelper
 import logging
 
@@ -52,17 +54,40 @@ class YarnBuilder(BaseBuilder, CommandHelper):
         self.yarn_args = yarn_args
         self.out_dir = build_folder
     
+    def install(self):
+        """
+        Install the project's dependencies - restoring them from the :class:`.NodeModulesCache` if we've installed
+        the exact same dependencies before (see :py:attr:`.settings.NODE_CACHE`)
+        """
+        cache = NodeModulesCache() if settings.NODE_CACHE else None
+        key = None if cache is None else cache.make_key(self.out_dir)
+        with self.metrics.stage('build:yarn install'):
+            if key is not None and cache.restore(key, self.out_dir):
+                self.metrics.incr('node_cache_hits')
+                if settings.NODE_CACHE_VERIFY:
+                    self._call('install', '--offline', '--frozen-lockfile', capture=False)
+                return
+            self._call('install', capture=False)
+        if key is not None:
+            with self.metrics.stage('build:node cache save'):
+                cache.save(key, self.out_dir)
+    
     def build(self):
         # self.out_dir = self.download()
-        self._call('install')
+        self.install()
         # If there's just a flat list of arguments, e.g. ['run', 'pack'] - then we're just running a single command
         if type(self.yarn_args[0]) is str:
-            self._call(*self.yarn_args)
+            self._timed_call(*self.yarn_args)
             return self.out_dir
         # Otherwise, assume it's a list of yarn commands to run
         for cmd in self.yarn_args:   # type: List[str]
-            self._call(*cmd)
+            self._timed_call(*cmd)
         return self.out_dir
+    
+    def _timed_call(self, *args):
+        with self.metrics.stage('build:yarn ' + ' '.join(args)):
+            # Builds can log a lot of output, which we don't need to keep in memory
+            return self._call(*args, capture=False)
 
 
 export = YarnBuilder
@@ -35,6 +35,8 @@ Copyright::
 from abc import ABC, abstractmethod
 import logging
 
+from cdnbuilder.metrics import BuildMetrics
+
 log = logging.getLogger(__name__)
 
 
@@ -44,6 +46,8 @@ class BaseBuilder(ABC):
     def __init__(self, build_folder: str, **kwargs):
         self.build_folder = build_folder
         self.args = dict(kwargs)
+        # Replaced with the library's metrics by BaseLib.run_builder
+        self.metrics = BuildMetrics(type(self).__name__)
     
     @abstractmethod
     def build(self) -> str:
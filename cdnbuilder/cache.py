@@ -0,0 +1,279 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+from functools import lru_cache
+from hashlib import sha256
+from os import makedirs, rename
+from os.path import join, exists, basename
+from typing import Optional
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.core import CommandHelper
+from cdnbuilder.exceptions import DownloadError
+from cdnbuilder.files import file_lock, link_tree, dir_size
+
+log = logging.getLogger(__name__)
+
+
+class GitMirror(CommandHelper):
+    """
+    A persistent bare mirror of a Git repository, kept inside of :py:attr:`.settings.GIT_CACHE_DIR`
+
+    Only ``refs/heads/*`` and ``refs/tags/*`` are mirrored (not e.g. GitHub's ``refs/pull/*``), so that the mirror
+    only contains the history we could actually want to build.
+
+    Updating the mirror holds an exclusive lock on the mirror, while cloning from it only holds a shared lock - so
+    concurrent builds of the same repo can clone from one mirror at the same time, but never while it's being fetched.
+
+    Example:
+
+        >>> m = GitMirror('https://github.com/EOSIO/eosjs.git')
+        >>> m.update()                  # Clone the mirror if it doesn't exist, otherwise incrementally fetch into it
+        >>> m.clone('/tmp/eosjs123')    # Fast local clone (hardlinked objects) from the mirror
+
+    """
+    cmd_exc = DownloadError
+    default_command = 'git'
+    out_dir = None
+
+    def __init__(self, url: str, cache_dir: str = None):
+        self.url = url
+        self.cache_dir = settings.GIT_CACHE_DIR if empty(cache_dir) else cache_dir
+        self.path = join(self.cache_dir, self.mirror_name(url))
+        self.lock_path = f'{self.path}.lock'
+
+    @staticmethod
+    def mirror_name(url: str) -> str:
+        """
+        Generate a folder-safe, unique mirror folder name for a Git URL
+
+            >>> GitMirror.mirror_name('https://github.com/EOSIO/eosjs.git')
+            'eosjs-7991545296c7.git'
+
+        """
+        name = re.sub(r'[^a-zA-Z0-9_.-]', '_', basename(url.rstrip('/')))
+        name = name[:-4] if name.endswith('.git') else name
+        return f'{name}-{sha256(url.encode()).hexdigest()[:12]}.git'
+
+    @property
+    def exists(self) -> bool:
+        return exists(join(self.path, 'HEAD'))
+
+    def update(self):
+        """Create the bare mirror if it doesn't exist yet, otherwise fetch any new objects/refs into it"""
+        makedirs(self.cache_dir, exist_ok=True)
+        with file_lock(self.lock_path):
+            if self.exists:
+                log.info('Fetching updates into mirror "%s"', self.path)
+                self._call('--git-dir', self.path, 'fetch', '-q', '--prune', '--tags', 'origin')
+                return
+            
+            # Clone into a temporary folder and then rename it, so an interrupted clone never looks like a valid mirror
+            tmp_path = f'{self.path}.tmp'
+            if exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            log.info('Creating new mirror of "%s" in "%s"', self.url, self.path)
+            self._call('clone', '-q', '--bare', self.url, tmp_path)
+            self._call('--git-dir', tmp_path, 'config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*')
+            rename(tmp_path, self.path)
+
+    def clone(self, destination: str, *args):
+        """
+        Clone the mirror into ``destination``. As the mirror is on the local filesystem, Git hardlinks the objects
+        instead of copying them. The ``origin`` remote of the clone is pointed back at the real :py:attr:`.url`
+        
+        :param str destination: The folder to clone the mirror into
+        :param args: Any extra arguments to pass to ``git clone``, e.g. ``--no-checkout``
+        """
+        with file_lock(self.lock_path, shared=True):
+            log.info('Cloning mirror "%s" into "%s"', self.path, destination)
+            self._call('clone', '-q', '--local', *args, self.path, destination)
+        self._call('-C', destination, 'remote', 'set-url', 'origin', self.url)
+        return destination
+
+
+@lru_cache()
+def node_version() -> str:
+    """Returns the installed NodeJS version (e.g. ``v10.16.3``), or ``unknown`` if we couldn't find it"""
+    try:
+        return subprocess.check_output(['node', '--version'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class NodeModulesCache:
+    """
+    A cache of fully installed ``node_modules`` folders, keyed by the hash of ``yarn.lock``, ``package.json`` and
+    the NodeJS version - kept inside of :py:attr:`.settings.NODE_CACHE_DIR`
+
+    When a library has the same dependencies as a previous build, the cached ``node_modules`` are restored into the
+    build folder using reflinks or copies (see :py:attr:`.settings.NODE_CACHE_LINK`), instead of running a full
+    ``yarn install``. Entries are never hardlinked to or from a build folder, as a build which writes to a file in
+    ``node_modules`` would then modify the cached copy used by every later build. The least recently used entries
+    are evicted once the cache grows past :py:attr:`.settings.NODE_CACHE_MAX_SIZE` or
+    :py:attr:`.settings.NODE_CACHE_MAX_ENTRIES`
+
+    Example:
+
+        >>> cache = NodeModulesCache()
+        >>> key = cache.make_key('/tmp/eosjs123')
+        >>> if not cache.restore(key, '/tmp/eosjs123'):
+        ...     run_yarn_install()
+        ...     cache.save(key, '/tmp/eosjs123')
+
+    """
+    key_files = ['yarn.lock']
+    package_fields = [
+        'dependencies', 'devDependencies', 'optionalDependencies', 'peerDependencies', 'resolutions', 'workspaces'
+    ]
+    """
+    Fields of ``package.json`` which affect what ``yarn install`` installs. Only these are part of the key, so releases
+    which only bumped their ``version`` (e.g. when backfilling old tags) share the same cache entry.
+    """
+
+    def __init__(self, cache_dir: str = None, max_size: int = None, max_entries: int = None, link_mode: str = None):
+        self.cache_dir = settings.NODE_CACHE_DIR if empty(cache_dir) else cache_dir
+        self.max_size = settings.NODE_CACHE_MAX_SIZE if empty(max_size) else max_size
+        self.max_entries = settings.NODE_CACHE_MAX_ENTRIES if empty(max_entries) else max_entries
+        self.link_mode = settings.NODE_CACHE_LINK if empty(link_mode) else link_mode
+        if self.link_mode == 'hardlink':
+            log.warning('NodeModulesCache can\'t use hardlinks, as builds may modify node_modules - using "auto"')
+            self.link_mode = 'auto'
+        self.lock_path = join(self.cache_dir, '.lock')
+
+    def make_key(self, folder: str) -> Optional[str]:
+        """
+        Generate the cache key for the project in ``folder``. Returns ``None`` if there's no ``yarn.lock``, as
+        without a lockfile the installed dependencies aren't reproducible, so they can't be safely cached.
+        """
+        if not exists(join(folder, 'yarn.lock')):
+            return None
+        h = sha256(node_version().encode())
+        for f in self.key_files:
+            f = join(folder, f)
+            if exists(f):
+                with open(f, 'rb') as fp:
+                    h.update(fp.read())
+        pkg = join(folder, 'package.json')
+        if exists(pkg):
+            with open(pkg) as fp:
+                data = json.load(fp)
+            fields = {k: data[k] for k in self.package_fields if k in data}
+            h.update(json.dumps(fields, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def restore(self, key: str, folder: str) -> bool:
+        """
+        Restore the cached ``node_modules`` for ``key`` into ``folder``
+
+        :return bool restored: ``True`` if the cache entry existed and was restored, ``False`` on a cache miss
+        """
+        entry = join(self.cache_dir, key)
+        if not exists(join(entry, 'node_modules')):
+            return False
+        with file_lock(self.lock_path, shared=True):
+            if not exists(join(entry, 'node_modules')):
+                return False
+            mode = link_tree(
+                join(entry, 'node_modules'), join(folder, 'node_modules'), mode=self.link_mode, allow_hardlink=False
+            )
+            # Touch the entry, so that the least recently *used* entries are evicted first
+            os.utime(entry)
+        log.info('Restored node_modules for "%s" from cache entry %s (mode: %s)', folder, key[:12], mode)
+        return True
+
+    def save(self, key: str, folder: str):
+        """Save the ``node_modules`` folder within ``folder`` into the cache as ``key``, then evict old entries"""
+        entry = join(self.cache_dir, key)
+        if exists(entry) or not exists(join(folder, 'node_modules')):
+            return
+        makedirs(self.cache_dir, exist_ok=True)
+        # Build the entry in a temporary folder and rename it into place, so a half-saved entry is never restored.
+        # Tool caches such as webpack/babel's node_modules/.cache aren't part of the installed dependencies.
+        tmp_entry = f'{entry}.tmp{os.getpid()}'
+        try:
+            mode = link_tree(
+                join(folder, 'node_modules'), join(tmp_entry, 'node_modules'), mode=self.link_mode,
+                ignore=lambda p: p == '.cache', allow_hardlink=False
+            )
+            with open(join(tmp_entry, 'cache.json'), 'w') as fp:
+                json.dump(dict(size=dir_size(tmp_entry), node=node_version()), fp)
+        except BaseException:
+            # Temporary entries are never listed by entries(), so a failed save would never be evicted
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        with file_lock(self.lock_path):
+            if exists(entry):
+                shutil.rmtree(tmp_entry)
+            else:
+                rename(tmp_entry, entry)
+                log.info('Saved node_modules for "%s" into cache entry %s (mode: %s)', folder, key[:12], mode)
+        self.evict()
+
+    def entries(self) -> list:
+        """List each cache entry as a tuple of ``(last_used, size, path)``, least recently used first"""
+        res = []
+        if not exists(self.cache_dir):
+            return res
+        for name in os.listdir(self.cache_dir):
+            # Entries which are still being saved by another build (see save) aren't part of the cache yet
+            if '.tmp' in name:
+                continue
+            entry = join(self.cache_dir, name)
+            meta = join(entry, 'cache.json')
+            if not exists(meta):
+                continue
+            with open(meta) as fp:
+                size = json.load(fp).get('size', 0)
+            res.append((os.stat(entry).st_mtime, size, entry))
+        return sorted(res)
+
+    def evict(self):
+        """Remove the least recently used cache entries until the cache is within the size / entry limits"""
+        with file_lock(self.lock_path):
+            entries = self.entries()
+            total = sum(e[1] for e in entries)
+            while len(entries) > 0 and (total > self.max_size or len(entries) > self.max_entries):
+                _, size, entry = entries.pop(0)
+                log.info('Evicting node_modules cache entry "%s" (%d bytes)', entry, size)
+                shutil.rmtree(entry)
+                total -= size
@@ -0,0 +1,206 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import logging
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from os.path import exists, splitext
+from typing import List, Tuple, Optional
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+"""Size of the chunks which files are read in while compressing them"""
+
+
+COMPRESSORS = {
+    'gz': 9,
+    'br': 11,
+    'zst': 22,
+}
+"""Map of file extension -> the compression level (each format's maximum) used by :class:`.StreamCompressor`"""
+
+
+class StreamCompressor:
+    """
+    Incrementally compress a file into the ``fmt`` format (at it's level in :py:attr:`.COMPRESSORS`), so it can be
+    compressed chunk by chunk while it's being read for something else - without holding the whole file in memory.
+
+        >>> c = StreamCompressor('gz')
+        >>> data = c.compress(b'console.log(1);') + c.flush()
+
+    :param str fmt: The compression format, one of :py:attr:`.COMPRESSORS`
+    :param int size: (Optional) The size of the uncompressed input, if known (stored in ``zst`` frame headers)
+    """
+    def __init__(self, fmt: str, size: int = None):
+        if fmt not in COMPRESSORS:
+            raise ValueError(f'Unknown compression format "{fmt}"')
+        self.fmt, level = fmt, COMPRESSORS[fmt]
+        if fmt == 'gz':
+            # wbits=31 writes a gzip header and trailer. The header's mtime is always 0, so identical files always
+            # produce identical .gz files (which can then be de-duplicated)
+            obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self._compress, self._flush = obj.compress, obj.flush
+        elif fmt == 'br':
+            obj = brotli.Compressor(mode=brotli.MODE_TEXT, quality=level)
+            self._compress, self._flush = obj.process, obj.finish
+        else:
+            cctx = zstandard.ZstdCompressor(level=level)
+            obj = cctx.compressobj(size=-1 if size is None else size)
+            self._compress, self._flush = obj.compress, obj.flush
+
+    def compress(self, data: bytes) -> bytes:
+        """Feed the next chunk of input, returning any compressed output which is ready (may be empty)"""
+        return self._compress(data)
+
+    def flush(self) -> bytes:
+        """Finish the stream, returning the remaining compressed output. Must be called exactly once, at the end."""
+        return self._flush()
+
+
+def available_formats(formats: List[str] = None) -> List[str]:
+    """
+    Filter ``formats`` (default: :py:attr:`.settings.COMPRESS_FORMATS`) down to those we can actually produce.
+    ``br`` requires the ``brotli`` package, and ``zst`` requires the ``zstandard`` package.
+    """
+    formats = settings.COMPRESS_FORMATS if formats is None else formats
+    res = []
+    for fmt in formats:
+        if fmt not in COMPRESSORS:
+            log.warning('Unknown compression format "%s" - skipping', fmt)
+        elif (fmt == 'br' and brotli is None) or (fmt == 'zst' and zstandard is None):
+            log.warning('Compression format "%s" requires the %s package. Install it with: pip3 install %s',
+                        fmt, *(['brotli'] * 2 if fmt == 'br' else ['zstandard'] * 2))
+        else:
+            res.append(fmt)
+    return res
+
+
+def variant_path(path: str, fmt: str) -> str:
+    """The path of the ``fmt`` compressed variant of ``path``, e.g. ``/out/eosjs-api.js.gz``"""
+    return f'{path}.{fmt}'
+
+
+def is_up_to_date(path: str, fmt: str) -> bool:
+    """Returns ``True`` if the ``fmt`` variant of ``path`` exists, and isn't older than ``path``"""
+    v = variant_path(path, fmt)
+    return exists(v) and os.stat(v).st_mtime >= os.stat(path).st_mtime
+
+
+def compress_file(path: str, fmt: str) -> str:
+    """
+    Write the ``fmt`` compressed variant of ``path`` next to it (e.g. ``eosjs-api.js.gz``).
+    The variant is written to a temporary file first, so a half written variant is never served.
+
+    :return str variant: The path to the compressed variant
+    """
+    v = variant_path(path, fmt)
+    tmp_v = f'{v}.tmp{os.getpid()}'
+    # Compress chunk by chunk, so large bundles / source maps aren't held in memory by every worker process
+    c = StreamCompressor(fmt, size=os.path.getsize(path))
+    try:
+        with open(path, 'rb') as fp, open(tmp_v, 'wb') as out:
+            while True:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(c.compress(chunk))
+            out.write(c.flush())
+    except BaseException:
+        if exists(tmp_v):
+            os.remove(tmp_v)
+        raise
+    # Match the source file's modification time, so we can tell when the variant is out of date
+    st = os.stat(path)
+    os.utime(tmp_v, (st.st_atime, st.st_mtime))
+    os.replace(tmp_v, v)
+    return v
+
+
+def _compress_task(task: Tuple[str, str]) -> str:
+    return compress_file(*task)
+
+
+def should_compress(path: str) -> bool:
+    """Returns ``True`` if ``path`` has one of the file extensions in :py:attr:`.settings.COMPRESS_EXTENSIONS`"""
+    return splitext(path)[1].lower() in settings.COMPRESS_EXTENSIONS
+
+
+def compress_files(paths: List[str], formats: List[str] = None, jobs: int = None, force=False) -> List[str]:
+    """
+    Generate precompressed variants (e.g. ``.gz`` / ``.br``) of each file in ``paths`` which has a compressible file
+    extension (:py:attr:`.settings.COMPRESS_EXTENSIONS`), in parallel worker processes. Variants which are already
+    up to date are skipped, unless ``force`` is True - this only matters when re-compressing files in place, as
+    :func:`.publish_lib` always compresses newly staged files.
+
+    Example:
+
+        >>> compress_files(['/opt/cdn/eosjs/20.0.1/eosjs-api.js'], formats=['gz', 'br'])
+        ['/opt/cdn/eosjs/20.0.1/eosjs-api.js.gz', '/opt/cdn/eosjs/20.0.1/eosjs-api.js.br']
+
+    :param List[str] paths: The files to compress
+    :param List[str] formats: The formats to generate (default: :py:attr:`.settings.COMPRESS_FORMATS`)
+    :param int jobs: Number of worker processes (default: :py:attr:`.settings.COMPRESS_JOBS`)
+    :param bool force: Re-generate variants even if they're up to date
+    :return List[str] variants: The paths to each variant which was (re-)generated
+    """
+    formats = available_formats(formats)
+    jobs = settings.COMPRESS_JOBS if empty(jobs) else int(jobs)
+    tasks = [
+        (p, fmt) for p in paths for fmt in formats
+        if should_compress(p) and (force or not is_up_to_date(p, fmt))
+    ]
+    if len(tasks) == 0:
+        return []
+    # Daemonic processes (e.g. multiprocessing pool workers on older Python versions) can't start child processes
+    if jobs <= 1 or len(tasks) == 1 or multiprocessing.current_process().daemon:
+        return [_compress_task(t) for t in tasks]
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+        return list(pool.map(_compress_task, tasks))
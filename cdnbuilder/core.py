@@ -32,46 +32,84 @@ Copyright::
 
 
 """
+import asyncio
+import os
+import re
 import subprocess
-from importlib import import_module
-from typing import Type
+import threading
+import time
+from collections import deque
+from typing import Type, Optional
 import logging
 
 from privex.helpers import NotConfigured
+from cdnbuilder import settings
 from cdnbuilder.exceptions import BuildError
 
 
 log = logging.getLogger(__name__)
 
 
+BUILD_DIR_PREFIX = 'cdnbuilder-'
+"""Prefix of each temporary folder we create in ``BUILD_FOLDER``, so ``gc`` can tell them apart from anything else"""
+
+
+def build_dir_prefix(lib_name: str) -> str:
+    """
+    Prefix for a temporary build folder of ``lib_name``. It includes the PID of the current process, so that ``gc``
+    can tell whether the folder is still in use, or was orphaned by a crashed build.
+    
+        >>> build_dir_prefix('eosjs')
+        'cdnbuilder-eosjs-12345-'
+    
+    """
+    return f'{BUILD_DIR_PREFIX}{lib_name}-{os.getpid()}-'
+
+
 def get_builder(name: str):
     """
     
-    :param name: Flat, or absolute module name for a builder class e.g. ``YarnBuilder``
+    :param name: Flat, or absolute module name for a builder class e.g. ``YarnBuilder``, or the name of a builder
+                 registered by a plugin (see :class:`cdnbuilder.registry.Registry`)
     :returns: A builder class, implementing :class:`cdnbuilder.builders.base.BaseBuilder`
     :rtype: Type[cdnbuilder.builders.base.BaseBuilder]
     """
-    builder_path = name if '.' in name else f'cdnbuilder.builders.{name}'
-    log.debug('Importing builder module: %s', builder_path)
-    builder = import_module(builder_path)
-    log.debug('Successfully imported: %s', builder_path)
+    from cdnbuilder.registry import get_registry
     from cdnbuilder.builders.base import BaseBuilder
-    b: BaseBuilder = builder.export
+    b: Type[BaseBuilder] = get_registry().load('builders', name)
     return b
 
 
 def load_lib(name: str):
-    lib_path = name if '.' in name else f'cdnbuilder.libs.{name}'
-    log.debug('Importing library meta module: %s', lib_path)
-    _lib = import_module(lib_path)
-    log.debug('Successfully imported: %s', lib_path)
+    """
     
+    :param name: Flat, or absolute module name for a library e.g. ``eosjs``, or the name of a library registered by a
+                 plugin (see :class:`cdnbuilder.registry.Registry`)
+    :returns: A library class, implementing :class:`cdnbuilder.libs.base.BaseLib`
+    """
+    from cdnbuilder.registry import get_registry
     from cdnbuilder.libs.base import BaseLib
-    lib: Type[BaseLib] = _lib.export
-    
+    lib: Type[BaseLib] = get_registry().load('libs', name)
     return lib
 
 
+def _version_parts(version: str) -> tuple:
+    return tuple((0, int(p), '') if p.isdigit() else (1, 0, p) for p in re.split(r'[.+_]', version) if p != '')
+
+
+def version_key(version: str) -> tuple:
+    """
+    Sort key for version strings, so that versions are ordered numerically (``1.10.0`` after ``1.9.2``), and
+    pre-releases come before their release (``2.0.0-beta.1`` before ``2.0.0``). A leading ``v`` is ignored.
+    
+        >>> sorted(['1.10.0', '1.9.2', 'v2.0.0', '2.0.0-beta.1'], key=version_key)
+        ['1.9.2', '1.10.0', '2.0.0-beta.1', 'v2.0.0']
+    
+    """
+    main, _, pre = version.strip().lstrip('vV').partition('-')
+    return _version_parts(main), (1,) if pre == '' else (0,) + _version_parts(pre)
+
+
 def call_sys(command: str, *args, cwd=None, **kwargs):
     c = [command] + list(args)
     kw = {
@@ -81,6 +119,93 @@ def call_sys(command: str, *args, cwd=None, **kwargs):
     return subprocess.Popen(c, **kw)
 
 
+def wait_usage(proc: subprocess.Popen):
+    """
+    Wait for ``proc`` to exit (like :py:meth:`subprocess.Popen.wait`), returning the resource usage (``ru_maxrss``,
+    ``ru_utime`` etc.) of the process and any children it waited for - e.g. the ``node`` processes started by ``yarn``.
+    
+    :return resource.struct_rusage usage: The process' resource usage, or ``None`` if it was already reaped
+    """
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        proc.wait()
+        return None
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return usage
+
+
+class _CommandOutput:
+    """
+    Handles the streamed output of a command ran by :class:`.CommandHelper` - logging each line, writing it to the
+    log file (if any), and keeping the last ``settings.CMD_TAIL_LINES`` lines (and everything, if ``capture``).
+    """
+    read_size = 65536
+    """Size of the chunks which command output is read in - lines longer than this are split into chunks"""
+    
+    def __init__(self, name: str, log_file: str = None, capture=False):
+        self.name, self.capture = name, capture
+        self.tail, self.captured = deque(maxlen=settings.CMD_TAIL_LINES), []
+        self.log_fp = None if not log_file else open(log_file, 'ab')
+        self._buf = b''
+    
+    def start(self, command: str, *args):
+        if self.log_fp is not None:
+            self.log_fp.write(f'$ {command} {" ".join(args)}\n'.encode())
+    
+    def feed(self, line: bytes):
+        self.tail.append(line)
+        if self.capture:
+            self.captured.append(line)
+        if self.log_fp is not None:
+            self.log_fp.write(line)
+        log.debug('%s: %s', self.name, line.decode('utf-8', 'replace').rstrip())
+    
+    def feed_chunk(self, chunk: bytes):
+        """
+        Feed a chunk of raw output, which may contain any number of (partial) lines. We read fixed size chunks rather
+        than lines, as minified JS and progress bars can produce a single line of any length - overly long lines are
+        fed as several chunks, so memory usage stays bounded.
+        """
+        *lines, self._buf = (self._buf + chunk).split(b'\n')
+        for line in lines:
+            self.feed(line + b'\n')
+        while len(self._buf) >= self.read_size:
+            self.feed(self._buf[:self.read_size])
+            self._buf = self._buf[self.read_size:]
+    
+    def flush(self):
+        """Feed any remaining partial line, once the command's output has ended"""
+        if len(self._buf) > 0:
+            self.feed(self._buf)
+            self._buf = b''
+    
+    def close(self):
+        if self.log_fp is not None:
+            self.log_fp.close()
+    
+    def finish(self, returncode: int, exc: Type[Exception]) -> bytes:
+        """Raise ``exc`` (with the output tail attached) if ``returncode`` is non-zero, otherwise return the output"""
+        if returncode != 0:
+            output = [l.decode('utf-8', 'replace').rstrip('\n') for l in self.tail]
+            raise exc(f"{self.name} returned non-zero return code: {returncode}", output=output, returncode=returncode)
+        return b''.join(self.captured if self.capture else self.tail)
+
+
+_engine = threading.local()
+
+
+def bind_loop(loop: Optional[asyncio.AbstractEventLoop]):
+    """
+    Bind the asyncio event loop ``loop`` to the current thread. While bound, all :class:`.CommandHelper` commands
+    ran from this thread are executed on ``loop`` via :py:meth:`.CommandHelper._acall_raw`, so that a single
+    event loop manages every subprocess (used by :class:`cdnbuilder.pipeline.PipelineEngine`'s worker threads).
+    
+    Pass ``None`` to unbind the loop.
+    """
+    _engine.loop = loop
+
+
 class CommandHelper:
     out_dir: str
     """The working directory to execute commands within. Set this to ``None`` if it doesn't matter."""
@@ -88,21 +213,112 @@ class CommandHelper:
     """The command to pass arguments to, when using _call. This must be set for :py:meth:`._call` to work."""
     cmd_exc = BuildError
     """The exception to raise when a non-zero return code is detected"""
+    log_file: Optional[str] = None
+    """If set, the output of every command is also appended to this file"""
+    metrics = None
+    """
+    If set to a :class:`.BuildMetrics`, the peak memory (``peak_rss_bytes``) of the commands, and the average CPU
+    cores (CPU time / wall time) of the busiest command (``avg_cpus``), are recorded into it (see
+    :class:`.ResourceHistory`)
+    """
     
-    def _call_raw(self, command: str, *args):
+    def _call_raw(self, command: str, *args, capture=True):
+        """
+        Run ``command`` with the arguments ``args`` inside of :py:attr:`.out_dir`
+        
+        The output (stdout + stderr) is streamed line by line into the debug log (and :py:attr:`.log_file` if set),
+        and the last ``settings.CMD_TAIL_LINES`` lines are attached to the exception if the command fails.
+        
+        Commands which can produce a lot of output (e.g. ``yarn install``) should pass ``capture=False``, so that only
+        the last ``CMD_TAIL_LINES`` lines are kept in memory instead of the whole output. Lines longer than 64KB are
+        split, so memory usage then stays the same no matter how much output a build produces.
+        
+        If an event loop was bound to this thread with :func:`.bind_loop`, the command is ran on that loop
+        using :py:meth:`._acall_raw` instead.
+        
+        :param str command: The command to run, e.g. ``git``
+        :param args: Arguments to pass to the command
+        :param bool capture: (Default: ``True``) Keep the entire output in memory and return it as ``stdout``.
+                             If ``False``, only the last ``CMD_TAIL_LINES`` lines are kept and returned.
+        :raises CommandError: (:py:attr:`.cmd_exc`) when the command returns a non-zero exit code
+        :return tuple res: ``(stdout: bytes, stderr: None, process: Popen)`` - ``stdout`` is the entire output, or
+                           only the last ``CMD_TAIL_LINES`` lines of it if ``capture`` is False.
+        """
+        loop = getattr(_engine, 'loop', None)
+        if loop is not None:
+            return asyncio.run_coroutine_threadsafe(self._acall_raw(command, *args, capture=capture), loop).result()
+        
         if not hasattr(self, 'out_dir'):
             raise NotConfigured('Cannot use CommandHelper._call as out_dir was never set!')
         log.debug('Running "%s" with args: %s in working dir: "%s"', command, args, self.out_dir)
-        h = call_sys(command, *args, cwd=self.out_dir)
-        stdout, stderr = h.communicate()
-        log.debug('%s stdout: %s', command.capitalize(), stdout)
-        log.debug('%s stderr: %s', command.capitalize(), stderr)
-        if h.returncode != 0:
-            raise self.cmd_exc(f"{command.capitalize()} returned non-zero return code: {h.returncode}")
-        return stdout, stderr, h
-    
-    def _call(self, *args):
+        out = _CommandOutput(command.capitalize(), log_file=self.log_file, capture=capture)
+        start, h = time.perf_counter(), None
+        try:
+            h = call_sys(command, *args, cwd=self.out_dir)
+            out.start(command, *args)
+            while True:
+                # read1 returns whatever output is available, rather than waiting for a full chunk
+                chunk = h.stdout.read1(out.read_size)
+                if not chunk:
+                    break
+                out.feed_chunk(chunk)
+            out.flush()
+            usage = wait_usage(h)
+        finally:
+            # If streaming the output failed, make sure the command doesn't keep running (or become a zombie)
+            if h is not None:
+                if h.returncode is None:
+                    h.kill()
+                    h.wait()
+                h.stdout.close()
+            out.close()
+        self._record_usage(usage, time.perf_counter() - start)
+        return out.finish(h.returncode, self.cmd_exc), None, h
+    
+    def _record_usage(self, usage, elapsed: float):
+        if self.metrics is None or usage is None:
+            return
+        # ru_maxrss is in kilobytes on Linux
+        self.metrics.peak('peak_rss_bytes', usage.ru_maxrss * 1024)
+        if elapsed > 0:
+            self.metrics.peak('avg_cpus', round((usage.ru_utime + usage.ru_stime) / elapsed, 2))
+    
+    def _call(self, *args, **kwargs):
         if not hasattr(self, 'default_command'):
             raise NotConfigured('Cannot use CommandHelper._call as default_command was never set!')
-        return self._call_raw(self.default_command, *args)
-
+        return self._call_raw(self.default_command, *args, **kwargs)
+    
+    async def _acall_raw(self, command: str, *args, capture=True):
+        """
+        Async version of :py:meth:`._call_raw` built on :func:`asyncio.create_subprocess_exec` - takes the same
+        arguments, and returns ``(stdout: bytes, stderr: None, process: asyncio.subprocess.Process)``
+        """
+        if not hasattr(self, 'out_dir'):
+            raise NotConfigured('Cannot use CommandHelper._acall as out_dir was never set!')
+        log.debug('Running "%s" with args: %s in working dir: "%s" (async)', command, args, self.out_dir)
+        out, h = _CommandOutput(command.capitalize(), log_file=self.log_file, capture=capture), None
+        try:
+            h = await asyncio.create_subprocess_exec(
+                command, *args, cwd=self.out_dir, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+            )
+            out.start(command, *args)
+            # Read fixed size chunks rather than readline(), as minified JS can produce lines longer than
+            # asyncio's stream buffer limit
+            while True:
+                chunk = await h.stdout.read(out.read_size)
+                if not chunk:
+                    break
+                out.feed_chunk(chunk)
+            out.flush()
+            await h.wait()
+        finally:
+            if h is not None and h.returncode is None:
+                h.kill()
+                await h.wait()
+            out.close()
+        return out.finish(h.returncode, self.cmd_exc), None, h
+    
+    async def _acall(self, *args, **kwargs):
+        if not hasattr(self, 'default_command'):
+            raise NotConfigured('Cannot use CommandHelper._acall as default_command was never set!')
+        return await self._acall_raw(self.default_command, *args, **kwargs)
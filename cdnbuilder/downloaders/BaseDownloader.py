@@ -36,6 +36,7 @@ from abc import ABC, abstractmethod
 from tempfile import mkdtemp
 from typing import Optional
 from cdnbuilder import settings
+from cdnbuilder.core import build_dir_prefix
 import logging
 
 log = logging.getLogger(__name__)
@@ -44,10 +45,13 @@ log = logging.getLogger(__name__)
 class BaseDownloader(ABC):
     downloaded: bool
     folder: Optional[str]
+    ref: Optional[str]
+    """The version to download, e.g. a tag, branch or commit for Git. ``None`` means the default / latest version"""
     
-    def __init__(self, lib_name: str, url: str):
+    def __init__(self, lib_name: str, url: str, ref: str = None):
         self.lib_name = lib_name
         self.url = url
+        self.ref = ref
         self.downloaded = False
         self.folder = None
     
@@ -57,9 +61,26 @@ class BaseDownloader(ABC):
 
     def download(self, out_dir=None) -> str:
         if not out_dir:
-            out_dir = mkdtemp(prefix=self.lib_name, dir=settings.BUILD_FOLDER)
+            out_dir = mkdtemp(prefix=build_dir_prefix(self.lib_name), dir=settings.BUILD_FOLDER)
         log.info('Downloading library %s into folder "%s"', self.lib_name, out_dir)
         d = self._download(url=self.url, destination=out_dir)
         self.downloaded = True
         self.folder = d
         return d
+    
+    def remote_revision(self) -> Optional[str]:
+        """
+        Cheaply look up the revision (e.g. commit hash) of :py:attr:`.ref` at the remote :py:attr:`.url` *without*
+        downloading the source code. Used to skip builds when nothing has changed upstream.
+        
+        Downloaders which have no cheap way to check this should return ``None`` (the default), which means
+        the library will always be rebuilt.
+        """
+        return None
+    
+    def revision(self) -> Optional[str]:
+        """
+        Return the revision (e.g. commit hash) of the source code which was actually downloaded into
+        :py:attr:`.folder` - or ``None`` if it's not downloaded, or the downloader can't identify revisions.
+        """
+        return None
@@ -32,20 +32,120 @@ Copyright::
 
 
 """
+import re
 from tempfile import TemporaryDirectory
+from typing import Optional
 from privex.helpers import empty
+from cdnbuilder import settings
+from cdnbuilder.cache import GitMirror
 from cdnbuilder.core import CommandHelper
 from cdnbuilder.downloaders.BaseDownloader import BaseDownloader
 from cdnbuilder.exceptions import DownloadError
 
+CLONE_MODES = ('full', 'shallow', 'single-branch', 'blobless')
+"""
+Clone strategies supported by :class:`.GitDownloader`:
+
+ * ``full`` - Full clone of the repo (uses the local mirror cache if :py:attr:`.settings.GIT_MIRROR` is enabled)
+ * ``shallow`` - Only the single commit being built (``--depth 1``)
+ * ``single-branch`` - Full history, but only for the branch/tag being built (``--single-branch``)
+ * ``blobless`` - Full commit history, but file contents are only downloaded when checked out (``--filter=blob:none``)
+
+"""
+
 
 class GitDownloader(BaseDownloader, CommandHelper):
     cmd_exc = DownloadError
     default_command = 'git'
     
+    def __init__(self, lib_name: str, url: str, ref: str = None, clone_mode: str = 'full'):
+        """
+        :param str lib_name: The name of the library being downloaded
+        :param str url: The Git URL to clone
+        :param str ref: (Optional) A tag, branch or commit hash to checkout. Default: the repo's default branch
+        :param str clone_mode: (Default: ``full``) The clone strategy to use - see :py:attr:`.CLONE_MODES`
+        """
+        super().__init__(lib_name=lib_name, url=url, ref=ref)
+        if clone_mode not in CLONE_MODES:
+            raise ValueError(f'Invalid clone_mode "{clone_mode}" - must be one of: {", ".join(CLONE_MODES)}')
+        self.clone_mode = clone_mode
+        self.out_dir = None
+    
+    @property
+    def ref_is_commit(self) -> bool:
+        """Returns ``True`` if :py:attr:`.ref` looks like a (possibly abbreviated) commit hash"""
+        return not empty(self.ref) and re.match(r'^[0-9a-f]{7,40}$', self.ref) is not None
+    
+    def remote_revision(self) -> Optional[str]:
+        """Find the commit hash which :py:attr:`.ref` (or ``HEAD``) points to on the remote using ``git ls-remote``"""
+        if self.ref_is_commit:
+            # We can't resolve abbreviated hashes without the repo, but a full commit hash can never move.
+            return self.ref if len(self.ref) == 40 else None
+        ref = 'HEAD' if empty(self.ref) else self.ref
+        stdout, _, _ = self._call('ls-remote', self.url, ref, f'{ref}^{{}}', capture=True)
+        # Map each ref name returned by ls-remote to it's commit hash
+        refs = {}
+        for line in stdout.decode().splitlines():
+            if '\t' in line:
+                commit, name = line.split('\t', 1)
+                refs[name.strip()] = commit.strip()
+        # Prefer peeled tags (the commit an annotated tag points to), then tags, then branches
+        for name in (f'{ref}^{{}}', f'refs/tags/{ref}^{{}}', f'refs/tags/{ref}', f'refs/heads/{ref}', ref):
+            if name in refs:
+                return refs[name]
+        return None
+    
+    def revision(self) -> Optional[str]:
+        if not self.downloaded:
+            return None
+        stdout, _, _ = self._call('rev-parse', 'HEAD', capture=True)
+        return stdout.decode().strip()
+    
+    def _fetch_ref(self, url: str, destination: str, *args):
+        """Initialise an empty repo in ``destination``, then fetch only :py:attr:`.ref` into it and check it out"""
+        if self.ref_is_commit and len(self.ref) < 40:
+            raise DownloadError(
+                f'Cannot use abbreviated commit "{self.ref}" with clone_mode "{self.clone_mode}" - please use the full '
+                f'40 character commit hash, or clone_mode "full" / "blobless"'
+            )
+        self._call('init', '-q', destination)
+        self._call('remote', 'add', 'origin', url)
+        self._call('fetch', '-q', *args, 'origin', self.ref)
+        self._call('checkout', '-q', 'FETCH_HEAD')
+    
     def _download(self, url: str, destination: str = None):
         if empty(destination):
             destination = TemporaryDirectory().name
         self.out_dir = destination
-        self._call('clone', '-q', url, destination)
+        ref, mode = self.ref, self.clone_mode
+        # No point checking out the default branch if we're going to checkout a different ref straight afterwards
+        no_checkout = [] if empty(ref) else ['--no-checkout']
+        
+        if mode == 'full' and settings.GIT_MIRROR:
+            # Bring our local mirror of the repo up to date, then make a fast local clone from it
+            mirror = GitMirror(url)
+            mirror.log_file = self.log_file
+            mirror.update()
+            mirror.clone(destination, *no_checkout)
+        elif mode == 'shallow':
+            if empty(ref):
+                self._call('clone', '-q', '--depth', '1', url, destination)
+            else:
+                # Unlike 'clone --branch', fetching a ref directly works for commit hashes as well as branches/tags
+                self._fetch_ref(url, destination, '--depth', '1')
+            return destination
+        elif mode == 'single-branch':
+            if self.ref_is_commit:
+                self._fetch_ref(url, destination)
+                return destination
+            branch = [] if empty(ref) else ['--branch', ref]
+            self._call('clone', '-q', '--single-branch', *branch, url, destination)
+            return destination
+        elif mode == 'blobless':
+            self._call('clone', '-q', '--filter=blob:none', *no_checkout, url, destination)
+        else:
+            self._call('clone', '-q', *no_checkout, url, destination)
+        
+        if not empty(ref):
+            self._call('checkout', '-q', ref)
         return destination
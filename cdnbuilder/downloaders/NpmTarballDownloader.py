@@ -0,0 +1,240 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import tarfile
+from http.client import HTTPException
+from os.path import join
+from tempfile import TemporaryFile
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.downloaders.BaseDownloader import BaseDownloader
+from cdnbuilder.exceptions import DownloadError
+from cdnbuilder.httppool import ConnectionPool, get_pool, same_origin
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+INTEGRITY_ALGOS = ('sha512', 'sha384', 'sha256', 'sha1')
+"""Subresource integrity algorithms supported for verifying tarballs, strongest first"""
+
+
+def parse_integrity(integrity: Optional[str], shasum: str = None) -> Tuple[str, bytes]:
+    """
+    Pick the strongest supported hash from an npm ``dist.integrity`` string (falling back to the legacy hex
+    ``dist.shasum``)
+
+        >>> parse_integrity('sha1-qUqP... sha512-9ZSjd...')
+        ('sha512', b'\\xf5\\x94\\xa3w...')
+
+    :return tuple hash: ``(algorithm, expected_digest)``
+    :raises DownloadError: When there's no supported hash to verify the tarball with
+    """
+    hashes = {}
+    for h in (integrity or '').split():
+        algo, _, b64 = h.partition('-')
+        if algo in INTEGRITY_ALGOS:
+            # Options (e.g. '?foo') may follow the digest
+            hashes[algo] = base64.b64decode(b64.split('?')[0])
+    for algo in INTEGRITY_ALGOS:
+        if algo in hashes:
+            return algo, hashes[algo]
+    if not empty(shasum):
+        return 'sha1', bytes.fromhex(shasum)
+    raise DownloadError('The package has no supported integrity hash to verify it with')
+
+
+def safe_extract(tar: tarfile.TarFile, destination: str, strip: int = 1) -> int:
+    """
+    Extract the regular files / folders in ``tar`` into ``destination``, removing the first ``strip`` path components
+    (npm tarballs put everything inside of ``package/``).
+
+    Members with absolute paths or ``..`` components are rejected. Links and special files (devices, FIFOs) are
+    skipped, so a tarball can't write (or point) outside of ``destination``.
+
+    :return int files: The number of files extracted
+    :raises DownloadError: When a member's path would escape ``destination``
+    """
+    root, count = os.path.realpath(destination), 0
+    for m in tar:
+        parts = [p for p in m.name.replace('\\', '/').split('/') if p not in ('', '.')]
+        if m.name.startswith('/') or '..' in parts:
+            raise DownloadError(f'Refusing to extract unsafe path "{m.name}" from tarball')
+        parts = parts[strip:]
+        if len(parts) == 0:
+            continue
+        out_path = join(root, *parts)
+        if not (m.isfile() or m.isdir()):
+            log.warning('Skipping link / special file "%s" in tarball', m.name)
+            continue
+        if m.isdir():
+            os.makedirs(out_path, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        src = tar.extractfile(m)
+        with open(out_path, 'wb') as fp:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fp.write(chunk)
+        # Only keep the permission bits (e.g. executable scripts) - never setuid / setgid
+        os.chmod(out_path, (m.mode & 0o777) | 0o600)
+        count += 1
+    return count
+
+
+class NpmTarballDownloader(BaseDownloader):
+    """
+    Downloads a published package tarball from the npm registry, instead of cloning the source code.
+
+    Many packages already include their built ``dist/`` files in the tarball, so pairing this with the
+    :class:`.NoopBuilder` skips installing dependencies and compiling entirely.
+
+    The library's :py:attr:`.BaseLib.url` is the npm package name (e.g. ``eosjs`` or ``@scatterjs/core``), and
+    :py:attr:`.BaseLib.ref` is a version or dist-tag (default: ``latest``). The tarball is streamed to a temporary
+    file while it's hashed, verified against the registry's ``dist.integrity``, and then safely extracted.
+
+    Example:
+
+        >>> class EOSJSLib(BaseLib):
+        ...     lib_name = 'eosjs'
+        ...     url = 'eosjs'
+        ...     ref = '20.0.0'
+        ...     builder = 'NoopBuilder'
+        ...     downloader_cls = NpmTarballDownloader
+
+    """
+    def __init__(self, lib_name: str, url: str, ref: str = None, registry: str = None, token: str = None,
+                 pool: ConnectionPool = None, **kwargs):
+        """
+        :param str lib_name: The name of the library being downloaded
+        :param str url: The npm package name, e.g. ``eosjs`` or ``@scatterjs/core``
+        :param str ref: (Optional) A version or dist-tag to download. Default: ``latest``
+        :param str registry: Base URL of the registry (default: :py:attr:`.settings.NPM_REGISTRY`)
+        :param str token: Auth token for the registry (default: :py:attr:`.settings.NPM_TOKEN`)
+        :param ConnectionPool pool: Connection pool to send requests with (default: the shared pool)
+        """
+        super().__init__(lib_name=lib_name, url=url, ref=ref)
+        if len(kwargs) > 0:
+            log.debug('NpmTarballDownloader ignoring unsupported options: %s', ', '.join(kwargs.keys()))
+        self.registry = (settings.NPM_REGISTRY if empty(registry) else registry).rstrip('/')
+        self.token = settings.NPM_TOKEN if empty(token) else token
+        self.pool = get_pool() if pool is None else pool
+        self.version = None     # type: Optional[str]
+        self._meta = None       # type: Optional[dict]
+
+    def headers(self, url: str) -> dict:
+        """Request headers for ``url`` - the auth token is only sent to the registry itself, not to other hosts"""
+        h = {'User-Agent': 'cdn-builder', 'Accept-Encoding': 'identity'}
+        if not empty(self.token) and same_origin(url, self.registry):
+            h['Authorization'] = f'Bearer {self.token}'
+        return h
+
+    def package_meta(self) -> dict:
+        """
+        Look up the metadata of the version :py:attr:`.ref` resolves to, using the registry's abbreviated metadata
+        (the ``dist-tags`` are resolved, e.g. ``latest`` -> ``20.0.0``)
+        """
+        if self._meta is not None:
+            return self._meta
+        # Scoped packages keep their '@', but the '/' is encoded, e.g. /@scatterjs%2Fcore
+        url = f"{self.registry}/{quote(self.url, safe='@')}"
+        headers = dict(self.headers(url), Accept='application/vnd.npm.install-v1+json; q=1.0, application/json; q=0.8')
+        try:
+            with self.pool.request('GET', url, headers=headers) as res:
+                body = res.read()
+                if res.status != 200:
+                    raise DownloadError(f'Registry returned HTTP {res.status} for package "{self.url}" ({url})')
+        except (OSError, HTTPException) as e:
+            raise DownloadError(f'Error looking up package "{self.url}" from {url}: {type(e).__name__}: {e}')
+        data = json.loads(body)
+        ref = 'latest' if empty(self.ref) else self.ref
+        version = data.get('dist-tags', {}).get(ref, ref)
+        if version not in data.get('versions', {}):
+            raise DownloadError(f'Version "{ref}" of npm package "{self.url}" was not found')
+        self._meta = data['versions'][version]
+        return self._meta
+
+    def remote_revision(self) -> Optional[str]:
+        """The exact version :py:attr:`.ref` resolves to - published npm versions can never change"""
+        return self.package_meta()['version']
+
+    def revision(self) -> Optional[str]:
+        return self.version if self.downloaded else None
+
+    def _fetch(self, url: str, algo: str, expected: bytes, fp):
+        """Stream ``url`` into the file ``fp``, verifying it's ``algo`` hash matches ``expected``"""
+        h = hashlib.new(algo)
+        try:
+            with self.pool.request('GET', url, headers=self.headers(url)) as res:
+                if res.status != 200:
+                    res.read()
+                    raise DownloadError(f'Registry returned HTTP {res.status} for tarball {url}')
+                while True:
+                    chunk = res.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    fp.write(chunk)
+        except (OSError, HTTPException) as e:
+            raise DownloadError(f'Error downloading tarball {url}: {type(e).__name__}: {e}')
+        if h.digest() != expected:
+            raise DownloadError(f'Integrity check failed for tarball {url} ({algo} does not match the registry)')
+
+    def _download(self, url: str, destination: str = None) -> str:
+        meta = self.package_meta()
+        dist = meta.get('dist', {})
+        algo, expected = parse_integrity(dist.get('integrity'), dist.get('shasum'))
+        log.info('Downloading npm package %s@%s from %s', self.url, meta['version'], dist.get('tarball'))
+        with TemporaryFile(dir=settings.BUILD_FOLDER) as fp:
+            self._fetch(dist['tarball'], algo, expected, fp)
+            fp.seek(0)
+            try:
+                with tarfile.open(fileobj=fp, mode='r:*') as tar:
+                    count = safe_extract(tar, destination)
+            except tarfile.TarError as e:
+                raise DownloadError(f'Invalid tarball for package "{self.url}": {e}')
+        log.info('Extracted %d files from %s@%s into "%s"', count, self.url, meta['version'], destination)
+        self.version = meta['version']
+        return destination
@@ -32,6 +32,9 @@ Copyright::
 
 
 """
+from typing import List
+
+
 class CDNBuilderException(Exception):
     pass
 
@@ -41,11 +44,30 @@ class VersionNotFound(CDNBuilderException):
     pass
 
 
-class DownloadError(CDNBuilderException):
+class CommandError(CDNBuilderException):
+    """
+    Raised when an external command (e.g. ``git`` or ``yarn``) returns a non-zero exit code.
+
+    :ivar List[str] output: The last lines of output from the failed command (see ``settings.CMD_TAIL_LINES``)
+    :ivar int returncode: The exit code of the failed command
+    """
+    def __init__(self, *args, output: List[str] = None, returncode: int = None):
+        super().__init__(*args)
+        self.output = [] if output is None else list(output)
+        self.returncode = returncode
+
+    def __str__(self):
+        msg = super().__str__()
+        if len(self.output) == 0:
+            return msg
+        return f"{msg}\n--- Last {len(self.output)} lines of output ---\n" + "\n".join(self.output)
+
+
+class DownloadError(CommandError):
     """Raised when something went wrong downloading the library package e.g. via Git"""
     pass
 
 
-class BuildError(CDNBuilderException):
+class BuildError(CommandError):
     """Raised when something went wrong attempting to build the library"""
     pass
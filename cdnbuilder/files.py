@@ -0,0 +1,308 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import ctypes
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from os.path import join, islink, relpath, dirname
+from typing import Callable, Dict, Tuple
+
+log = logging.getLogger(__name__)
+
+FICLONE = 0x40049409
+"""The Linux ``ioctl`` request number for cloning (reflinking) a file on copy-on-write filesystems (btrfs, XFS etc.)"""
+
+TRANSFER_MODES = ('auto', 'reflink', 'hardlink', 'copy_range', 'sendfile', 'copy')
+"""
+Methods which :func:`.transfer_file` (and :func:`.link_tree`) can use to recreate a file, from cheapest to most
+expensive:
+
+ * ``auto`` - Try each of the below in order, until one is supported between the source and destination
+ * ``reflink`` - Copy-on-write clone of the file. Instant, and safe to modify - but needs btrfs / XFS etc.
+ * ``hardlink`` - Instant, but both paths share one inode, so modifying the file in-place changes both copies.
+   Only works when the source and destination are on the same filesystem.
+ * ``copy_range`` - ``os.copy_file_range`` - the kernel copies the data, without it passing through userspace
+ * ``sendfile`` - ``os.sendfile`` - same as ``copy_range``, for older kernels / Python versions
+ * ``copy`` - Plain userspace copy of the file contents
+
+"""
+
+_NOT_SUPPORTED = (
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EPERM, errno.ENOSYS, errno.EBADF
+)
+
+_CHUNK_SIZE = 8 * 1024 * 1024
+
+_mode_cache = {}  # type: Dict[Tuple[int, int], str]
+_mode_cache_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(lock_path: str, shared=False):
+    """
+    Context manager which holds an advisory ``flock`` on ``lock_path`` (created if it doesn't exist) for the duration
+    of the ``with`` block. Blocks until the lock can be acquired.
+    
+    Locks are held per open file, so they work between both threads and processes (e.g. parallel builds).
+    
+    Example:
+    
+        >>> with file_lock('/tmp/example.lock'):
+        ...     print('only one process at a time can be here')
+        >>> with file_lock('/tmp/example.lock', shared=True):
+        ...     print('many readers can be here at once, but not while an exclusive lock is held')
+    
+    :param str lock_path: Absolute path to the lock file
+    :param bool shared: (Default: ``False``) If True, acquire a shared (read) lock instead of an exclusive lock
+    """
+    with open(lock_path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield fp
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def reflink_file(src: str, dst: str):
+    """
+    Create ``dst`` as a copy-on-write clone of ``src`` using the ``FICLONE`` ioctl. No file data is read or written,
+    the new file simply shares the same data blocks until one of them is modified.
+    
+    :raises OSError: If the filesystem doesn't support reflinks (or ``src`` and ``dst`` are on different filesystems)
+    """
+    with open(src, 'rb') as s_fp, open(dst, 'wb') as d_fp:
+        fcntl.ioctl(d_fp.fileno(), FICLONE, s_fp.fileno())
+
+
+def copy_range_file(src: str, dst: str):
+    """Copy ``src`` to ``dst`` inside of the kernel using ``os.copy_file_range`` (Linux 4.5+ / Python 3.8+)"""
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'os.copy_file_range is not available')
+    with open(src, 'rb') as s_fp, open(dst, 'wb') as d_fp:
+        while os.copy_file_range(s_fp.fileno(), d_fp.fileno(), _CHUNK_SIZE) > 0:
+            pass
+
+
+def sendfile_file(src: str, dst: str):
+    """Copy ``src`` to ``dst`` inside of the kernel using ``os.sendfile``"""
+    with open(src, 'rb') as s_fp, open(dst, 'wb') as d_fp:
+        offset = 0
+        while True:
+            sent = os.sendfile(d_fp.fileno(), s_fp.fileno(), offset, _CHUNK_SIZE)
+            if sent == 0:
+                break
+            offset += sent
+
+
+_TRANSFER_FUNCS = {
+    'reflink': reflink_file,
+    'hardlink': os.link,
+    'copy_range': copy_range_file,
+    'sendfile': sendfile_file,
+    'copy': shutil.copyfile,
+}  # type: Dict[str, Callable[[str, str], None]]
+
+
+def transfer_file(src: str, dst: str, mode: str = 'auto', allow_hardlink=True) -> str:
+    """
+    Recreate the file ``src`` at ``dst`` using the cheapest method available (see :py:attr:`.TRANSFER_MODES`).
+    If ``dst`` already exists, it's replaced.
+    
+    With ``auto`` mode, the first method which works between the source + destination filesystems is remembered,
+    so the unsupported methods aren't retried for every file.
+    
+    Example:
+    
+        >>> transfer_file('/tmp/eosjs123/dist-web/eosjs-api.js', '/opt/cdn/eosjs/20.0.1/eosjs-api.js')
+        'reflink'
+    
+    :param str src: The file to copy from
+    :param str dst: The file to create
+    :param str mode: The copy method to use - see :py:attr:`.TRANSFER_MODES`
+    :param bool allow_hardlink: (Default: ``True``) If False, ``auto`` never hardlinks - for copies which must be
+                                independent of ``src`` (e.g. synced to another server's mount)
+    :return str mode: The copy method which was actually used (useful if ``mode`` was ``auto``)
+    """
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f'Invalid transfer mode "{mode}" - must be one of: {", ".join(TRANSFER_MODES)}')
+    if os.path.lexists(dst):
+        os.remove(dst)
+    
+    candidates = list(TRANSFER_MODES[1:]) if mode == 'auto' else [mode]
+    cache_key = None
+    if mode == 'auto':
+        cache_key = (os.stat(src).st_dev, os.stat(dirname(dst) or '.').st_dev)
+        with _mode_cache_lock:
+            if cache_key in _mode_cache:
+                candidates = candidates[candidates.index(_mode_cache[cache_key]):]
+        if not allow_hardlink:
+            candidates = [m for m in candidates if m != 'hardlink']
+            # The cached mode would be wrong for calls which do allow hardlinks
+            cache_key = None
+    
+    for i, m in enumerate(candidates):
+        try:
+            _TRANSFER_FUNCS[m](src, dst)
+        except OSError as e:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if i == len(candidates) - 1 or e.errno not in _NOT_SUPPORTED:
+                raise
+            log.debug('Transfer mode "%s" not supported for "%s" (%s) - falling back', m, dst, e)
+            continue
+        if m != 'hardlink':
+            shutil.copymode(src, dst)
+        if cache_key is not None:
+            with _mode_cache_lock:
+                _mode_cache[cache_key] = m
+        return m
+
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+def exchange_paths(a: str, b: str):
+    """
+    Atomically swap the two existing paths ``a`` and ``b`` (e.g. two folders) using Linux's ``renameat2`` with
+    ``RENAME_EXCHANGE`` - at no point does either path not exist.
+    
+    :raises OSError: If the swap failed, or ``renameat2`` isn't supported by the OS / C library / filesystem
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 is None:
+        raise OSError(errno.ENOSYS, 'renameat2 is not available')
+    if renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), a)
+
+
+def replace_symlink(target: str, link: str) -> bool:
+    """
+    Atomically create or re-point the symlink ``link`` to ``target`` (by creating a temporary symlink, then renaming
+    it over ``link``) - so readers see either the old target or the new target, never a missing file.
+    
+    :return bool changed: ``False`` if ``link`` already pointed to ``target``, otherwise ``True``
+    """
+    if islink(link) and os.readlink(link) == target:
+        return False
+    tmp_link = join(dirname(link), f'.{os.path.basename(link)}.tmp{os.getpid()}')
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link)
+    return True
+
+
+def link_tree(src: str, dst: str, mode: str = 'auto', ignore: Callable[[str], bool] = None,
+              allow_hardlink=True) -> str:
+    """
+    Recreate the folder ``src`` at ``dst`` (which must not exist yet) using the cheapest file copy method available
+    (see :func:`.transfer_file`). Symlinks inside of ``src`` are recreated as symlinks.
+    
+    Example:
+    
+        >>> link_tree('/tmp/build/dist', '/tmp/publish/dist')
+        'hardlink'
+        >>> link_tree('/tmp/build/node_modules', '/opt/cache/node_modules/5f1e.../node_modules', allow_hardlink=False)
+        'reflink'
+    
+    :param str src: The folder to copy from
+    :param str dst: The destination folder to create
+    :param str mode: The copy method to use - see :py:attr:`.TRANSFER_MODES`
+    :param callable ignore: (Optional) Called with each path relative to ``src`` - return ``True`` to skip it
+    :param bool allow_hardlink: (Default: ``True``) If False, ``auto`` never hardlinks (see :func:`.transfer_file`)
+    :return str mode: The copy method which was used for the last file copied (``mode`` if there were no files)
+    """
+    used = mode
+    os.makedirs(dst)
+    for root, dirs, files in os.walk(src):
+        out_root = join(dst, relpath(root, src))
+        for name in list(dirs) + files:
+            s_path, d_path = join(root, name), join(out_root, name)
+            if ignore is not None and ignore(relpath(s_path, src)):
+                if name in dirs:
+                    dirs.remove(name)
+                continue
+            if islink(s_path):
+                os.symlink(os.readlink(s_path), d_path)
+            elif name in dirs:
+                os.mkdir(d_path)
+                shutil.copymode(s_path, d_path)
+            else:
+                used = transfer_file(s_path, d_path, mode=mode, allow_hardlink=allow_hardlink)
+    return used
+
+
+def dir_size(path: str) -> int:
+    """Total size in bytes of all files within the folder ``path`` (hardlinked files are only counted once)"""
+    total, seen = 0, set()
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            st = os.lstat(join(root, f))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+def file_digest(path: str, *algorithms: str) -> dict:
+    """
+    Hash the file ``path`` with one or more ``hashlib`` algorithms, reading it only once (in chunks).
+    
+        >>> d = file_digest('/opt/cdn/eosjs/20.0.1/eosjs-api.js', 'sha256', 'sha384')
+        >>> d['sha256'].hexdigest()
+        '5f1e...'
+    
+    :param str path: The file to hash
+    :param str algorithms: One or more hashlib algorithm names (default: ``sha256``)
+    :return dict hashes: A dict mapping each algorithm name to it's (finished) hashlib object
+    """
+    hashes = {a: hashlib.new(a) for a in (algorithms or ('sha256',))}
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(1024 * 1024)
+            if not chunk:
+                break
+            for h in hashes.values():
+                h.update(chunk)
+    return hashes
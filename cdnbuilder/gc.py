@@ -0,0 +1,272 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import logging
+import os
+import re
+import shutil
+import time
+from os.path import join, isdir, islink, exists
+from typing import Dict, List, Optional, Tuple
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.core import BUILD_DIR_PREFIX, version_key
+from cdnbuilder.files import dir_size
+from cdnbuilder.index import OutputIndex
+from cdnbuilder.publish import LATEST, STAGING_PREFIX
+from cdnbuilder.store import BlobStore
+
+log = logging.getLogger(__name__)
+
+_TEMP_DIR_RE = re.compile(r'^(?:' + re.escape(BUILD_DIR_PREFIX) + r'.+-|' + re.escape(STAGING_PREFIX) + r')(\d+)-[^-]+$')
+_VERSION_RE = re.compile(r'^[vV]?\d')
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user
+        return True
+    return True
+
+
+def _remove_tree(path: str) -> bool:
+    try:
+        shutil.rmtree(path)
+        return True
+    except OSError as e:
+        log.warning('Failed to remove "%s": %s', path, e)
+        return False
+
+
+class GarbageCollector:
+    """
+    Reclaims disk space used by CDN Builder:
+
+     * **Orphaned build folders** - temporary folders in ``BUILD_FOLDER`` (and version staging folders in
+       ``STAGING_FOLDER``) older than ``max_age`` hours, which were left behind by a crashed / killed build. Folders
+       belonging to a process which is still running are never removed.
+     * **Old versions** - for each (sub-)package, only the newest ``keep_versions`` versions are kept.
+     * **Disk budget** - if ``OUT_FOLDER`` is still larger than ``budget`` bytes, the least recently used versions
+       (by file access time) are removed until it fits.
+
+    The version that a package's ``latest`` symlink points to (or it's newest version) is never removed, and neither
+    are pinned versions - from the ``GC_PINNED`` setting (e.g. ``eosjs@20.0.1,scatter-js/core@11.0.1``) or a library's
+    :py:attr:`.BaseLib.pinned_versions`. Libraries can also override ``keep_versions`` with
+    :py:attr:`.BaseLib.keep_versions`.
+
+    Example:
+
+        >>> gc = GarbageCollector(keep_versions=5, budget=20 * 1024 ** 3, dry_run=True)
+        >>> gc.run()
+        {'build_dirs': (2, 2147483648), 'versions': (14, 73400320), 'blobs': (0, 0)}
+
+    """
+    def __init__(self, max_age: float = None, keep_versions: int = None, budget: int = None,
+                 pinned: List[str] = None, dry_run=False):
+        self.max_age = (settings.GC_BUILD_MAX_AGE if max_age is None else float(max_age)) * 3600
+        self.keep_versions = settings.GC_KEEP_VERSIONS if keep_versions is None else int(keep_versions)
+        self.budget = settings.GC_OUTPUT_BUDGET if budget is None else int(budget)
+        self.pinned = set(settings.GC_PINNED if pinned is None else pinned)
+        self.dry_run = dry_run
+        self.lib_meta = self._lib_meta()
+
+    @staticmethod
+    def _lib_meta() -> Dict[str, dict]:
+        """Retention settings of each library class (from the registry - so no libraries are imported), by lib_name"""
+        from cdnbuilder.registry import get_registry
+        try:
+            return {l['lib_name']: l for l in get_registry().libs().values() if not empty(l.get('lib_name'))}
+        except Exception:
+            log.warning('Failed to load library metadata - per-library retention settings will be ignored', exc_info=True)
+            return {}
+
+    def _remove(self, path: str, size: int, reason: str) -> bool:
+        log.info('%s %s "%s" (%d bytes)', 'Would remove' if self.dry_run else 'Removing', reason, path, size)
+        return True if self.dry_run else _remove_tree(path)
+
+    def _is_orphan(self, path: str, name: str) -> bool:
+        m = _TEMP_DIR_RE.match(name)
+        if m is not None and _pid_alive(int(m.group(1))):
+            return False
+        return time.time() - os.lstat(path).st_mtime >= self.max_age
+
+    def clean_temp_dirs(self) -> Tuple[int, int]:
+        """
+        Remove orphaned temporary build folders in ``BUILD_FOLDER``, and staging folders in ``STAGING_FOLDER`` - or
+        in each library's output folder, where older versions staged them (see the class docs)
+        
+        :return tuple res: ``(folders_removed, bytes_freed)``
+        """
+        candidates = []
+        if isdir(settings.BUILD_FOLDER):
+            for name in os.listdir(settings.BUILD_FOLDER):
+                if name.startswith(BUILD_DIR_PREFIX):
+                    candidates.append((join(settings.BUILD_FOLDER, name), name))
+        if isdir(settings.STAGING_FOLDER):
+            for name in os.listdir(settings.STAGING_FOLDER):
+                if name.startswith(STAGING_PREFIX):
+                    candidates.append((join(settings.STAGING_FOLDER, name), name))
+        if isdir(settings.OUT_FOLDER):
+            for lib in os.listdir(settings.OUT_FOLDER):
+                lib_folder = join(settings.OUT_FOLDER, lib)
+                if lib.startswith('.') or islink(lib_folder) or not isdir(lib_folder):
+                    continue
+                candidates += [(join(lib_folder, n), n) for n in os.listdir(lib_folder) if n.startswith(STAGING_PREFIX)]
+        
+        removed, freed = 0, 0
+        for path, name in candidates:
+            try:
+                if islink(path) or not isdir(path) or not self._is_orphan(path, name):
+                    continue
+                size = dir_size(path)
+            except FileNotFoundError:
+                # Finished (and cleaned up) by it's build while we were looking at it
+                continue
+            if self._remove(path, size, 'orphaned build folder'):
+                removed, freed = removed + 1, freed + size
+        return removed, freed
+
+    def output_versions(self) -> List[dict]:
+        """
+        Find every published version in ``OUT_FOLDER``. Returns a list of dicts containing the ``lib``, ``package``,
+        ``version``, ``path``, ``size`` (bytes which would be freed by removing it), ``last_used`` (unix time),
+        and ``protected`` (why it can't be removed - or ``None``)
+        """
+        versions = []
+        if not isdir(settings.OUT_FOLDER):
+            return versions
+        # With the blob store, each published file has one extra hardlink (it's blob)
+        max_links = 2 if settings.DEDUPE_OUTPUT else 1
+        for lib in sorted(os.listdir(settings.OUT_FOLDER)):
+            lib_folder = join(settings.OUT_FOLDER, lib)
+            if lib.startswith('.') or islink(lib_folder) or not isdir(lib_folder):
+                continue
+            meta = self.lib_meta.get(lib, {})
+            pinned = set(meta.get('pinned_versions') or [])
+            pkg_roots = [(None, lib_folder)] + [
+                (d, join(lib_folder, d)) for d in sorted(os.listdir(lib_folder))
+                if not d.startswith('.') and d != LATEST and not _VERSION_RE.match(d)
+                and isdir(join(lib_folder, d)) and not islink(join(lib_folder, d))
+            ]
+            for package, pkg_root in pkg_roots:
+                names = [
+                    v for v in os.listdir(pkg_root)
+                    if _VERSION_RE.match(v) and isdir(join(pkg_root, v)) and not islink(join(pkg_root, v))
+                ]
+                if len(names) == 0:
+                    continue
+                latest = join(pkg_root, LATEST)
+                latest = os.readlink(latest) if islink(latest) else max(names, key=version_key)
+                for v in names:
+                    path, size, last_used = join(pkg_root, v), 0, 0
+                    for root, _, files in os.walk(path):
+                        for f in files:
+                            st = os.lstat(join(root, f))
+                            last_used = max(last_used, st.st_atime, st.st_mtime)
+                            if st.st_nlink <= max_links:
+                                size += st.st_size
+                    spec = f'{package}@{v}' if package else v
+                    protected = None
+                    if v == latest:
+                        protected = 'latest'
+                    elif spec in pinned or f'{lib}/{spec}' in self.pinned or f'{lib}@{spec}' in self.pinned:
+                        protected = 'pinned'
+                    versions.append(dict(
+                        lib=lib, package=package, version=v, path=path, size=size, last_used=last_used,
+                        protected=protected, keep=meta.get('keep_versions')
+                    ))
+        return versions
+
+    def clean_versions(self) -> Tuple[int, int]:
+        """
+        Apply the retention policy (``keep_versions``), then the disk budget to ``OUT_FOLDER`` - see the class docs.
+        
+        :return tuple res: ``(versions_removed, bytes_freed)``
+        """
+        versions = self.output_versions()
+        remove = []  # type: List[dict]
+        
+        # Keep the newest N versions of each (sub-)package
+        groups = {}
+        for v in versions:
+            groups.setdefault((v['lib'], v['package']), []).append(v)
+        for group in groups.values():
+            keep = group[0]['keep'] if group[0]['keep'] is not None else self.keep_versions
+            if keep is None or keep <= 0:
+                continue
+            group = sorted(group, key=lambda x: version_key(x['version']), reverse=True)
+            remove += [v for v in group[keep:] if v['protected'] is None]
+        
+        # Then if we're still over budget, remove the least recently used versions until we fit
+        if self.budget > 0:
+            total = dir_size(settings.OUT_FOLDER) - sum(v['size'] for v in remove)
+            removing = set(v['path'] for v in remove)
+            candidates = sorted(
+                [v for v in versions if v['protected'] is None and v['path'] not in removing],
+                key=lambda x: x['last_used']
+            )
+            while total > self.budget and len(candidates) > 0:
+                v = candidates.pop(0)
+                remove.append(v)
+                total -= v['size']
+            if total > self.budget:
+                log.warning('Output folder is still over budget (%d > %d bytes) - the remaining versions are '
+                            'either the latest version of their package, or pinned', total, self.budget)
+        
+        removed, freed, by_lib = 0, 0, {}
+        for v in remove:
+            if self._remove(v['path'], v['size'], f"version {v['version']} of {v['lib']}/{v['package'] or ''}"):
+                removed, freed = removed + 1, freed + v['size']
+                by_lib.setdefault(v['lib'], []).append((v['package'], v['version']))
+        if not self.dry_run:
+            for lib, removed_versions in by_lib.items():
+                OutputIndex(lib).remove_versions(removed_versions)
+        return removed, freed
+
+    def run(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Clean up orphaned build folders, old versions, and then any blobs no longer used by a version.
+        
+        :return dict res: ``(removed, bytes_freed)`` for each of ``build_dirs``, ``versions`` and ``blobs``
+        """
+        res = dict(build_dirs=self.clean_temp_dirs(), versions=self.clean_versions(), blobs=(0, 0))
+        if settings.DEDUPE_OUTPUT and exists(settings.BLOB_FOLDER):
+            res['blobs'] = BlobStore().cleanup(dry_run=self.dry_run)
+        return res
@@ -0,0 +1,185 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import http.client
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urljoin
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+
+log = logging.getLogger(__name__)
+
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# Errors raised when a pooled keep-alive connection was closed by the server while it was idle
+_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+def same_origin(url: str, other: str) -> bool:
+    """Returns ``True`` if both URLs have the same scheme and host (including the port)"""
+    a, b = urlsplit(url), urlsplit(other)
+    return (a.scheme.lower(), a.netloc.lower()) == (b.scheme.lower(), b.netloc.lower())
+
+
+class ConnectionPool:
+    """
+    A small thread-safe pool of keep-alive :mod:`http.client` connections, so repeated requests to the same host
+    (e.g. the npm registry) don't pay for a new TCP + TLS handshake every time.
+
+    Example:
+
+        >>> pool = ConnectionPool()
+        >>> with pool.request('GET', 'https://registry.npmjs.org/eosjs') as res:
+        ...     data = json.load(res)
+
+    """
+    def __init__(self, max_idle: int = None, timeout: float = None):
+        """
+        :param int max_idle: Idle connections to keep open for each host (default: :py:attr:`.settings.HTTP_POOL_SIZE`)
+        :param float timeout: Socket timeout in seconds (default: :py:attr:`.settings.HTTP_TIMEOUT`)
+        """
+        self.max_idle = settings.HTTP_POOL_SIZE if max_idle is None else int(max_idle)
+        self.timeout = settings.HTTP_TIMEOUT if timeout is None else float(timeout)
+        self._idle = {}     # type: Dict[Tuple[str, str], List[http.client.HTTPConnection]]
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _get(self, key: Tuple[str, str]) -> Tuple[http.client.HTTPConnection, bool]:
+        """Returns an idle connection to ``key`` (``(scheme, host:port)``) if there is one, otherwise a new one"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # We were forked - the sockets are shared with the parent process, so we can't use them
+                self._idle, self._pid = {}, os.getpid()
+            idle = self._idle.get(key, [])
+            if len(idle) > 0:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _connect(self, key: Tuple[str, str]) -> http.client.HTTPConnection:
+        scheme, host = key
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return cls(host, timeout=self.timeout)
+
+    def _put(self, key: Tuple[str, str], conn: http.client.HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle and self._pid == os.getpid():
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, method: str, url: str, headers: dict, body=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if not empty(parts.query):
+            path += '?' + parts.query
+        conn, reused = self._get(key)
+        while True:
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return key, conn, conn.getresponse()
+            except _STALE_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                # The server closed the idle connection - retry once with a fresh one
+                log.debug('Pooled connection to %s was closed - reconnecting', parts.netloc)
+                conn, reused = self._connect(key), False
+            except BaseException:
+                conn.close()
+                raise
+
+    def _release(self, key, conn: http.client.HTTPConnection, res: http.client.HTTPResponse):
+        # Connections can only be reused once the response has been fully read
+        if res.isclosed() and not res.will_close:
+            self._put(key, conn)
+        else:
+            conn.close()
+
+    @contextmanager
+    def request(self, method: str, url: str, headers: dict = None, body=None):
+        """
+        Send a request, following up to :py:attr:`.MAX_REDIRECTS` redirects. Yields the
+        :class:`http.client.HTTPResponse` - once the ``with`` block exits, the connection is returned to the pool
+        (if the response was read to the end), or closed.
+
+        The ``Authorization`` header is dropped when a redirect leads to a different scheme or host, so credentials
+        are never handed to a server they weren't meant for.
+        """
+        headers = {} if headers is None else dict(headers)
+        for _ in range(MAX_REDIRECTS + 1):
+            key, conn, res = self._send(method, url, headers, body)
+            if res.status not in REDIRECTS or empty(res.getheader('Location')):
+                break
+            res.read()
+            self._release(key, conn, res)
+            new_url = urljoin(url, res.getheader('Location'))
+            if not same_origin(url, new_url):
+                headers = {k: v for k, v in headers.items() if k.lower() != 'authorization'}
+            url = new_url
+            log.debug('Following redirect to %s', url)
+        else:
+            conn.close()
+            raise http.client.HTTPException(f'Too many redirects requesting {url}')
+        try:
+            yield res
+        finally:
+            self._release(key, conn, res)
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for c in conns:
+                c.close()
+
+
+_pool = None    # type: Optional[ConnectionPool]
+
+
+def get_pool() -> ConnectionPool:
+    """Returns the shared :class:`.ConnectionPool` instance"""
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool()
+    return _pool
@@ -0,0 +1,224 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import base64
+import json
+import logging
+import os
+import time
+from os import makedirs
+from os.path import join, exists
+from typing import Dict, List, Optional, Tuple
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.core import version_key
+from cdnbuilder.files import file_lock, file_digest
+from cdnbuilder.libs.base import FileOutput
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = 'index.json'
+
+
+def _write_json(out_path: str, data: dict):
+    """Write ``data`` to a temporary file and then rename it, so readers never see a partially written index"""
+    tmp_path = f'{out_path}.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(data, fp, indent=2)
+    os.replace(tmp_path, out_path)
+
+
+def file_info(out_file: str) -> dict:
+    """
+    Collect the size, mtime, SHA-256 and SRI (``sha384-...``) hash of the published file ``out_file``,
+    reading it only once.
+
+        >>> file_info('/opt/cdn/eosjs/20.0.1/eosjs-api.js')
+        {'size': 39718, 'mtime': 1571304480, 'sha256': '5f1e...', 'sri': 'sha384-oqVuAfXRKap7fdgcCY5uykM6+R9GqQ8K...'}
+
+    """
+    st = os.stat(out_file)
+    d = file_digest(out_file, 'sha256', 'sha384')
+    return dict(
+        size=st.st_size, mtime=int(st.st_mtime), sha256=d['sha256'].hexdigest(),
+        sri='sha384-' + base64.b64encode(d['sha384'].digest()).decode()
+    )
+
+
+class OutputIndex:
+    """
+    A JSON index of the libraries, versions and files published into ``OUT_FOLDER``, which is updated incrementally
+    each time a library is published - so the CDN frontend / purge tooling don't have to walk the output folder.
+
+    Two levels of index are kept:
+
+     - ``OUT_FOLDER/index.json`` - every library, with the known versions and newest (``latest``) version of each
+       of it's (sub-)packages. Small enough to answer "what's the newest scatter-js core?" with a single read.
+     - ``OUT_FOLDER/<lib_name>/index.json`` - every published file of the library, with it's version, package,
+       filename, size, mtime, SHA-256 and SRI hash (plus the same details for any precompressed variants)
+
+    Libraries without sub-packages are listed under the package name ``""``.
+
+    Example::
+
+        >>> idx = OutputIndex('scatter-js')
+        >>> idx.update(files)    # List[FileOutput] as returned by BaseLib.build
+        >>> OutputIndex.load_root()['libs']['scatter-js']['packages']['core']['latest']
+        '11.0.1'
+        >>> idx.load()['packages']['core']['versions']['11.0.1']['files']['scatterjs-core.min.js']['sri']
+        'sha384-oqVuAfXRKap7fdgcCY5uykM6+R9GqQ8K...'
+
+    """
+    def __init__(self, lib_name: str, out_folder: str = None):
+        self.lib_name = lib_name
+        self.out_folder = settings.OUT_FOLDER if empty(out_folder) else out_folder
+        self.path = join(self.out_folder, lib_name, INDEX_NAME)
+        self.root_path = join(self.out_folder, INDEX_NAME)
+        # A single lock for the library indexes and the root index, as updating a library updates both
+        self.lock_path = join(settings.LOCK_FOLDER, 'index.lock')
+
+    def load(self) -> dict:
+        """Load this library's index from disk. Returns an empty index if it doesn't exist yet."""
+        if not exists(self.path):
+            return dict(lib=self.lib_name, updated_at=None, packages={})
+        with open(self.path) as fp:
+            return json.load(fp)
+
+    @classmethod
+    def load_root(cls, out_folder: str = None) -> dict:
+        """Load the root index (``OUT_FOLDER/index.json``). Returns an empty index if it doesn't exist yet."""
+        root_path = join(settings.OUT_FOLDER if empty(out_folder) else out_folder, INDEX_NAME)
+        if not exists(root_path):
+            return dict(updated_at=None, libs={})
+        with open(root_path) as fp:
+            return json.load(fp)
+
+    def has_version(self, package: Optional[str], version: str) -> bool:
+        """Returns ``True`` if ``version`` of the (sub-)package ``package`` is in this library's index"""
+        return version in self.load()['packages'].get(package or '', {}).get('versions', {})
+
+    def file_entry(self, f: FileOutput, info: dict = None) -> dict:
+        """
+        Generate the index entry for the published :class:`.FileOutput` ``f``
+
+        :param FileOutput f: The published file
+        :param dict info: (Optional) The file's details if they're already known (see :func:`.stream_publish`),
+                          otherwise the file and it's variants are hashed
+        """
+        rel_path = join(self.lib_name, f.pkg_folder, f.filename)
+        out_file = join(self.out_folder, rel_path)
+        if info is not None:
+            info = dict(info)
+            variants = info.pop('variants')
+        else:
+            info, variants = file_info(out_file), {}
+            for fmt in settings.COMPRESS_FORMATS:
+                if exists(f'{out_file}.{fmt}'):
+                    v = file_info(f'{out_file}.{fmt}')
+                    variants[fmt] = dict(size=v['size'], sha256=v['sha256'])
+        return dict(
+            path=rel_path, package=f.package, version=f.version, filename=f.filename, dest_folder=f.dest_folder,
+            **info, variants=variants
+        )
+
+    def update(self, files: List[FileOutput], infos: Dict[str, dict] = None):
+        """
+        Add (or replace) the versions which the published ``files`` belong to in this library's index, then update
+        the library's entry in the root index.
+
+        Only the versions in ``files`` are hashed, any other versions already in the index are left as they are.
+        Files whose path (relative to ``OUT_FOLDER``) is in ``infos`` aren't hashed again - their details were
+        already collected while they were published.
+        """
+        infos = {} if infos is None else infos
+        if len(files) == 0:
+            return
+        # Hash the files before taking the lock, so concurrent publishes of other libraries aren't held up
+        versions = {}
+        for f in files:
+            key = (f.package or '', f.version)
+            entry = self.file_entry(f, infos.get(join(self.lib_name, f.pkg_folder, f.filename)))
+            versions.setdefault(key, {})[join(f.dest_folder or '', f.filename)] = entry
+
+        now = int(time.time())
+        makedirs(self.out_folder, exist_ok=True)
+        makedirs(settings.LOCK_FOLDER, exist_ok=True)
+        with file_lock(self.lock_path):
+            idx = self.load()
+            for (package, version), ver_files in versions.items():
+                pkg = idx['packages'].setdefault(package, dict(latest=None, versions={}))
+                pkg['versions'][version] = dict(published_at=now, files=ver_files)
+                pkg['latest'] = max(pkg['versions'].keys(), key=version_key)
+            idx['updated_at'] = now
+            _write_json(self.path, idx)
+            self._update_root(idx)
+        log.info('Updated the output index for "%s" (%d versions)', self.lib_name, len(versions))
+
+    def remove_versions(self, versions: List[Tuple[Optional[str], str]]):
+        """
+        Remove each ``(package, version)`` in ``versions`` from this library's index (e.g. after they've been deleted
+        by ``gc``), then update the library's entry in the root index.
+        """
+        if len(versions) == 0 or not exists(self.path):
+            return
+        makedirs(settings.LOCK_FOLDER, exist_ok=True)
+        with file_lock(self.lock_path):
+            idx = self.load()
+            for package, version in versions:
+                pkg = idx['packages'].get(package or '')
+                if pkg is None:
+                    continue
+                pkg['versions'].pop(version, None)
+                if len(pkg['versions']) == 0:
+                    del idx['packages'][package or '']
+                else:
+                    pkg['latest'] = max(pkg['versions'].keys(), key=version_key)
+            idx['updated_at'] = int(time.time())
+            _write_json(self.path, idx)
+            self._update_root(idx)
+
+    def _update_root(self, idx: dict):
+        """Update this library's summary in the root index from it's library index ``idx`` (must hold the lock)"""
+        root = self.load_root(self.out_folder)
+        packages = {
+            name: dict(latest=pkg['latest'], versions=sorted(pkg['versions'].keys(), key=version_key))
+            for name, pkg in idx['packages'].items()
+        }
+        root['libs'][self.lib_name] = dict(
+            updated_at=idx['updated_at'], index=join(self.lib_name, INDEX_NAME), packages=packages
+        )
+        root['updated_at'] = idx['updated_at']
+        _write_json(self.root_path, root)
@@ -0,0 +1,331 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import Process
+from os import makedirs
+from os.path import dirname
+from typing import List, Optional, Dict
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.build import build_lib
+from cdnbuilder.metrics import BuildMetrics
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lib TEXT NOT NULL,
+    force INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker TEXT,
+    lease_expires REAL,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+
+def worker_id() -> str:
+    """A unique name for this worker process, e.g. ``build1.example.com:12345``"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+    """
+    A queue of library builds, stored in a SQLite database (``QUEUE_DB``) - so any number of worker processes
+    (including on other machines, if the database is on a volume they all share) can pull builds from it.
+
+    Workers :py:meth:`.claim` a job, which leases it to them for ``lease_time`` seconds. While building, the worker
+    sends a :py:meth:`.heartbeat` to extend it's lease. If a worker dies, it's lease expires, and the job is handed to
+    the next worker which asks for one (up to ``max_attempts`` times - after that, the job is marked as failed).
+
+    Example:
+
+        >>> q = JobQueue()
+        >>> q.enqueue(['eosjs', 'scatterjs'])
+        [1, 2]
+        >>> job = q.claim('worker-1')
+        >>> job['lib']
+        'eosjs'
+        >>> q.complete(job['id'], 'worker-1', ok=True, result={'status': 'built'})
+        True
+
+    Note: SQLite relies on the filesystem's locking - if the database is on a network volume, make sure it supports
+    POSIX locks (e.g. NFSv4).
+    """
+    def __init__(self, path: str = None, lease_time: float = None):
+        self.path = settings.QUEUE_DB if empty(path) else path
+        self.lease_time = settings.QUEUE_LEASE if lease_time is None else float(lease_time)
+        makedirs(dirname(self.path) or '.', exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _conn(self):
+        # Connections aren't shared between threads (e.g. the heartbeat thread), so open one per operation
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """An exclusive write transaction - so two workers can never claim the same job"""
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def enqueue(self, libs: List[str], force=False, max_attempts: int = None) -> List[int]:
+        """
+        Add a build job for each library in ``libs``. Libraries which already have a queued / running job
+        aren't added again.
+
+        :return List[int] ids: The job ID for each library (existing jobs return their current ID)
+        """
+        max_attempts = settings.QUEUE_MAX_ATTEMPTS if max_attempts is None else int(max_attempts)
+        ids = []
+        with self._transaction() as conn:
+            for lib in libs:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE lib = ? AND status IN ('queued', 'running')", (lib,)
+                ).fetchone()
+                if row is not None:
+                    log.info('Library "%s" is already queued (job %d)', lib, row['id'])
+                    ids.append(row['id'])
+                    continue
+                cur = conn.execute(
+                    'INSERT INTO jobs (lib, force, max_attempts, enqueued_at) VALUES (?, ?, ?, ?)',
+                    (lib, int(force), max_attempts, time.time())
+                )
+                ids.append(cur.lastrowid)
+        return ids
+
+    @staticmethod
+    def _reclaim(conn: sqlite3.Connection) -> int:
+        now = time.time()
+        expired = conn.execute(
+            "SELECT id, lib, worker, attempts, max_attempts FROM jobs WHERE status = 'running' AND lease_expires < ?",
+            (now,)
+        ).fetchall()
+        for job in expired:
+            retry = job['attempts'] < job['max_attempts']
+            log.warning('Lease of job %d (%s) held by worker "%s" expired - %s', job['id'], job['lib'], job['worker'],
+                        'requeueing it' if retry else 'no attempts left, marking it as failed')
+            conn.execute(
+                'UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, finished_at = ?, error = ? WHERE id = ?',
+                ('queued' if retry else 'failed', None if retry else now, f"Lease expired (worker: {job['worker']})",
+                 job['id'])
+            )
+        return len(expired)
+
+    def reclaim_expired(self) -> int:
+        """Requeue (or fail) every running job whose lease has expired. Returns the number of jobs reclaimed."""
+        with self._transaction() as conn:
+            return self._reclaim(conn)
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """
+        Lease the oldest queued job to ``worker`` (after reclaiming any expired leases)
+
+        :return dict job: The claimed job row (as a dict), or ``None`` if there are no queued jobs
+        """
+        with self._transaction() as conn:
+            self._reclaim(conn)
+            job = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if job is None:
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, lease_expires = ?, "
+                "started_at = ?, error = NULL WHERE id = ?", (worker, now + self.lease_time, now, job['id'])
+            )
+            return dict(job, status='running', worker=worker, attempts=job['attempts'] + 1,
+                        lease_expires=now + self.lease_time, started_at=now)
+
+    def heartbeat(self, job_id: int, worker: str) -> bool:
+        """Extend ``worker``'s lease on a job. Returns ``False`` if the worker no longer holds the lease."""
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_time, job_id, worker)
+            )
+            return cur.rowcount > 0
+
+    def complete(self, job_id: int, worker: str, ok: bool, result: dict = None, error: str = None) -> bool:
+        """
+        Record the result of a job. Returns ``False`` (and records nothing) if ``worker`` lost it's lease, as the job
+        may have been handed to another worker.
+        """
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ?, lease_expires = NULL "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                ('done' if ok else 'failed', time.time(), None if result is None else json.dumps(result, default=str),
+                 error, job_id, worker)
+            )
+            return cur.rowcount > 0
+
+    def jobs(self, status: str = None, limit: int = 100) -> List[dict]:
+        """List the most recent jobs (optionally only those with ``status``)"""
+        with self._conn() as conn:
+            if status is None:
+                rows = conn.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+            else:
+                rows = conn.execute('SELECT * FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?',
+                                    (status, limit)).fetchall()
+        res = []
+        for r in rows:
+            job = dict(r)
+            job['result'] = None if job['result'] is None else json.loads(job['result'])
+            res.append(job)
+        return res
+
+    def stats(self) -> Dict[str, int]:
+        """Number of jobs with each status"""
+        with self._conn() as conn:
+            counts = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {s: counts.get(s, 0) for s in STATUSES}
+
+
+class QueueWorker:
+    """
+    Claims jobs from a :class:`.JobQueue` and builds them with :func:`.build_lib`, sending heartbeats from a
+    background thread while each build runs.
+
+    Example:
+
+        >>> QueueWorker(JobQueue()).run(exit_when_empty=True)
+        3
+
+    """
+    def __init__(self, queue: JobQueue, name: str = None, poll_interval: float = None,
+                 heartbeat_interval: float = None):
+        self.queue = queue
+        self.name = worker_id() if empty(name) else name
+        self.poll_interval = settings.QUEUE_POLL if poll_interval is None else float(poll_interval)
+        self.heartbeat_interval = settings.QUEUE_HEARTBEAT if heartbeat_interval is None else float(heartbeat_interval)
+
+    def _heartbeat(self, job_id: int, stop: threading.Event):
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                if not self.queue.heartbeat(job_id, self.name):
+                    log.warning('[%s] Lost the lease on job %d - another worker may build it too', self.name, job_id)
+                    return
+            except sqlite3.Error:
+                log.exception('[%s] Failed to send heartbeat for job %d', self.name, job_id)
+
+    def run_job(self, job: dict) -> bool:
+        """Build the library of the claimed ``job``, and record the result in the queue"""
+        log.info('[%s] Building library "%s" (job %d, attempt %d)', self.name, job['lib'], job['id'], job['attempts'])
+        stop = threading.Event()
+        hb = threading.Thread(target=self._heartbeat, args=(job['id'], stop), daemon=True)
+        hb.start()
+        metrics, ok, error = BuildMetrics(job['lib']), False, None
+        try:
+            build_lib(job['lib'], force=bool(job['force']), metrics=metrics)
+            ok = True
+        except Exception as e:
+            log.exception('[%s] Error while building library "%s"...', self.name, job['lib'])
+            error = f'{type(e).__name__}: {e}'
+        finally:
+            stop.set()
+            hb.join()
+        if not self.queue.complete(job['id'], self.name, ok, result=metrics.to_dict(), error=error):
+            log.warning('[%s] Lease on job %d expired before it finished - result not recorded', self.name, job['id'])
+        return ok
+
+    def run(self, max_jobs: int = None, exit_when_empty=False) -> int:
+        """
+        Claim and build jobs until ``max_jobs`` have been ran - or if ``exit_when_empty`` is True, until there are no
+        more queued jobs. Otherwise, polls for new jobs forever.
+
+        :return int jobs: The number of jobs which were ran
+        """
+        ran = 0
+        log.info('[%s] Worker started, using queue "%s"', self.name, self.queue.path)
+        while max_jobs is None or ran < max_jobs:
+            job = self.queue.claim(self.name)
+            if job is None:
+                if exit_when_empty:
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            self.run_job(job)
+            ran += 1
+        return ran
+
+
+def _worker_process(path: str, exit_when_empty: bool):
+    QueueWorker(JobQueue(path)).run(exit_when_empty=exit_when_empty)
+
+
+def run_workers(workers: int = 1, path: str = None, exit_when_empty=False):
+    """
+    Run ``workers`` :class:`.QueueWorker` s against the queue at ``path`` - each in it's own process if there's more
+    than one. Blocks until they've all exited.
+    """
+    if workers <= 1:
+        QueueWorker(JobQueue(path)).run(exit_when_empty=exit_when_empty)
+        return
+    procs = [Process(target=_worker_process, args=(path, exit_when_empty)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
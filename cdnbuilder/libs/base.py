@@ -32,18 +32,25 @@ Copyright::
 
 
 """
+import mmap
+import re
 from abc import abstractmethod, ABC
-from os.path import basename, join
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from hashlib import sha256
+from os import makedirs
+from os.path import basename, join, exists
 from tempfile import TemporaryDirectory
-from typing import List, Tuple, Type, Optional
-from importlib import import_module
+from typing import List, Tuple, Type, Optional, Dict, Iterator, Match, Pattern, Union
 
-from privex.helpers import is_true
+from privex.helpers import is_true, empty
 
 from cdnbuilder import settings
 from cdnbuilder.builders.base import BaseBuilder
+from cdnbuilder.core import CommandHelper, get_builder, build_dir_prefix
 from cdnbuilder.downloaders.BaseDownloader import BaseDownloader
 from cdnbuilder.downloaders.GitDownloader import GitDownloader
+from cdnbuilder.metrics import BuildMetrics
 import logging
 
 log = logging.getLogger(__name__)
@@ -100,6 +107,22 @@ Example:
 """
 
 
+@lru_cache(maxsize=None)
+def _bytes_regex(regex: Union[str, Pattern]) -> Pattern[bytes]:
+    """Convert a ``str`` regex (compiled or not) into a compiled ``bytes`` regex, so it can search raw / mmap'd files"""
+    regex = re.compile(regex) if isinstance(regex, (str, bytes)) else regex
+    if isinstance(regex.pattern, str):
+        regex = re.compile(regex.pattern.encode(), regex.flags & ~re.UNICODE)
+    return regex
+
+
+def _match_groups(m: Optional[Match]) -> Optional[tuple]:
+    if m is None:
+        return None
+    groups = m.groups() or (m.group(0),)
+    return tuple(None if g is None else g.decode('utf-8', 'replace') for g in groups)
+
+
 class LibBuilderHelper:
     builder: str
     args: dict
@@ -111,11 +134,7 @@ class LibBuilderHelper:
 
     @staticmethod
     def import_builder(name: str) -> Type[BaseBuilder]:
-        builder_path = name if '.' in name else f'cdnbuilder.builders.{name}'
-        log.debug('Importing builder module: %s', builder_path)
-        builder = import_module(builder_path)
-        log.debug('Successfully imported: %s', builder_path)
-        return builder.export
+        return get_builder(name)
 
     
 class BaseLib(ABC, LibBuilderHelper):
@@ -162,6 +181,18 @@ class BaseLib(ABC, LibBuilderHelper):
     downloader_cls: Type[BaseDownloader] = GitDownloader
     """Downloader class to use to load the source code from :py:attr:`.url`"""
     
+    downloader_args: dict = {}
+    """Any extra configuration options to pass to the downloader class __init__"""
+    
+    ref: Optional[str] = None
+    """The version of the source code to build, e.g. a Git tag, branch or commit. Default: the latest version"""
+    
+    clone_mode: Optional[str] = None
+    """
+    Clone strategy for :class:`.GitDownloader` - ``full`` (default), ``shallow``, ``single-branch`` or ``blobless``.
+    See :py:attr:`cdnbuilder.downloaders.GitDownloader.CLONE_MODES`
+    """
+    
     link_root: bool = True
     """Symlink all component files back to the root package folder"""
     
@@ -171,14 +202,126 @@ class BaseLib(ABC, LibBuilderHelper):
     include_sub: bool = True
     """Include :py:meth:`.identify` for each sub-package in the :py:meth:`.build` output"""
     
+    lock_files: List[str] = ['yarn.lock', 'package-lock.json']
+    """Dependency lock files (relative to the source root) which are hashed and recorded in the build manifest"""
+    
+    keep_versions: Optional[int] = None
+    """Number of versions of each (sub-)package which ``gc`` keeps in the output folder (default: GC_KEEP_VERSIONS)"""
+    
+    pinned_versions: List[str] = []
+    """Versions which ``gc`` never removes, e.g. ``['20.0.1']`` or ``['core@11.0.1']`` for a sub-package"""
+    
+    banner_scan_size: int = 8192
+    """Number of bytes at the start of each file which :py:meth:`.find_banners` scans for a version banner"""
+    
+    build_cpus: Optional[float] = None
+    """Estimated CPU cores used while building, until it's been measured (default: RESOURCE_DEFAULT_CPUS)"""
+    
+    build_memory: Optional[int] = None
+    """Estimated memory (MB) used while building, until it's been measured (default: RESOURCE_DEFAULT_MEMORY)"""
+    
     def __init__(self):
-        self.downloader = self.downloader_cls(self.lib_name, self.url)
-        self.temp_dir_obj = TemporaryDirectory(prefix=self.lib_name, dir=settings.BUILD_FOLDER)
+        self.metrics = BuildMetrics(self.lib_name)
+        self.downloader = self.get_downloader()
+        self.temp_dir_obj = TemporaryDirectory(prefix=build_dir_prefix(self.lib_name), dir=settings.BUILD_FOLDER)
         self.temp_dir = self.temp_dir_obj.name
-
+        self.log_file = None
+        if not empty(settings.BUILD_LOG_FOLDER):
+            makedirs(settings.BUILD_LOG_FOLDER, exist_ok=True)
+            self.log_file = join(settings.BUILD_LOG_FOLDER, f'{self.lib_name}.log')
+        if isinstance(self.downloader, CommandHelper):
+            self.downloader.log_file = self.log_file
+
+    def get_downloader(self) -> BaseDownloader:
+        """
+        Initialise :py:attr:`.downloader_cls` for this library. :py:attr:`.ref` and :py:attr:`.clone_mode` are only
+        passed to the downloader if they're set, so custom downloaders which don't support them still work.
+        """
+        kwargs = dict(self.downloader_args)
+        if not empty(self.ref):
+            kwargs['ref'] = self.ref
+        if not empty(self.clone_mode):
+            kwargs['clone_mode'] = self.clone_mode
+        return self.downloader_cls(self.lib_name, self.url, **kwargs)
+
+    def build_key(self, commit: str = None) -> Optional[dict]:
+        """
+        Generate the key used to identify a build of this library in the :class:`.BuildManifest`
+        
+        If ``commit`` isn't passed, the downloader is asked for the revision that was downloaded - or if we haven't
+        downloaded anything yet, it's cheaply looked up from the remote (e.g. ``git ls-remote``).
+        
+        The dependency lockfile hash isn't part of the key, as it's pinned by the commit - it's recorded
+        alongside the build in the manifest instead (see :py:meth:`.lockfile_hash`).
+        
+        :param str commit: (Optional) The revision of the source code being built
+        :return dict key: The build key, or ``None`` if the downloader can't identify revisions.
+        """
+        dl = self.downloader
+        if empty(commit):
+            commit = dl.revision() if dl.downloaded else dl.remote_revision()
+        if empty(commit):
+            return None
+        return dict(lib=self.lib_name, commit=commit, builder=self.builder, args=self.args)
+    
+    def lockfile_hash(self, folder: str) -> Optional[str]:
+        """Returns the SHA-256 hash of the combined :py:attr:`.lock_files` inside of ``folder`` (``None`` if none exist)"""
+        h, found = sha256(), False
+        for f in self.lock_files:
+            f = join(folder, f)
+            if not exists(f):
+                continue
+            found = True
+            with open(f, 'rb') as fp:
+                h.update(fp.read())
+        return h.hexdigest() if found else None
+    
+    @classmethod
+    def find_banners(cls, paths: List[str], regex: Union[str, Pattern], scan_size: int = None) \
+            -> Dict[str, Optional[tuple]]:
+        """
+        Search each of the files ``paths`` for a version banner matching ``regex``, without reading whole files
+        into memory.
+        
+        Banners are almost always in a comment at the very top of a bundle, so only the first ``scan_size`` bytes
+        of each file are read. If the banner isn't found there, the whole file is searched via ``mmap`` - which lets
+        the regex run over the file without copying it into a Python string.
+        
+            >>> ScatterJSLib.find_banners(['/tmp/sj/scatterjs-core.min.js'], r'ScatterJS - ([a-zA-Z0-9-]+) v([0-9.-]+)')
+            {'/tmp/sj/scatterjs-core.min.js': ('core', '11.0.1')}
+        
+        :param List[str] paths: Absolute paths to the files to search
+        :param regex: A ``str`` regex (compiled or not) to search for. It's matched against the raw UTF-8 bytes.
+        :param int scan_size: Bytes to scan at the start of each file (default: :py:attr:`.banner_scan_size`)
+        :return dict banners: Maps each path to the match's groups (decoded to ``str``), or ``None`` if not found
+        """
+        regex = _bytes_regex(regex)
+        scan_size = cls.banner_scan_size if scan_size is None else scan_size
+        banners = {}
+        for p in paths:
+            with open(p, 'rb') as fp:
+                banners[p] = _match_groups(regex.search(fp.read(scan_size)))
+                # If we read less than scan_size, we've already searched the whole file (and empty files can't be mmap'd)
+                if banners[p] is None and fp.tell() == scan_size:
+                    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        # The match has to be decoded before the mmap is closed
+                        banners[p] = _match_groups(regex.search(mm))
+        return banners
+    
+    @classmethod
+    def find_banner(cls, path: str, regex: Union[str, Pattern], scan_size: int = None) -> Optional[tuple]:
+        """Search the single file ``path`` for a version banner - see :py:meth:`.find_banners`"""
+        return cls.find_banners([path], regex, scan_size=scan_size)[path]
+    
     def download(self) -> str:
         dl = self.downloader
-        return dl.download(out_dir=self.temp_dir) if not dl.downloaded else dl.folder
+        if dl.downloaded:
+            return dl.folder
+        if self.log_file is not None:
+            # Start each build with an empty log file
+            open(self.log_file, 'w').close()
+        with self.metrics.stage('download'):
+            return dl.download(out_dir=self.temp_dir)
     
     @abstractmethod
     def identify(self, folder: str, package: str = None) -> LibIdent:
@@ -219,28 +362,68 @@ class BaseLib(ABC, LibBuilderHelper):
         """
         pass
 
-    def build(self) -> List[FileOutput]:
-        # Download the repo
-        log.info('Downloading repo...')
-        dest = self.download()
+    def run_builder(self, dest: str) -> str:
+        """
+        Initialise the builder for this library with the downloaded source code folder ``dest``, then build it.
+        
+        :param str dest: The folder containing the downloaded source code (see :py:meth:`.download`)
+        :return str dest: The folder containing the built library, to be passed to :py:meth:`.outputs`
+        """
         log.info('Initialising builder...')
         # Initialise the builder with the repo download folder
         builder = self.get_builder(build_folder=dest)
+        builder.metrics = self.metrics
+        if isinstance(builder, CommandHelper):
+            builder.log_file = self.log_file
         # Trigger the build in the repo
         log.info('Triggering build...')
-        dest = builder.build()
-        log.info('Scanning versions')
-        # Generate the list of files to save
-        versions = []
-        
-        if self.include_main:
-            versions += [self.identify(dest)]
+        with self.metrics.stage('build'):
+            return builder.build()
+    
+    def iter_outputs(self, dest: str) -> Iterator[FileOutput]:
+        """
+        Identify the main package and/or each sub-package inside of the built folder ``dest``, yielding each of their
+        files as soon as they're known.
         
-        if self.include_sub:
-            versions += [self.identify(dest, package=pkg) for pkg in self.subpackages]
+        The :py:meth:`.identify` calls run concurrently in a thread pool (up to ``IDENTIFY_JOBS`` at once), and the
+        files of each (sub-)package are yielded in the order they finish - so they can be published while the other
+        sub-packages are still being identified.
+        """
+        log.info('Scanning versions')
+        packages = ([None] if self.include_main else []) + (list(self.subpackages) if self.include_sub else [])
+        if len(packages) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(settings.IDENTIFY_JOBS, len(packages)))) as pool:
+            futures = [pool.submit(self._timed_identify, dest, pkg) for pkg in packages]
+            for fut in as_completed(futures):
+                pkg, ver, files = fut.result()
+                for f in files:
+                    yield FileOutput(src=f, package=pkg, version=ver, link_root=True)
+    
+    def _timed_identify(self, dest: str, package: str = None) -> LibIdent:
+        with self.metrics.stage('identify'):
+            return self.identify(dest) if package is None else self.identify(dest, package=package)
+    
+    def outputs(self, dest: str) -> List[FileOutput]:
+        """Identify the main package and/or each sub-package inside of the built folder ``dest``, and list their files"""
+        return list(self.iter_outputs(dest))
+    
+    def iter_build(self) -> Iterator[FileOutput]:
+        """
+        Download and build the library, then yield each file which should be published as soon as it's identified.
         
-        result = []
-        for pkg, ver, files in versions:
-            for f in files:
-                result.append(FileOutput(src=f, package=pkg, version=ver, link_root=True))
-        return result
+        This runs each stage one after the other: :py:meth:`.download` -> :py:meth:`.run_builder` ->
+        :py:meth:`.iter_outputs`. The stages can also be called individually, e.g. by :class:`.PipelineEngine`
+        """
+        # Download the repo
+        log.info('Downloading repo...')
+        dest = self.download()
+        dest = self.run_builder(dest)
+        yield from self.iter_outputs(dest)
+
+    def build(self) -> List[FileOutput]:
+        """
+        Download, build and identify the library - returning the list of files which should be published.
+        See :py:meth:`.iter_build` for a streaming version.
+        """
+        return list(self.iter_build())
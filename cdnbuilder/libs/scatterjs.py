@@ -34,16 +34,22 @@ class ScatterJSLib(BaseLib):
         """
         r = cls.vreg.findall(contents)
         if len(r) < 1:
-            p_err = ' for ScatterJS' if not package else f' for ScatterJS sub-package "{package}"'
-            raise VersionNotFound(f'{__name__} - could not find version{p_err}')
+            raise cls._not_found(package)
         return r[0]
     
+    @staticmethod
+    def _not_found(package: str = None) -> VersionNotFound:
+        p_err = ' for ScatterJS' if not package else f' for ScatterJS sub-package "{package}"'
+        return VersionNotFound(f'{__name__} - could not find version{p_err}')
+    
     def identify(self, folder: str, package: str = None) -> LibIdent:
         f_loc = join(folder, self.output_folder, f"scatterjs-{package}.min.js")
-        with open(f_loc, 'r') as fp:
-            data = fp.read()
-            pkg, ver = self._get_version(contents=data, package=package)
-            return pkg, ver, [f_loc]
+        # The version banner is at the top of the bundle, so there's no need to read the entire file
+        r = self.find_banner(f_loc, self.vreg)
+        if r is None:
+            raise self._not_found(package)
+        pkg, ver = r
+        return pkg, ver, [f_loc]
 
 
 export = ScatterJSLib
@@ -0,0 +1,131 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import json
+import logging
+import time
+from hashlib import sha256
+from os import makedirs, replace
+from os.path import join, exists
+from typing import Optional, List
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.files import file_lock
+
+log = logging.getLogger(__name__)
+
+
+class BuildManifest:
+    """
+    A persistent record of the successful builds of a library, stored as JSON in
+    ``MANIFEST_FOLDER/<lib_name>.json``
+
+    Each build is recorded against a key generated from the library name, resolved commit hash, builder name and
+    builder args (see :py:meth:`cdnbuilder.libs.base.BaseLib.build_key`). If a build with the same key has already
+    been recorded - and all of the files it published are still present in ``OUT_FOLDER`` - there's no need to
+    download / install / build the library again.
+
+    Example:
+
+        >>> m = BuildManifest('eosjs')
+        >>> key = dict(lib='eosjs', commit='8a6c15ec...', builder='YarnBuilder', args={})
+        >>> m.is_built(key)
+        False
+        >>> m.record(key, files=['eosjs/20.0.1/eosjs-api.js'], lockfile='5f1e...')
+        >>> m.is_built(key)
+        True
+
+    """
+    def __init__(self, lib_name: str, folder: str = None):
+        self.lib_name = lib_name
+        self.folder = settings.MANIFEST_FOLDER if empty(folder) else folder
+        self.path = join(self.folder, f'{lib_name}.json')
+        self.lock_path = f'{self.path}.lock'
+
+    @staticmethod
+    def key_hash(key: dict) -> str:
+        """Generate a stable SHA-256 hash of a build key dictionary"""
+        return sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def load(self) -> dict:
+        """Load the manifest from disk. Returns an empty manifest if it doesn't exist yet."""
+        if not exists(self.path):
+            return dict(last=None, builds={})
+        with open(self.path) as fp:
+            return json.load(fp)
+
+    def find(self, key: dict) -> Optional[dict]:
+        """Return the recorded build for ``key``, or ``None`` if it's never been successfully built"""
+        return self.load()['builds'].get(self.key_hash(key))
+
+    @property
+    def last(self) -> Optional[dict]:
+        """The most recent successful build recorded in this manifest (or ``None``)"""
+        m = self.load()
+        return None if empty(m['last']) else m['builds'].get(m['last'])
+
+    def is_built(self, key: dict) -> bool:
+        """
+        Returns ``True`` if a build matching ``key`` was previously recorded, and every file it published still
+        exists in ``OUT_FOLDER`` (if someone deleted the output, we'd need to build it again)
+        """
+        build = self.find(key)
+        if build is None:
+            return False
+        return all(exists(join(settings.OUT_FOLDER, f)) for f in build['files'])
+
+    def record(self, key: dict, files: List[str], set_last=True, **extra):
+        """
+        Record a successful build of ``key`` into the manifest, and mark it as the most recent build.
+
+        :param dict key: The build key (see :py:meth:`cdnbuilder.libs.base.BaseLib.build_key`)
+        :param List[str] files: Paths of each file published by the build, relative to ``OUT_FOLDER``
+        :param bool set_last: (Default: ``True``) Mark this as the most recent build. Backfills of old versions
+                              pass ``False``, so :py:attr:`.last` still refers to the latest upstream build.
+        :param extra: Any extra info to store with the build, e.g. ``lockfile='5f1e...'``
+        """
+        makedirs(self.folder, exist_ok=True)
+        h = self.key_hash(key)
+        with file_lock(self.lock_path):
+            m = self.load()
+            m['builds'][h] = dict(**key, **extra, files=list(files), built_at=int(time.time()))
+            if set_last or empty(m['last']):
+                m['last'] = h
+            # Write to a temporary file and then rename it, so a crash mid-write can't corrupt the manifest
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump(m, fp, indent=2, default=str)
+            replace(tmp_path, self.path)
@@ -0,0 +1,189 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from os import makedirs
+from os.path import dirname
+from typing import List, Optional
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+
+log = logging.getLogger(__name__)
+
+
+class BuildMetrics:
+    """
+    Stage timings and counters collected while building a single library.
+
+    Each library instance has it's own :py:attr:`.BaseLib.metrics`, which the library, it's builder and
+    :func:`.publish_lib` record into. Time spent in a stage which runs more than once (e.g. ``identify`` for
+    each sub-package, which may run concurrently) is added together.
+
+    Example:
+
+        >>> m = BuildMetrics('eosjs')
+        >>> with m.stage('download'):
+        ...     lib.download()
+        >>> m.incr('bytes_published', 39718)
+        >>> m.finish('built')
+        >>> m.to_dict()
+        {'lib': 'eosjs', 'status': 'built', 'duration': 12.81, 'stages': {'download': 2.53}, 'counters': {...}}
+
+    """
+    def __init__(self, lib_name: str):
+        self.lib_name = lib_name
+        self.status = None      # type: Optional[str]
+        self.stages = {}
+        self.counters = {}
+        self.started_at = time.time()
+        self.duration = None    # type: Optional[float]
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager which adds the time spent inside of it to the stage ``name``"""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def peak(self, name: str, value):
+        """Set the counter ``name`` to ``value`` if it's higher than the current value (e.g. peak memory usage)"""
+        with self._lock:
+            self.counters[name] = max(self.counters.get(name, value), value)
+
+    def finish(self, status: str):
+        """Mark the build as finished with ``status`` (``built``, ``skipped`` or ``failed``)"""
+        self.status = status
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        return dict(
+            lib=self.lib_name, status=self.status, started_at=self.started_at, duration=self.duration,
+            stages={k: round(v, 4) for k, v in self.stages.items()}, counters=dict(self.counters)
+        )
+
+
+def _write_atomic(out_path: str, data: str):
+    makedirs(dirname(out_path) or '.', exist_ok=True)
+    tmp_path = f'{out_path}.tmp'
+    with open(tmp_path, 'w') as fp:
+        fp.write(data)
+    os.replace(tmp_path, out_path)
+
+
+def _prom_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(builds: List[dict], finished_at: float = None) -> str:
+    """
+    Render the build metrics dicts ``builds`` (see :py:meth:`.BuildMetrics.to_dict`) in the Prometheus text format,
+    for node_exporter's textfile collector.
+    """
+    finished_at = time.time() if finished_at is None else finished_at
+    metrics = [
+        ('cdnbuilder_stage_duration_seconds', 'Seconds spent in each stage of the last build of a library'),
+        ('cdnbuilder_build_duration_seconds', 'Total seconds taken by the last build of a library'),
+        ('cdnbuilder_build_success', 'Whether the last build of a library succeeded (1) or failed (0)'),
+        ('cdnbuilder_build_skipped', 'Whether the last build of a library was skipped as it was up to date'),
+        ('cdnbuilder_published_bytes', 'Bytes published by the last build of a library'),
+        ('cdnbuilder_published_files', 'Files published by the last build of a library'),
+        ('cdnbuilder_peak_rss_bytes', 'Peak memory used by a single build command of the last build of a library'),
+    ]
+    samples = {name: [] for name, _ in metrics}
+    for b in builds:
+        lib = _prom_label(b['lib'])
+        for stage, secs in b['stages'].items():
+            samples['cdnbuilder_stage_duration_seconds'].append(f'{{lib="{lib}",stage="{_prom_label(stage)}"}} {secs}')
+        samples['cdnbuilder_build_duration_seconds'].append(f'{{lib="{lib}"}} {b["duration"] or 0}')
+        samples['cdnbuilder_build_success'].append(f'{{lib="{lib}"}} {0 if b["status"] == "failed" else 1}')
+        samples['cdnbuilder_build_skipped'].append(f'{{lib="{lib}"}} {1 if b["status"] == "skipped" else 0}')
+        samples['cdnbuilder_published_bytes'].append(f'{{lib="{lib}"}} {b["counters"].get("bytes_published", 0)}')
+        samples['cdnbuilder_published_files'].append(f'{{lib="{lib}"}} {b["counters"].get("files_published", 0)}')
+        if 'peak_rss_bytes' in b['counters']:
+            samples['cdnbuilder_peak_rss_bytes'].append(f'{{lib="{lib}"}} {b["counters"]["peak_rss_bytes"]}')
+    
+    lines = []
+    for name, desc in metrics:
+        lines += [f'# HELP {name} {desc}', f'# TYPE {name} gauge']
+        lines += [f'{name}{s}' for s in samples[name]]
+    lines += [
+        '# HELP cdnbuilder_last_run_timestamp_seconds Unix time that the last build run finished',
+        '# TYPE cdnbuilder_last_run_timestamp_seconds gauge',
+        f'cdnbuilder_last_run_timestamp_seconds {finished_at}',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def write_reports(builds: List[BuildMetrics], started_at: float = None):
+    """
+    Write the metrics of each library built during this run to the JSON run report (``METRICS_REPORT``) and the
+    Prometheus textfile (``METRICS_PROM_FILE``), if they're enabled.
+    
+    :param List[BuildMetrics] builds: The metrics of each library build in this run
+    :param float started_at: Unix time that the run started (default: the start of the earliest build)
+    """
+    builds = [b.to_dict() if isinstance(b, BuildMetrics) else b for b in builds]
+    finished_at = time.time()
+    if started_at is None:
+        started_at = min([b['started_at'] for b in builds], default=finished_at)
+    try:
+        if not empty(settings.METRICS_REPORT):
+            report = dict(started_at=started_at, finished_at=finished_at, duration=finished_at - started_at, builds=builds)
+            _write_atomic(settings.METRICS_REPORT, json.dumps(report, indent=2))
+            log.info('Wrote build report to "%s"', settings.METRICS_REPORT)
+        if not empty(settings.METRICS_PROM_FILE):
+            _write_atomic(settings.METRICS_PROM_FILE, prometheus_text(builds, finished_at))
+            log.debug('Wrote Prometheus metrics to "%s"', settings.METRICS_PROM_FILE)
+    except OSError:
+        # Failing to write the metrics shouldn't fail the whole run
+        log.exception('Failed to write build metrics')
@@ -0,0 +1,143 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.build import is_up_to_date, record_build
+from cdnbuilder.core import load_lib, bind_loop
+from cdnbuilder.metrics import BuildMetrics, write_reports
+from cdnbuilder.publish import publish_lib
+
+log = logging.getLogger(__name__)
+
+
+class PipelineEngine:
+    """
+    An asyncio based build engine, which splits each library build into pipeline stages, with a separate
+    concurrency limit for each stage:
+
+     * **fetch** - check if the library is up to date, and download it (network bound, so lots can run at once)
+     * **build** - install dependencies and build the library (CPU / memory heavy, so only a few at once)
+     * **publish** - identify the built files and copy them into the output folder (disk bound)
+
+    As each library moves through the stages independently, the stages overlap - e.g. library N+1 can be cloning
+    while library N is running yarn, and library N-1 is being published.
+
+    The stages themselves are the normal :class:`.BaseLib` methods (so existing libraries work unchanged), ran in
+    worker threads. Each worker thread has the engine's event loop bound to it (see :func:`.bind_loop`), so every
+    git / yarn command they run is executed on the event loop via ``asyncio.create_subprocess_exec``.
+
+    Example:
+
+        >>> engine = PipelineEngine(fetch_jobs=8, build_jobs=2, publish_jobs=2)
+        >>> engine.run(['eosjs', 'scatterjs'])
+        {'eosjs': True, 'scatterjs': True}
+
+    """
+    def __init__(self, fetch_jobs: int = None, build_jobs: int = None, publish_jobs: int = None, force=False):
+        self.fetch_jobs = settings.PIPELINE_FETCH_JOBS if empty(fetch_jobs) else int(fetch_jobs)
+        self.build_jobs = settings.PIPELINE_BUILD_JOBS if empty(build_jobs) else int(build_jobs)
+        self.publish_jobs = settings.PIPELINE_PUBLISH_JOBS if empty(publish_jobs) else int(publish_jobs)
+        self.force = force
+        self.loop = None     # type: asyncio.AbstractEventLoop
+        self.executor = None  # type: ThreadPoolExecutor
+        self.metrics = {}     # type: Dict[str, BuildMetrics]
+
+    async def _in_thread(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def _build_one(self, name: str, fetch: asyncio.Semaphore, build: asyncio.Semaphore,
+                         publish: asyncio.Semaphore) -> bool:
+        metrics = self.metrics[name] = BuildMetrics(name)
+        try:
+            async with fetch:
+                lib = await self._in_thread(lambda: load_lib(name)())
+                lib.metrics = metrics
+                with metrics.stage('check'):
+                    up_to_date = not self.force and await self._in_thread(is_up_to_date, lib)
+                if up_to_date:
+                    metrics.finish('skipped')
+                    return True
+                log.info('[%s] Downloading...', name)
+                dest = await self._in_thread(lib.download)
+            async with build:
+                log.info('[%s] Building...', name)
+                dest = await self._in_thread(lib.run_builder, dest)
+            async with publish:
+                log.info('[%s] Publishing...', name)
+                published = await self._in_thread(lambda: publish_lib(lib, lib.iter_outputs(dest), self.force))
+                with metrics.stage('record'):
+                    await self._in_thread(record_build, lib, published)
+            metrics.finish('built')
+            return True
+        except Exception:
+            log.exception('Unexpected error while building library "%s"...', name)
+            metrics.finish('failed')
+            return False
+
+    async def run_async(self, libs: List[str]) -> Dict[str, bool]:
+        """Build each library in ``libs`` through the pipeline. Must be called from within :py:attr:`.loop`"""
+        fetch = asyncio.Semaphore(self.fetch_jobs)
+        build = asyncio.Semaphore(self.build_jobs)
+        publish = asyncio.Semaphore(self.publish_jobs)
+        res = await asyncio.gather(*[self._build_one(l, fetch, build, publish) for l in libs])
+        return dict(zip(libs, res))
+
+    def run(self, libs: List[str]) -> Dict[str, bool]:
+        """
+        Build each library in ``libs`` through the pipeline, using a new event loop.
+
+        :param List[str] libs: A list of library module names to build, e.g. ``['eosjs', 'scatterjs']``
+        :return dict results: A dict mapping each library name to ``True`` (built OK / up to date) or ``False``
+        """
+        self.loop = asyncio.new_event_loop()
+        # Enough threads for every stage to be running at it's limit at the same time
+        workers = self.fetch_jobs + self.build_jobs + self.publish_jobs
+        self.executor = ThreadPoolExecutor(max_workers=workers, initializer=bind_loop, initargs=(self.loop,))
+        try:
+            results = self.loop.run_until_complete(self.run_async(libs))
+        finally:
+            self.executor.shutdown(wait=True)
+            self.loop.close()
+        write_reports(list(self.metrics.values()))
+        failed = [l for l, ok in results.items() if not ok]
+        if len(failed) > 0:
+            log.error('%d of %d libraries failed to build: %s', len(failed), len(libs), ', '.join(failed))
+        return results
@@ -0,0 +1,354 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import base64
+import hashlib
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from os import path, makedirs
+from tempfile import mkdtemp
+from typing import Dict, Iterable, List
+
+from cdnbuilder import settings
+from cdnbuilder.compress import compress_files, available_formats, should_compress, variant_path, \
+    StreamCompressor, CHUNK_SIZE
+from cdnbuilder.core import version_key
+from cdnbuilder.files import transfer_file, exchange_paths, replace_symlink, file_lock
+from cdnbuilder.index import OutputIndex
+from cdnbuilder.libs.base import BaseLib, FileOutput
+from cdnbuilder.store import BlobStore
+
+log = logging.getLogger(__name__)
+
+STAGING_PREFIX = '.staging-'
+"""Prefix of the temporary folders which versions are staged in, inside of ``STAGING_FOLDER``"""
+
+LATEST = 'latest'
+"""Name of the symlink inside of each (sub-)package folder, which points to the newest version folder"""
+
+LATEST_LOCK = 'latest.lock'
+"""Lock file (inside of ``LOCK_FOLDER``) held while updating ``latest`` symlinks, so parallel builds can't regress it"""
+
+
+def publish_lib(lib: BaseLib, files: Iterable[FileOutput], force=False) -> List[str]:
+    """
+    Publish each of the built ``files`` for ``lib`` into the versioned folder structure within ``OUT_FOLDER``
+    
+    Each version folder (e.g. ``eosjs/20.0.1`` or ``scatter-js/core/1.5.28``) is fully staged in a temporary folder
+    (including it's compressed variants), then moved into place with a single atomic rename - so readers never see
+    a half published version. Version folders which already exist are left alone, unless ``force`` is True.
+    
+    ``files`` can be a generator (e.g. :py:meth:`.BaseLib.iter_build`) - each file is copied into the staging folder
+    as soon as it's yielded, while the library is still identifying the rest of it's files.
+    
+    With ``STREAM_PUBLISH`` enabled, each file is read only once - it's copied, hashed (for the blob store and the
+    index) and compressed in a single pass by :func:`.stream_publish`, in a pool of ``COMPRESS_JOBS`` threads.
+    
+    The published versions are then added to the library's :class:`.OutputIndex` (if ``OUTPUT_INDEX`` is enabled).
+    
+    If :py:attr:`.BaseLib.link_root` is enabled, each (sub-)package folder contains a ``latest`` symlink pointing to
+    it's newest version folder, and the library's root folder contains aliases pointing through it, e.g.::
+    
+        eosjs/latest -> 20.0.1
+        eosjs/eosjs-api.js -> latest/eosjs-api.js
+        scatter-js/core/latest -> 1.5.28
+        scatter-js/scatterjs-core.min.js -> core/latest/scatterjs-core.min.js
+    
+    Switching to a new version only requires atomically replacing the ``latest`` symlink, no matter how many files
+    the version contains.
+    
+    :param BaseLib lib: The library instance the files were built by
+    :param Iterable[FileOutput] files: The files to publish, e.g. from :py:meth:`.BaseLib.build` / ``iter_build``
+    :param bool force: Replace any version folders which already exist
+    :return List[str] published: The path of each file in the output folder, relative to ``OUT_FOLDER``
+    """
+    published, metrics = [], lib.metrics
+    store = BlobStore() if settings.DEDUPE_OUTPUT else None
+    index = OutputIndex(lib.lib_name) if settings.OUTPUT_INDEX else None
+    lib_folder = path.join(settings.OUT_FOLDER, lib.lib_name)
+    makedirs(lib_folder, exist_ok=True)
+    # The staging folder is on the same filesystem as the final location, but outside of OUT_FOLDER so it's never served
+    # It's prefixed with our PID, so 'gc' can tell if it was left behind by a crashed build
+    makedirs(settings.STAGING_FOLDER, exist_ok=True)
+    staging = mkdtemp(prefix=f'{STAGING_PREFIX}{os.getpid()}-', dir=settings.STAGING_FOLDER)
+    try:
+        # Map each version folder (relative to lib_folder) to the files which belong in it
+        versions = {}  # type: Dict[str, List[FileOutput]]
+        staged, skipped, stage_files = [], [], []
+        # With STREAM_PUBLISH, each file is read once - copied, hashed and compressed in one pass - by a thread pool
+        streaming = settings.STREAM_PUBLISH
+        formats = available_formats() if settings.COMPRESS else []
+        pool = ThreadPoolExecutor(max_workers=max(1, settings.COMPRESS_JOBS)) if streaming else None
+        streams, infos = {}, {}
+        
+        def _stream(src: str, stage_file: str):
+            with metrics.stage('copy'):
+                return stream_publish(src, stage_file, store, formats if should_compress(stage_file) else [])
+        
+        try:
+            for f in files:
+                ver_dir = path.join(f.package or '', f.version)
+                if ver_dir not in versions:
+                    # First file of this version - check if the version is already published
+                    if path.exists(path.join(lib_folder, ver_dir)) and not force:
+                        log.warning('The version folder "%s" already exists. Skipping.', path.join(lib_folder, ver_dir))
+                        skipped.append(ver_dir)
+                    else:
+                        staged.append(ver_dir)
+                versions.setdefault(ver_dir, []).append(f)
+                if ver_dir in skipped:
+                    continue
+                stage_file = path.join(staging, f.pkg_folder, f.filename)
+                makedirs(path.dirname(stage_file), exist_ok=True)
+                if streaming:
+                    # A later file with the same path replaces the earlier one - so it mustn't be written concurrently
+                    if stage_file in streams:
+                        streams[stage_file].result()
+                    streams[stage_file] = pool.submit(_stream, f.src, stage_file)
+                    continue
+                with metrics.stage('copy'):
+                    _publish_file(f.src, stage_file, store)
+                stage_files.append(stage_file)
+                metrics.incr('files_published')
+                metrics.incr('bytes_published', path.getsize(stage_file))
+            
+            for stage_file, fut in streams.items():
+                info = fut.result()
+                infos[path.relpath(stage_file, staging)] = info
+                metrics.incr('files_published')
+                metrics.incr('bytes_published', info['size'])
+                for v in info['variants'].values():
+                    metrics.incr('compressed_files')
+                    metrics.incr('compressed_bytes', v['size'])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        
+        to_index = []
+        for ver_dir in skipped:
+            published += [path.relpath(p, settings.OUT_FOLDER) for p in _list_files(path.join(lib_folder, ver_dir))]
+            # Versions published before the index existed still need to be added to it
+            ver_files = versions[ver_dir]
+            if index is not None and not index.has_version(ver_files[0].package, ver_files[0].version):
+                to_index += ver_files
+        
+        if settings.COMPRESS and len(stage_files) > 0:
+            # Generate precompressed variants in parallel, then publish them like any other file. Every staged file is
+            # new, so there aren't any up to date variants to skip - force avoids checking for them.
+            with metrics.stage('compress'):
+                for v in compress_files(stage_files, force=True):
+                    if store is not None:
+                        _publish_file(v, v, store)
+                    metrics.incr('compressed_files')
+                    metrics.incr('compressed_bytes', path.getsize(v))
+        
+        # Now that every version is fully staged, move each one into place
+        for ver_dir in staged:
+            final_dir = path.join(lib_folder, ver_dir)
+            with metrics.stage('move'):
+                _move_into_place(path.join(staging, ver_dir), final_dir)
+            published += [path.relpath(p, settings.OUT_FOLDER) for p in _list_files(final_dir)]
+            to_index += versions[ver_dir]
+        
+        if index is not None:
+            with metrics.stage('index'):
+                index.update(to_index, {path.join(lib.lib_name, k): v for k, v in infos.items()})
+        
+        if lib.link_root:
+            makedirs(settings.LOCK_FOLDER, exist_ok=True)
+            with metrics.stage('symlink'), file_lock(path.join(settings.LOCK_FOLDER, LATEST_LOCK)):
+                for ver_dir, ver_files in versions.items():
+                    update_latest(lib_folder, ver_files)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return published
+
+
+def _list_files(folder: str) -> List[str]:
+    return [path.join(root, f) for root, _, fs in os.walk(folder) for f in sorted(fs)]
+
+
+def _publish_file(src: str, out_file: str, store: BlobStore = None):
+    """Publish ``src`` to ``out_file``, via the blob store if ``store`` is set"""
+    if store is not None:
+        digest, mode = store.publish(src, out_file, mode=settings.PUBLISH_MODE)
+        log.info('Published "%s" to "%s" (blob: %s, mode: %s)', src, out_file, digest[:12], mode)
+    else:
+        mode = transfer_file(src, out_file, mode=settings.PUBLISH_MODE)
+        log.info('Published "%s" to "%s" (mode: %s)', src, out_file, mode)
+
+
+def stream_publish(src: str, out_file: str, store: BlobStore = None, formats: List[str] = None) -> dict:
+    """
+    Publish ``src`` to ``out_file`` (via the blob store if ``store`` is set), along with it's compressed ``formats``
+    variants - reading ``src`` only once. Each chunk is written to ``out_file``, fed into the SHA-256 / SHA-384
+    hashes, and fed into a :class:`.StreamCompressor` per format, whose output is hashed as it's written. So the
+    number of reads per published byte doesn't grow with the number of hashes and variants.
+
+    Unlike :func:`.transfer_file`, the data is always copied - ``PUBLISH_MODE`` isn't used.
+
+    Example:
+
+        >>> stream_publish('/tmp/eosjs123/dist-web/eosjs-api.js', '/opt/cdn-staging/.staging-1-x/20.0.1/eosjs-api.js',
+        ...                formats=['gz', 'br'])
+        {'size': 39718, 'mtime': 1571304480, 'sha256': '5f1e...', 'sri': 'sha384-oqVuAfXR...',
+         'variants': {'gz': {'size': 9817, 'sha256': '0c3d...'}, 'br': {'size': 8412, 'sha256': 'a41b...'}}}
+
+    :param str src: The file to publish
+    :param str out_file: Where to write it - the variants are written next to it (e.g. ``eosjs-api.js.gz``)
+    :param BlobStore store: (Optional) Store the file and it's variants in this blob store
+    :param List[str] formats: The compressed variants to generate (default: none)
+    :return dict info: The file's details, in the same format as :func:`.file_info`, plus the ``size`` and
+                       ``sha256`` of each variant in ``variants``
+    """
+    formats = [] if formats is None else formats
+    hashes = dict(sha256=hashlib.sha256(), sha384=hashlib.sha384())
+    compressors = {fmt: StreamCompressor(fmt, size=path.getsize(src)) for fmt in formats}
+    v_hashes = {fmt: hashlib.sha256() for fmt in formats}
+    v_sizes = {fmt: 0 for fmt in formats}
+    v_files, size = {}, 0
+    
+    def _write_variant(fmt: str, data: bytes):
+        if len(data) > 0:
+            v_files[fmt].write(data)
+            v_hashes[fmt].update(data)
+            v_sizes[fmt] += len(data)
+    
+    try:
+        with open(src, 'rb') as fp, open(out_file, 'wb') as out:
+            for fmt in formats:
+                v_files[fmt] = open(variant_path(out_file, fmt), 'wb')
+            while True:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+                size += len(chunk)
+                for h in hashes.values():
+                    h.update(chunk)
+                for fmt, c in compressors.items():
+                    _write_variant(fmt, c.compress(chunk))
+            for fmt, c in compressors.items():
+                _write_variant(fmt, c.flush())
+    finally:
+        for v_fp in v_files.values():
+            v_fp.close()
+    shutil.copymode(src, out_file)
+    
+    digest = hashes['sha256'].hexdigest()
+    if store is not None:
+        # out_file is a new file which nothing else uses - so it can become the blob itself
+        store.publish(out_file, out_file, mode='auto', digest=digest)
+    st = os.stat(out_file)
+    info = dict(
+        size=size, mtime=int(st.st_mtime), sha256=digest,
+        sri='sha384-' + base64.b64encode(hashes['sha384'].digest()).decode(), variants={}
+    )
+    for fmt in formats:
+        v, v_digest = variant_path(out_file, fmt), v_hashes[fmt].hexdigest()
+        # Match the source file's modification time, like compress_file
+        os.utime(v, (st.st_atime, st.st_mtime))
+        if store is not None:
+            store.publish(v, v, mode='auto', digest=v_digest)
+        info['variants'][fmt] = dict(size=v_sizes[fmt], sha256=v_digest)
+    log.info('Published "%s" to "%s" (sha256: %s, variants: %s)', src, out_file, digest[:12], ', '.join(formats) or '-')
+    return info
+
+
+def _move_into_place(staged_dir: str, final_dir: str):
+    """Atomically move the fully staged version folder ``staged_dir`` to ``final_dir``, replacing it if it exists"""
+    if not path.exists(final_dir):
+        makedirs(path.dirname(final_dir), exist_ok=True)
+        os.rename(staged_dir, final_dir)
+        log.info('Moved staged version "%s" into place', final_dir)
+        return
+    try:
+        # Swap the old and new versions in a single atomic operation, then remove the old version
+        exchange_paths(staged_dir, final_dir)
+    except OSError as e:
+        # Without renameat2, there's a very brief window between the two renames where final_dir doesn't exist
+        log.debug('Atomic exchange not supported for "%s" (%s) - falling back to rename', final_dir, e)
+        old_dir = f'{staged_dir}.old'
+        os.rename(final_dir, old_dir)
+        os.rename(staged_dir, final_dir)
+        staged_dir = old_dir
+    shutil.rmtree(staged_dir)
+    log.info('Replaced existing version "%s" with the newly staged version', final_dir)
+
+
+def update_latest(lib_folder: str, ver_files: List[FileOutput]):
+    """
+    Point the ``latest`` symlink of the (sub-)package which ``ver_files`` belong to at their version folder - unless
+    ``latest`` already points to a newer version - and make sure the library root has an alias for each file.
+    
+    When ``latest`` moves to a version which doesn't have some of the files the previous version had, the root
+    aliases of those files are removed, rather than being left dangling.
+    """
+    if len(ver_files) == 0:
+        return
+    package, version = ver_files[0].package, ver_files[0].version
+    pkg_root = path.join(lib_folder, package or '')
+    latest = path.join(pkg_root, LATEST)
+    current = os.readlink(latest) if path.islink(latest) else None
+    
+    if current is None or not path.exists(latest) or version_key(version) >= version_key(current):
+        if replace_symlink(version, latest):
+            log.info('Pointed "%s" to version %s (was: %s)', latest, version, current)
+            _prune_aliases(lib_folder, path.join(package or '', LATEST))
+    
+    for f in ver_files:
+        if not f.link_root:
+            continue
+        names = [f.filename] + [f'{f.filename}.{fmt}' for fmt in settings.COMPRESS_FORMATS]
+        for name in names:
+            if not path.exists(path.join(pkg_root, version, f.dest_folder or '', name)):
+                continue
+            # Aliases are relative, so the output folder can be moved / synced elsewhere
+            target = path.join(package or '', LATEST, f.dest_folder or '', name)
+            if replace_symlink(target, path.join(lib_folder, name)):
+                log.info('Created alias "%s" -> "%s"', path.join(lib_folder, name), target)
+
+
+def _prune_aliases(lib_folder: str, latest: str):
+    """Remove the aliases in ``lib_folder`` which point through ``latest`` (e.g. ``core/latest``) to a missing file"""
+    for name in os.listdir(lib_folder):
+        alias = path.join(lib_folder, name)
+        if not path.islink(alias) or path.exists(alias):
+            continue
+        target = os.readlink(alias)
+        if target.startswith(latest + os.sep):
+            os.remove(alias)
+            log.info('Removed alias "%s" -> "%s", as the latest version doesn\'t contain it', alias, target)
@@ -0,0 +1,358 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import ast
+import json
+import logging
+import os
+import sys
+import threading
+from importlib import import_module
+from importlib.util import find_spec
+from os import makedirs
+from os.path import join, dirname, abspath, exists, splitext
+from typing import Dict, List, Optional
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+
+log = logging.getLogger(__name__)
+
+MOD_DIR = dirname(abspath(__file__))
+
+KINDS = dict(libs='cdnbuilder.libs', builders='cdnbuilder.builders')
+"""Each kind of plugin, mapped to the package containing the built-in modules (and the entry point group name)"""
+
+LIB_ATTRS = [
+    'lib_name', 'url', 'builder', 'args', 'subpackages', 'output_folder', 'ref', 'clone_mode', 'link_root',
+    'include_main', 'include_sub', 'keep_versions', 'pinned_versions', 'build_cpus', 'build_memory',
+]
+"""Static attributes of :class:`.BaseLib` classes which are extracted (without importing them) into the registry"""
+
+CACHE_VERSION = 2
+
+
+def _literal_attrs(cls_node: ast.ClassDef) -> Dict[str, object]:
+    """Extract each class attribute of ``cls_node`` which is assigned a plain literal value (str, list, dict etc.)"""
+    attrs = {}
+    for node in cls_node.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name, value = node.targets[0].id, node.value
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name) and node.value is not None:
+            name, value = node.target.id, node.value
+        else:
+            continue
+        try:
+            if isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and value.func.id == 'dict' \
+                    and len(value.args) == 0 and all(kw.arg is not None for kw in value.keywords):
+                # e.g. args = dict(yarn_args=['run', 'build'])
+                attrs[name] = {kw.arg: ast.literal_eval(kw.value) for kw in value.keywords}
+            else:
+                attrs[name] = ast.literal_eval(value)
+        except ValueError:
+            # Not a literal (e.g. re.compile(...)) - not static metadata
+            continue
+    return attrs
+
+
+def parse_module(path: str, attr: str = 'export') -> Optional[dict]:
+    """
+    Extract the static metadata of the class exported by the plugin module ``path`` (e.g. ``export = EosJSLib``)
+    by parsing it's source code, *without* importing it.
+    
+    Attributes inherited from other classes in the same module are included. Returns ``None`` if the exported
+    class can't be found statically (e.g. it's created dynamically, or imported from another module).
+    
+        >>> parse_module('cdnbuilder/libs/eosjs.py')
+        {'class': 'EosJSLib', 'lib_name': 'eosjs', 'url': 'https://github.com/EOSIO/eosjs.git', 'builder': ...}
+    
+    """
+    with open(path, 'rb') as fp:
+        tree = ast.parse(fp.read(), filename=path)
+    classes = {n.name: n for n in tree.body if isinstance(n, ast.ClassDef)}
+    exported = None
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == attr for t in node.targets) \
+                and isinstance(node.value, ast.Name):
+            exported = node.value.id
+    if exported is None or exported not in classes:
+        return None
+    
+    def collect(name: str, seen: set) -> dict:
+        attrs = {}
+        for base in classes[name].bases:
+            if isinstance(base, ast.Name) and base.id in classes and base.id not in seen:
+                attrs.update(collect(base.id, seen | {base.id}))
+        attrs.update(_literal_attrs(classes[name]))
+        return attrs
+    
+    meta = collect(exported, {exported})
+    meta['class'] = exported
+    doc = ast.get_docstring(classes[exported])
+    meta['description'] = None if empty(doc) else doc.strip().splitlines()[0]
+    return meta
+
+
+def _entry_points(group: str) -> Dict[str, str]:
+    """Returns the entry points of installed packages in ``group``, as a dict of ``name: 'module:attr'``"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # Python 3.7 doesn't have importlib.metadata
+        try:
+            import pkg_resources
+        except ImportError:
+            return {}
+        return {ep.name: f"{ep.module_name}:{'.'.join(ep.attrs) or 'export'}" for ep in pkg_resources.iter_entry_points(group)}
+    eps = entry_points()
+    eps = eps.select(group=group) if hasattr(eps, 'select') else eps.get(group, [])
+    return {ep.name: ep.value for ep in eps}
+
+
+def _path_stamp() -> List[list]:
+    """The mtime of each folder on ``sys.path`` - these change when packages (and their entry points) are installed"""
+    stamp = []
+    for p in sys.path:
+        try:
+            stamp.append([p, os.stat(p or '.').st_mtime])
+        except OSError:
+            continue
+    return stamp
+
+
+class Registry:
+    """
+    Discovers the available libraries and builders - both the built-in modules in ``cdnbuilder.libs`` /
+    ``cdnbuilder.builders``, and plugins registered by installed packages under the ``cdnbuilder.libs`` /
+    ``cdnbuilder.builders`` entry point groups, e.g. in a plugin's ``setup.py``::
+
+        entry_points={'cdnbuilder.libs': ['jquery = mycdnlibs.jquery']}
+
+    The static metadata of each library (``lib_name``, ``url``, ``builder``, ``subpackages`` etc.) is read by parsing
+    the module's source (see :func:`.parse_module`) rather than importing it, and is cached in ``REGISTRY_CACHE``.
+    Cached entries are only re-parsed when the module file's mtime / size change - so listing and planning hundreds
+    of libraries doesn't need to import any of them. The real module is only imported by :py:meth:`.load`.
+
+    Example:
+
+        >>> reg = Registry()
+        >>> reg.libs()['eosjs']['url']
+        'https://github.com/EOSIO/eosjs.git'
+        >>> reg.load('libs', 'eosjs')
+        <class 'cdnbuilder.libs.eosjs.EosJSLib'>
+
+    """
+    def __init__(self, cache_path: str = None):
+        self.cache_path = settings.REGISTRY_CACHE if cache_path is None else cache_path
+        self._cache = None    # type: Optional[dict]
+        self._dirty = False
+        self._found = {}      # type: Dict[str, Dict[str, str]]
+
+    def _load_cache(self) -> dict:
+        if self._cache is None:
+            self._cache = dict(version=CACHE_VERSION, plugins={}, entry_points=None)
+            if not empty(self.cache_path) and exists(self.cache_path):
+                try:
+                    with open(self.cache_path) as fp:
+                        cache = json.load(fp)
+                    if cache.get('version') == CACHE_VERSION:
+                        self._cache = cache
+                except (OSError, ValueError):
+                    log.warning('Registry cache "%s" is corrupt - rebuilding it', self.cache_path)
+        return self._cache
+
+    def _save_cache(self):
+        if not self._dirty or empty(self.cache_path):
+            return
+        try:
+            makedirs(dirname(self.cache_path), exist_ok=True)
+            tmp_path = f'{self.cache_path}.tmp{os.getpid()}-{threading.get_ident()}'
+            with open(tmp_path, 'w') as fp:
+                json.dump(self._cache, fp, indent=2, default=str)
+            os.replace(tmp_path, self.cache_path)
+            self._dirty = False
+        except OSError:
+            # The cache is only an optimisation - e.g. a read-only cache folder shouldn't stop builds
+            log.warning('Failed to write registry cache "%s"', self.cache_path, exc_info=True)
+
+    def _discover(self, kind: str, refresh=False) -> Dict[str, str]:
+        """
+        Find every module of ``kind``, returning a dict of ``name: 'module:attr'``. The modules are only discovered
+        once per registry (i.e. once per process, for :func:`.get_registry`), unless ``refresh`` is True.
+        """
+        if kind in self._found and not refresh:
+            return self._found[kind]
+        package = KINDS[kind]
+        found = {}
+        folder = join(MOD_DIR, kind)
+        for f in sorted(os.listdir(folder)):
+            name, ext = splitext(f)
+            if ext == '.py' and name not in ('__init__', 'base') and not name.startswith('_'):
+                found[name] = f'{package}.{name}:export'
+        
+        # Entry points are cached against the mtimes of sys.path, as looking them up reads the metadata of
+        # every installed package
+        cache = self._load_cache()
+        stamp = _path_stamp()
+        eps = cache.get('entry_points')
+        if eps is None or eps.get('stamp') != stamp:
+            eps = cache['entry_points'] = dict(stamp=stamp, groups={k: _entry_points(g) for k, g in KINDS.items()})
+            self._dirty = True
+        for name, target in eps['groups'].get(kind, {}).items():
+            if name in found:
+                log.warning('Plugin %s "%s" (%s) conflicts with a built-in module - ignoring it', kind, name, target)
+                continue
+            found[name] = target
+        self._found[kind] = found
+        return found
+
+    def _describe(self, kind: str, name: str, target: str) -> dict:
+        """Get the (cached) metadata for the plugin ``name`` of ``kind``, re-parsing it if it's file has changed"""
+        module, _, attr = target.partition(':')
+        attr = attr or 'export'
+        path = join(MOD_DIR, kind, f'{name}.py') if module == f'{KINDS[kind]}.{name}' else None
+        if path is None:
+            spec = find_spec(module)
+            path = None if spec is None else spec.origin
+        st = os.stat(path) if path is not None and exists(path) else None
+        stamp = None if st is None else [st.st_mtime, st.st_size]
+        
+        cache = self._load_cache()
+        key = f'{kind}:{name}'
+        entry = cache['plugins'].get(key)
+        if entry is not None and entry['target'] == target and stamp is not None and entry['stamp'] == stamp:
+            return entry
+        
+        meta = None
+        if stamp is not None and path.endswith('.py') and '.' not in attr:
+            try:
+                meta = parse_module(path, attr=attr)
+            except (SyntaxError, ValueError, OSError) as e:
+                log.warning('Failed to parse %s module "%s": %s', kind, path, e)
+        static = meta is not None and (kind != 'libs' or all(k in meta for k in ('lib_name', 'builder')))
+        if not static:
+            # The metadata couldn't be read statically, so we have to import the module (once per change to it)
+            log.debug('Importing %s "%s" to read it\'s metadata', kind, target)
+            cls = self._import(target)
+            meta = {k: getattr(cls, k, None) for k in LIB_ATTRS} if kind == 'libs' else {}
+            meta['class'] = cls.__name__
+            doc = (cls.__doc__ or '').strip()
+            meta['description'] = doc.splitlines()[0] if doc else None
+        
+        entry = dict(name=name, kind=kind, target=target, path=path, stamp=stamp, static=static, meta=meta)
+        cache['plugins'][key] = entry
+        self._dirty = True
+        return entry
+
+    def scan(self, kind: str) -> Dict[str, dict]:
+        """
+        Returns the metadata of every available plugin of ``kind`` (``libs`` or ``builders``), keyed by the name used
+        to load it (e.g. ``eosjs`` for ``cdnbuilder/libs/eosjs.py``)
+        """
+        found = self._discover(kind, refresh=True)
+        res = {}
+        for name, target in found.items():
+            try:
+                res[name] = self._describe(kind, name, target)
+            except Exception:
+                log.exception('Failed to load metadata for %s "%s" (%s)', kind, name, target)
+        # Forget plugins which no longer exist (modules loaded by their absolute name aren't discovered, so keep them)
+        cache = self._load_cache()
+        for key in list(cache['plugins'].keys()):
+            k, name = key.split(':', 1)
+            if k == kind and '.' not in name and name not in found:
+                del cache['plugins'][key]
+                self._dirty = True
+        self._save_cache()
+        return res
+
+    def libs(self) -> Dict[str, dict]:
+        """Metadata of every available library - see :py:meth:`.scan`"""
+        return {name: dict(entry['meta'], name=name, target=entry['target']) for name, entry in self.scan('libs').items()}
+
+    def builders(self) -> Dict[str, dict]:
+        """Metadata of every available builder - see :py:meth:`.scan`"""
+        return {
+            name: dict(entry['meta'], name=name, target=entry['target']) for name, entry in self.scan('builders').items()
+        }
+
+    def describe(self, kind: str, name: str) -> dict:
+        """Returns the metadata of the single plugin ``name`` of ``kind`` (which may be an absolute module name)"""
+        target = self.resolve(kind, name)
+        entry = self._describe(kind, name, target)
+        self._save_cache()
+        return dict(entry['meta'], name=name, target=target)
+
+    @staticmethod
+    def _import(target: str):
+        module, _, attr = target.partition(':')
+        obj = import_module(module)
+        for a in (attr or 'export').split('.'):
+            obj = getattr(obj, a)
+        return obj
+
+    def resolve(self, kind: str, name: str) -> str:
+        """
+        Resolve the plugin ``name`` of ``kind`` into a ``module:attr`` import target. Names containing a ``.`` are
+        treated as an absolute module name (e.g. ``mylibs.jquery``), which is imported as-is.
+        """
+        if '.' in name:
+            return name if ':' in name else f'{name}:export'
+        found = self._discover(kind)
+        if name not in found:
+            # It may have been added / installed since we last looked
+            found = self._discover(kind, refresh=True)
+        self._save_cache()
+        # Fall back to the built-in package, so a missing module raises the usual ModuleNotFoundError
+        return found.get(name, f'{KINDS[kind]}.{name}:export')
+
+    def load(self, kind: str, name: str):
+        """Import and return the class exported by the plugin ``name`` of ``kind``, e.g. ``load('libs', 'eosjs')``"""
+        target = self.resolve(kind, name)
+        log.debug('Importing %s module: %s', kind, target)
+        obj = self._import(target)
+        log.debug('Successfully imported: %s', target)
+        return obj
+
+
+_registry = None  # type: Optional[Registry]
+
+
+def get_registry() -> Registry:
+    """Returns the shared :class:`.Registry` instance"""
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
@@ -0,0 +1,174 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import json
+import logging
+import os
+import time
+from os import makedirs
+from os.path import dirname, exists
+from typing import Optional, Tuple, Dict
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.files import file_lock
+from cdnbuilder.registry import get_registry
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+Cost = Tuple[float, int]
+"""The estimated resource cost of building a library - ``(cpu_cores, memory_bytes)``"""
+
+
+def total_memory() -> int:
+    """Total physical memory of this machine in bytes"""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class ResourceHistory:
+    """
+    The peak memory / average CPU usage measured during the last few builds of each library, stored as JSON in
+    ``RESOURCES_FILE`` - used to estimate how much of the machine each build needs.
+
+    Example:
+
+        >>> h = ResourceHistory()
+        >>> h.record('eosjs', peak_rss=2.5 * 1024 ** 3, cpus=3.2)
+        >>> h.measured('eosjs')
+        (3.2, 2684354560)
+
+    """
+    def __init__(self, path: str = None, samples: int = None):
+        self.path = settings.RESOURCES_FILE if empty(path) else path
+        self.samples = settings.RESOURCE_SAMPLES if empty(samples) else int(samples)
+        self.lock_path = f'{self.path}.lock'
+
+    def load(self) -> Dict[str, list]:
+        if not exists(self.path):
+            return {}
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            log.warning('Resource history "%s" is unreadable - ignoring it', self.path)
+            return {}
+
+    def record(self, lib: str, peak_rss: int, cpus: float = None):
+        """Add a measurement of a build of ``lib``, keeping only the latest :py:attr:`.samples` for each library"""
+        makedirs(dirname(self.path) or '.', exist_ok=True)
+        with file_lock(self.lock_path):
+            data = self.load()
+            runs = data.get(lib, []) + [dict(peak_rss=int(peak_rss), cpus=cpus, at=int(time.time()))]
+            data[lib] = runs[-self.samples:]
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump(data, fp, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def measured(self, lib: str) -> Optional[Cost]:
+        """The highest CPU cores / memory used by the recorded builds of ``lib``, or ``None`` if it was never measured"""
+        runs = self.load().get(lib)
+        if empty(runs, itr=True):
+            return None
+        cpus = [r['cpus'] for r in runs if r.get('cpus') is not None]
+        return (max(cpus) if len(cpus) > 0 else None), max(r['peak_rss'] for r in runs)
+
+
+class ResourceBudget:
+    """
+    Tracks the CPU cores / memory reserved by the builds which are currently running, against machine-wide budgets.
+
+        >>> b = ResourceBudget(cpus=8, memory=16 * 1024 ** 3)
+        >>> b.fits((4, 6 * 1024 ** 3))
+        True
+        >>> b.acquire((4, 12 * 1024 ** 3))
+        >>> b.fits((4, 6 * 1024 ** 3))
+        False
+
+    """
+    def __init__(self, cpus: float = None, memory: int = None):
+        """
+        :param float cpus: CPU cores available to builds (default: :py:attr:`.settings.BUILD_CPU_BUDGET`)
+        :param int memory: Memory available to builds in bytes (default: ``BUILD_MEMORY_BUDGET``, or 80% of RAM)
+        """
+        self.cpus = settings.BUILD_CPU_BUDGET if empty(cpus) else float(cpus)
+        if empty(memory):
+            memory = settings.BUILD_MEMORY_BUDGET * MB if settings.BUILD_MEMORY_BUDGET > 0 else int(total_memory() * 0.8)
+        self.memory = int(memory)
+        self.used_cpus, self.used_memory = 0.0, 0
+
+    def fits(self, cost: Cost) -> bool:
+        return self.used_cpus + cost[0] <= self.cpus and self.used_memory + cost[1] <= self.memory
+
+    def acquire(self, cost: Cost):
+        self.used_cpus += cost[0]
+        self.used_memory += cost[1]
+
+    def release(self, cost: Cost):
+        self.used_cpus -= cost[0]
+        self.used_memory -= cost[1]
+
+
+def estimate_cost(name: str, history: ResourceHistory = None, meta: dict = None) -> Cost:
+    """
+    Estimate the CPU cores / memory needed to build the library module ``name``.
+
+    Measurements from previous builds (plus ``RESOURCE_HEADROOM``) are preferred. Otherwise the library's declared
+    :py:attr:`.BaseLib.build_cpus` / :py:attr:`.BaseLib.build_memory` are used, falling back to
+    ``RESOURCE_DEFAULT_CPUS`` / ``RESOURCE_DEFAULT_MEMORY``.
+
+    :param str name: The library module name, e.g. ``eosjs``
+    :param ResourceHistory history: The measured history to use (default: a new :class:`.ResourceHistory`)
+    :param dict meta: The library's registry metadata (default: looked up with :py:meth:`.Registry.describe`)
+    :return Cost cost: ``(cpu_cores, memory_bytes)``
+    """
+    history = ResourceHistory() if history is None else history
+    if meta is None:
+        try:
+            meta = get_registry().describe('libs', name)
+        except Exception:
+            log.debug('Could not describe library "%s" - using the default resource estimates', name)
+            meta = {}
+    cpus = meta.get('build_cpus') or settings.RESOURCE_DEFAULT_CPUS
+    memory = (meta.get('build_memory') or settings.RESOURCE_DEFAULT_MEMORY) * MB
+    measured = history.measured(name)
+    if measured is not None:
+        m_cpus, m_memory = measured
+        # CPU usage is averaged over each command, so never estimate below one core
+        cpus = cpus if m_cpus is None else max(1.0, m_cpus * settings.RESOURCE_HEADROOM)
+        memory = int(m_memory * settings.RESOURCE_HEADROOM)
+    return float(cpus), int(memory)
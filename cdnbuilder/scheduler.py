@@ -0,0 +1,186 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Tuple
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.build import build_lib
+from cdnbuilder.metrics import BuildMetrics, write_reports
+from cdnbuilder.resources import ResourceHistory, ResourceBudget, estimate_cost
+
+log = logging.getLogger(__name__)
+
+
+def _build_worker(lib: str, force=False, revision: str = None) -> Tuple[bool, dict]:
+    """
+    Build a single library, logging (rather than raising) any exception, so that one broken library can't
+    take down the rest of the run. Runs inside of a worker process when :func:`.build_libs` is parallel.
+    
+    :return tuple res: ``(success, metrics)`` - success is ``True`` if the library built without errors (or was
+                       already up to date), and metrics is the build's :py:meth:`.BuildMetrics.to_dict`
+    """
+    metrics = BuildMetrics(lib)
+    try:
+        build_lib(lib, force=force, metrics=metrics, revision=revision)
+        return True, metrics.to_dict()
+    except Exception:
+        log.exception('Unexpected error while building library "%s"...', lib)
+        return False, metrics.to_dict()
+
+
+def _failed_metrics(lib: str) -> dict:
+    """Metrics for a build whose worker process died, so it couldn't report it's own"""
+    m = BuildMetrics(lib)
+    m.finish('failed')
+    return m.to_dict()
+
+
+def _record_usage(history: ResourceHistory, lib: str, metrics: dict):
+    """Record the peak resource usage measured during a build of ``lib`` (if it actually ran a build)"""
+    counters = metrics['counters']
+    if metrics['status'] != 'built' or 'peak_rss_bytes' not in counters:
+        return
+    try:
+        history.record(lib, counters['peak_rss_bytes'], counters.get('avg_cpus'))
+    except OSError:
+        log.exception('Failed to record the resource usage of library "%s"', lib)
+
+
+def build_libs(libs: List[str], jobs: int = None, force=False, budget: ResourceBudget = None,
+               revisions: Dict[str, str] = None) -> Dict[str, bool]:
+    """
+    Build each library in ``libs``, running up to ``jobs`` whole library pipelines (download, build, copy) in
+    parallel worker processes. Each library's failures are isolated and logged, just like a sequential run.
+    
+    Builds are packed under the machine's CPU / memory ``budget``: a library is only started while it's estimated
+    cost (see :func:`.estimate_cost`) fits alongside the builds already running. Libraries which don't fit are
+    skipped over for now, so smaller builds can fill the gaps - but a library which doesn't fit into the budget
+    at all is still built once nothing else is running. The peak usage of each build is recorded into the
+    :class:`.ResourceHistory`, refining the estimates for the next run.
+    
+    If a worker process dies (e.g. it's killed by the OOM killer), the builds running in the pool at the time are
+    marked as failed, and the remaining libraries are built in a new pool.
+    
+    Once every library has finished, the run's stage timings are written out (see :func:`.write_reports`)
+    
+    Example:
+    
+        >>> res = build_libs(['eosjs', 'scatterjs'], jobs=2)
+        >>> res
+        {'eosjs': True, 'scatterjs': False}
+    
+    :param List[str] libs: A list of library module names to build, e.g. ``['eosjs', 'scatterjs']``
+    :param int jobs: Maximum number of libraries to build at once (default: :py:attr:`.settings.BUILD_JOBS`)
+    :param bool force: If True, overwrite any existing output files
+    :param ResourceBudget budget: The CPU / memory budget (default: ``BUILD_CPU_BUDGET`` / ``BUILD_MEMORY_BUDGET``)
+    :param dict revisions: (Optional) The upstream revision of each library, if already known (see :func:`.build_lib`)
+    :return dict results: A dict mapping each library name to ``True`` (built OK) or ``False`` (failed)
+    """
+    jobs = settings.BUILD_JOBS if empty(jobs) else int(jobs)
+    jobs = max(1, min(jobs, len(libs)))
+    results, builds, history = {}, [], ResourceHistory()
+    revisions = {} if revisions is None else revisions
+    
+    # With a single job, there's no benefit to spawning a worker process - just build them in order.
+    if jobs == 1:
+        for l in libs:
+            results[l], m = _build_worker(l, force=force, revision=revisions.get(l))
+            _record_usage(history, l, m)
+            builds.append(m)
+    else:
+        budget = ResourceBudget() if budget is None else budget
+        costs = {l: estimate_cost(l, history) for l in libs}
+        log.info('Building %d libraries with up to %d parallel jobs (budget: %.1f CPUs, %d MB memory)',
+                 len(libs), jobs, budget.cpus, budget.memory // (1024 * 1024))
+        pending, running = list(libs), {}
+        
+        def collect(fut) -> bool:
+            """Collect a finished build's result - returns ``True`` if it's worker process died, breaking the pool"""
+            l = running.pop(fut)
+            budget.release(costs[l])
+            broken = False
+            try:
+                results[l], m = fut.result()
+            except BrokenProcessPool:
+                log.error('A worker process died (e.g. killed by the OOM killer) while building library "%s"', l)
+                results[l], m, broken = False, _failed_metrics(l), True
+            except Exception:
+                log.exception('Worker process crashed while building library "%s"...', l)
+                results[l], m = False, _failed_metrics(l)
+            _record_usage(history, l, m)
+            builds.append(m)
+            return broken
+        
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                broken = False
+                for l in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    if not budget.fits(costs[l]) and len(running) > 0:
+                        continue
+                    log.debug('Starting build of "%s" (estimated %.1f CPUs, %d MB)', l, costs[l][0],
+                              costs[l][1] // (1024 * 1024))
+                    try:
+                        fut = pool.submit(_build_worker, l, force, revisions.get(l))
+                    except BrokenProcessPool:
+                        broken = True
+                        break
+                    budget.acquire(costs[l])
+                    running[fut] = l
+                    pending.remove(l)
+                if not broken:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    broken = any([collect(fut) for fut in done])
+                if broken:
+                    # When a worker dies, the pool fails every build still running in it. Collect them, then carry
+                    # on with the remaining libraries in a new pool - rather than losing the rest of the run.
+                    for fut in wait(running)[0]:
+                        collect(fut)
+                    pool.shutdown()
+                    pool = ProcessPoolExecutor(max_workers=jobs)
+        finally:
+            pool.shutdown()
+    
+    write_reports(builds)
+    failed = [l for l, ok in results.items() if not ok]
+    if len(failed) > 0:
+        log.error('%d of %d libraries failed to build: %s', len(failed), len(libs), ', '.join(failed))
+    return results
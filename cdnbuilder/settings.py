@@ -35,8 +35,8 @@ Copyright::
 import logging
 import dotenv
 from os.path import dirname, abspath, join
-from os import getenv as env
-from privex.helpers import env_csv
+from os import getenv as env, cpu_count
+from privex.helpers import env_csv, is_true
 
 dotenv.load_dotenv()
 
@@ -45,9 +45,175 @@ BASE_DIR = dirname(MOD_DIR)
 
 OUT_FOLDER = env('OUT_FOLDER', join(BASE_DIR, 'output'))
 BUILD_FOLDER = env('BUILD_FOLDER', '/tmp')
+# If set, the output of every command (git, yarn etc.) ran while building a library is written to
+# BUILD_LOG_FOLDER/<library>.log
+BUILD_LOG_FOLDER = env('BUILD_LOG_FOLDER', None)
+# Number of lines of command output which are included in the error if a command fails (and the only lines kept in
+# memory for commands with a lot of output, such as yarn builds)
+CMD_TAIL_LINES = int(env('CMD_TAIL_LINES', 50))
+
+# Persistent folder for caches which should survive between builds (e.g. git mirrors)
+CACHE_FOLDER = env('CACHE_FOLDER', join(BASE_DIR, 'cache'))
+# Lock files which are shared by every build publishing into OUT_FOLDER (kept out of OUT_FOLDER, so they aren't served)
+LOCK_FOLDER = env('LOCK_FOLDER', join(CACHE_FOLDER, 'locks'))
+
+# If enabled, GitDownloader keeps a bare mirror of each repo in GIT_CACHE_DIR, and only fetches new objects into it
+# on each build - instead of cloning the entire repo history from scratch every time.
+GIT_MIRROR = is_true(env('GIT_MIRROR', True))
+GIT_CACHE_DIR = env('GIT_CACHE_DIR', join(CACHE_FOLDER, 'git'))
+
+# NpmTarballDownloader downloads package tarballs from NPM_REGISTRY (authenticating with NPM_TOKEN if set). Requests
+# share a pool of keep-alive connections, keeping up to HTTP_POOL_SIZE idle connections open per host.
+NPM_REGISTRY = env('NPM_REGISTRY', 'https://registry.npmjs.org')
+NPM_TOKEN = env('NPM_TOKEN', None)
+HTTP_TIMEOUT = float(env('HTTP_TIMEOUT', 30))
+HTTP_POOL_SIZE = int(env('HTTP_POOL_SIZE', 4))
+
+# If enabled, YarnBuilder caches installed node_modules folders (keyed by yarn.lock + the dependencies listed in
+# package.json + node version) and restores them instead of running 'yarn install' when a library's dependencies
+# haven't changed.
+NODE_CACHE = is_true(env('NODE_CACHE', True))
+NODE_CACHE_DIR = env('NODE_CACHE_DIR', join(CACHE_FOLDER, 'node_modules'))
+# Least recently used entries are evicted when the cache is larger than NODE_CACHE_MAX_SIZE (in MB) or
+# has more than NODE_CACHE_MAX_ENTRIES entries
+NODE_CACHE_MAX_SIZE = int(env('NODE_CACHE_MAX_SIZE', 10240)) * 1024 * 1024
+NODE_CACHE_MAX_ENTRIES = int(env('NODE_CACHE_MAX_ENTRIES', 50))
+# How node_modules are saved into / restored from the cache: auto, reflink, copy_range, sendfile or copy
+# (see cdnbuilder.files.TRANSFER_MODES). 'auto' uses reflinks where supported, otherwise copies. Hardlinks are never
+# used, as a build which modifies a file inside of node_modules in-place would also modify the cached copy.
+NODE_CACHE_LINK = env('NODE_CACHE_LINK', 'auto')
+# If enabled, run 'yarn install --offline' after restoring node_modules from the cache to verify them
+NODE_CACHE_VERIFY = is_true(env('NODE_CACHE_VERIFY', False))
+
+# How built files are published into OUT_FOLDER: auto, reflink, hardlink, copy_range, sendfile or copy
+# (see cdnbuilder.files.TRANSFER_MODES). 'auto' tries each of them in that order, using the cheapest one which is
+# supported between BUILD_FOLDER and OUT_FOLDER.
+PUBLISH_MODE = env('PUBLISH_MODE', 'auto')
+
+# If enabled, each published file is stored once in a content-addressed blob store (BLOB_FOLDER, keyed by SHA-256),
+# and the versioned paths in OUT_FOLDER are hardlinks to it - so identical files across versions use no extra space.
+# Unreferenced blobs are removed with './run.py cleanup'
+# BLOB_FOLDER must be on the same filesystem as OUT_FOLDER (otherwise each path is a copy of the blob), but it shouldn't
+# be inside of it - or every published file could also be downloaded as /.blobs/xx/<sha256>. By default it's next to
+# OUT_FOLDER, e.g. /var/www/cdn -> /var/www/cdn-blobs - make sure your web server doesn't serve that folder either.
+DEDUPE_OUTPUT = is_true(env('DEDUPE_OUTPUT', True))
+BLOB_FOLDER = env('BLOB_FOLDER', OUT_FOLDER.rstrip('/') + '-blobs')
+
+# Each version is staged in a temporary folder inside of STAGING_FOLDER, then moved into OUT_FOLDER with a single
+# rename - so it must be on the same filesystem as OUT_FOLDER. Like BLOB_FOLDER, it's next to OUT_FOLDER by default
+# (e.g. /var/www/cdn -> /var/www/cdn-staging), so half published files are never served.
+STAGING_FOLDER = env('STAGING_FOLDER', OUT_FOLDER.rstrip('/') + '-staging')
+
+# Precompressed variants (e.g. eosjs-api.js.gz) of each published file with one of the COMPRESS_EXTENSIONS are
+# generated for each of the COMPRESS_FORMATS, so they can be served with nginx's gzip_static / brotli_static.
+# Supported formats: gz, br (requires the 'brotli' package), zst (requires the 'zstandard' package).
+# Set COMPRESS=false to disable precompression.
+COMPRESS = is_true(env('COMPRESS', True))
+COMPRESS_FORMATS = env_csv('COMPRESS_FORMATS', ['gz', 'br'])
+COMPRESS_EXTENSIONS = env_csv('COMPRESS_EXTENSIONS', ['.js', '.css'])
+# Number of worker processes used for compressing files (or threads used for publishing files, with STREAM_PUBLISH)
+COMPRESS_JOBS = int(env('COMPRESS_JOBS', cpu_count() or 1))
+
+# If enabled, each built file is read only once while publishing it: the same chunks are written to OUT_FOLDER, hashed
+# (SHA-256 for the blob store, SHA-256 + SRI for the output index) and streamed through each compressor - instead of
+# copying it, then re-reading it for every hash and compressed variant. Files are always copied in this mode, so
+# PUBLISH_MODE isn't used - disabling it may be faster on filesystems with reflinks, if COMPRESS and OUTPUT_INDEX are
+# both disabled.
+STREAM_PUBLISH = is_true(env('STREAM_PUBLISH', True))
+
+# Maximum number of (sub-)packages of a library which are identified at the same time after it's built
+IDENTIFY_JOBS = int(env('IDENTIFY_JOBS', 8))
+
+# If enabled, OUT_FOLDER/index.json (libraries, versions and the latest version of each package) and
+# OUT_FOLDER/<lib>/index.json (every published file, with it's size, mtime, SHA-256 and SRI hash) are updated each
+# time a library is published - see cdnbuilder.index.OutputIndex
+OUTPUT_INDEX = is_true(env('OUTPUT_INDEX', True))
+
+# Folder where a manifest of previous successful builds is kept for each library. Libraries are only rebuilt when
+# their upstream commit (or builder / builder args) change, unless you pass ``--force``
+MANIFEST_FOLDER = env('MANIFEST_FOLDER', join(CACHE_FOLDER, 'manifests'))
+
+# Cache of the metadata of each library / builder module (and entry point plugin), so that listing / planning
+# libraries doesn't need to import them. Entries are refreshed automatically when a module is modified.
+REGISTRY_CACHE = env('REGISTRY_CACHE', join(CACHE_FOLDER, 'registry.json'))
 
 BUILD_LIBS = env_csv('BUILD_LIBS', ['eosjs', 'scatterjs'])
 
+# Maximum number of libraries to build in parallel (each in their own worker process). Can be overridden
+# with ``./run.py build --jobs N``
+BUILD_JOBS = int(env('BUILD_JOBS', 1))
+
+# The build engine to use when building multiple libraries:
+#   process - build up to BUILD_JOBS whole libraries at once, each in a separate worker process
+#   async   - pipeline the download / build / publish stages of each library, with a separate concurrency limit for
+#             each stage (PIPELINE_*_JOBS) - so e.g. lots of repos can download at once, but only a few yarn builds
+BUILD_ENGINE = env('BUILD_ENGINE', 'process')
+
+# When building libraries in parallel with the 'process' engine, builds are only started while their estimated CPU
+# cores / memory (MB) fit within BUILD_CPU_BUDGET / BUILD_MEMORY_BUDGET (0 = 80% of the machine's RAM). Estimates come
+# from the peak memory / average CPU usage measured in the last RESOURCE_SAMPLES builds of each library (with
+# RESOURCE_HEADROOM added), stored in RESOURCES_FILE. Libraries which were never measured use their build_cpus /
+# build_memory attributes, or otherwise RESOURCE_DEFAULT_CPUS / RESOURCE_DEFAULT_MEMORY (MB).
+BUILD_CPU_BUDGET = float(env('BUILD_CPU_BUDGET', cpu_count() or 1))
+BUILD_MEMORY_BUDGET = int(env('BUILD_MEMORY_BUDGET', 0))
+RESOURCES_FILE = env('RESOURCES_FILE', join(CACHE_FOLDER, 'resources.json'))
+RESOURCE_SAMPLES = int(env('RESOURCE_SAMPLES', 5))
+RESOURCE_HEADROOM = float(env('RESOURCE_HEADROOM', 1.2))
+RESOURCE_DEFAULT_CPUS = float(env('RESOURCE_DEFAULT_CPUS', 1))
+RESOURCE_DEFAULT_MEMORY = int(env('RESOURCE_DEFAULT_MEMORY', 1024))
+PIPELINE_FETCH_JOBS = int(env('PIPELINE_FETCH_JOBS', 8))
+PIPELINE_BUILD_JOBS = int(env('PIPELINE_BUILD_JOBS', 2))
+PIPELINE_PUBLISH_JOBS = int(env('PIPELINE_PUBLISH_JOBS', 2))
+
+# After each run, the time spent in each stage (download, yarn install / commands, identify, copy etc.) and the
+# bytes / files published by each library are written to METRICS_REPORT as JSON. If METRICS_PROM_FILE is set,
+# they're also written there in the Prometheus text format, e.g. for node_exporter's textfile collector.
+METRICS_REPORT = env('METRICS_REPORT', join(CACHE_FOLDER, 'reports', 'last-run.json'))
+METRICS_PROM_FILE = env('METRICS_PROM_FILE', None)
+
+# './run.py gc' (or GC_AFTER_BUILD) removes temporary build folders in BUILD_FOLDER which were left behind by crashed
+# builds, once they're older than GC_BUILD_MAX_AGE hours. It also removes old versions from OUT_FOLDER - keeping the
+# newest GC_KEEP_VERSIONS versions of each package (0 = keep all), then removing the least recently used versions
+# until OUT_FOLDER is within GC_OUTPUT_BUDGET MB (0 = no budget). The latest version of each package, and versions
+# listed in GC_PINNED (e.g. 'eosjs@20.0.1,scatter-js/core@11.0.1') are never removed.
+GC_BUILD_MAX_AGE = float(env('GC_BUILD_MAX_AGE', 6))
+GC_KEEP_VERSIONS = int(env('GC_KEEP_VERSIONS', 0))
+GC_OUTPUT_BUDGET = int(env('GC_OUTPUT_BUDGET', 0)) * 1024 * 1024
+GC_PINNED = env_csv('GC_PINNED', [])
+GC_AFTER_BUILD = is_true(env('GC_AFTER_BUILD', False))
+
+# './run.py publish' (or SYNC_AFTER_BUILD) syncs OUT_FOLDER to each of the folders in SYNC_TARGETS (e.g. mounts of the
+# origin servers), copying only the files which changed since the last sync to that target - up to SYNC_JOBS files at
+# once per target, using SYNC_MODE (see cdnbuilder.files.TRANSFER_MODES - 'auto' never hardlinks). The state of each
+# target, and a cache of file hashes, are kept in SYNC_STATE_FOLDER. Files which were removed locally are also removed
+# from the targets if SYNC_DELETE is enabled. The URL paths which need purging from the CDN (prefixed with
+# SYNC_URL_PREFIX) are written to SYNC_PURGE_FILE.
+SYNC_TARGETS = env_csv('SYNC_TARGETS', [])
+SYNC_STATE_FOLDER = env('SYNC_STATE_FOLDER', join(CACHE_FOLDER, 'sync'))
+SYNC_JOBS = int(env('SYNC_JOBS', 4))
+SYNC_MODE = env('SYNC_MODE', 'auto')
+SYNC_DELETE = is_true(env('SYNC_DELETE', True))
+SYNC_URL_PREFIX = env('SYNC_URL_PREFIX', '/')
+SYNC_PURGE_FILE = env('SYNC_PURGE_FILE', join(CACHE_FOLDER, 'reports', 'purge.txt'))
+SYNC_AFTER_BUILD = is_true(env('SYNC_AFTER_BUILD', False))
+
+# './run.py queue' - a build queue stored in a SQLite database, which any number of workers (on this machine, or others
+# sharing QUEUE_DB over a network volume) pull library builds from. Workers lease each job for QUEUE_LEASE seconds,
+# renewing the lease every QUEUE_HEARTBEAT seconds while building. Jobs whose worker stopped renewing it's lease are
+# handed to another worker, up to QUEUE_MAX_ATTEMPTS times. Idle workers check for new jobs every QUEUE_POLL seconds.
+QUEUE_DB = env('QUEUE_DB', join(CACHE_FOLDER, 'queue.sqlite3'))
+QUEUE_LEASE = float(env('QUEUE_LEASE', 300))
+QUEUE_HEARTBEAT = float(env('QUEUE_HEARTBEAT', 60))
+QUEUE_POLL = float(env('QUEUE_POLL', 5))
+QUEUE_MAX_ATTEMPTS = int(env('QUEUE_MAX_ATTEMPTS', 3))
+
+# './run.py watch' checks each library's upstream repo for new commits every WATCH_INTERVAL seconds (checking up to
+# WATCH_JOBS remotes at once), and only builds the libraries which changed. A commit which fails to build isn't retried
+# until WATCH_RETRY seconds later.
+WATCH_INTERVAL = float(env('WATCH_INTERVAL', 300))
+WATCH_JOBS = int(env('WATCH_JOBS', 8))
+WATCH_RETRY = float(env('WATCH_RETRY', 3600))
+
 # Valid environment log levels (from least to most severe) are:
 # DEBUG, INFO, WARNING, ERROR, FATAL, CRITICAL
 LOG_LEVEL = env('LOG_LEVEL', None)
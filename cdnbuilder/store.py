@@ -0,0 +1,156 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import errno
+import logging
+import os
+from os import makedirs
+from os.path import join, exists
+from typing import Tuple
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.files import file_lock, file_digest, transfer_file
+
+log = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """
+    A content-addressed store of published files, keyed by their SHA-256 hash, kept in :py:attr:`.settings.BLOB_FOLDER`
+    (``OUT_FOLDER-blobs`` by default - it must be outside of ``OUT_FOLDER``, so the blobs aren't served).
+
+    Each file is only stored once, and the versioned paths within ``OUT_FOLDER`` are hardlinks to the stored blob - so
+    files which are byte-identical between versions / sub-packages only use disk space (and page cache) once.
+
+    As every published path is a hardlink, a blob's link count tells us how many paths use it. Blobs with a link
+    count of 1 are only referenced by the store itself, and are removed by :py:meth:`.cleanup`
+
+    Example:
+
+        >>> store = BlobStore()
+        >>> store.publish('/tmp/eosjs123/dist-web/eosjs-api.js', '/opt/cdn/eosjs/20.0.1/eosjs-api.js')
+        ('5f1e...', 'hardlink')
+        >>> store.publish('/tmp/eosjs456/dist-web/eosjs-api.js', '/opt/cdn/eosjs/20.0.2/eosjs-api.js')
+        ('5f1e...', 'dedupe')
+
+    """
+    def __init__(self, root: str = None):
+        self.root = settings.BLOB_FOLDER if empty(root) else root
+        self.lock_path = join(self.root, '.lock')
+
+    def blob_path(self, digest: str) -> str:
+        """The path to the blob for the SHA-256 hex ``digest``"""
+        return join(self.root, digest[:2], digest[2:])
+
+    def add(self, src: str, digest: str = None, mode: str = None) -> Tuple[str, str]:
+        """
+        Add the file ``src`` to the store (if it isn't already stored). Should be called while holding
+        a shared lock on :py:attr:`.lock_path`, so :py:meth:`.cleanup` can't remove it before it's linked.
+
+        :param str src: The file to store
+        :param str digest: (Optional) The SHA-256 hex digest of ``src``, if already known
+        :param str mode: The transfer mode used to copy ``src`` into the store (default: ``settings.PUBLISH_MODE``)
+        :return tuple res: ``(digest, mode)`` - mode is ``dedupe`` if an identical blob was already stored
+        """
+        digest = file_digest(src, 'sha256')['sha256'].hexdigest() if empty(digest) else digest
+        blob = self.blob_path(digest)
+        if exists(blob):
+            return digest, 'dedupe'
+        makedirs(join(self.root, digest[:2]), exist_ok=True)
+        # Copy into a temporary file, then link it into place - if another build stored the same blob at the same
+        # time, the link fails, and we just use their blob.
+        tmp_blob = f'{blob}.tmp{os.getpid()}-{id(src)}'
+        mode = transfer_file(src, tmp_blob, mode=settings.PUBLISH_MODE if empty(mode) else mode)
+        try:
+            os.link(tmp_blob, blob)
+        except FileExistsError:
+            mode = 'dedupe'
+        finally:
+            os.remove(tmp_blob)
+        return digest, mode
+
+    def link(self, digest: str, dst: str):
+        """Hardlink the stored blob ``digest`` to ``dst`` (replacing ``dst`` if it exists)"""
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(self.blob_path(digest), dst)
+        except OSError as e:
+            # If the destination is on a different filesystem to the store, we can't hardlink to the blob
+            if e.errno != errno.EXDEV:
+                raise
+            transfer_file(self.blob_path(digest), dst)
+
+    def publish(self, src: str, dst: str, mode: str = None, digest: str = None) -> Tuple[str, str]:
+        """
+        Store ``src`` in the blob store, and hardlink ``dst`` to the stored blob. ``dst`` may be ``src`` itself.
+
+        :param str digest: (Optional) The SHA-256 hex digest of ``src``, if already known
+        :return tuple res: ``(digest, mode)`` - see :py:meth:`.add`
+        """
+        makedirs(self.root, exist_ok=True)
+        with file_lock(self.lock_path, shared=True):
+            digest, mode = self.add(src, digest=digest, mode=mode)
+            self.link(digest, dst)
+        return digest, mode
+
+    def cleanup(self, dry_run=False) -> Tuple[int, int]:
+        """
+        Remove every blob which is no longer hardlinked to any published path (i.e. has a link count of 1)
+
+        :param bool dry_run: If True, only count the unreferenced blobs - don't remove them
+        :return tuple res: ``(blobs_removed, bytes_freed)``
+        """
+        removed, freed = 0, 0
+        if not exists(self.root):
+            return removed, freed
+        with file_lock(self.lock_path):
+            for prefix in os.listdir(self.root):
+                folder = join(self.root, prefix)
+                if len(prefix) != 2 or not os.path.isdir(folder):
+                    continue
+                for name in os.listdir(folder):
+                    blob = join(folder, name)
+                    st = os.lstat(blob)
+                    if st.st_nlink > 1:
+                        continue
+                    log.info('%s unreferenced blob "%s" (%d bytes)', 'Would remove' if dry_run else 'Removing', blob,
+                             st.st_size)
+                    if not dry_run:
+                        os.remove(blob)
+                    removed += 1
+                    freed += st.st_size
+        return removed, freed
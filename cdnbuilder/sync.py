@@ -0,0 +1,362 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from os import makedirs, path
+from typing import Dict, List, Optional, Tuple
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.files import transfer_file, replace_symlink, file_digest
+from cdnbuilder.index import INDEX_NAME, OutputIndex
+
+log = logging.getLogger(__name__)
+
+
+def _load_json(json_path: str, default: dict) -> dict:
+    if not path.exists(json_path):
+        return default
+    try:
+        with open(json_path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        log.warning('Sync state "%s" is unreadable - ignoring it', json_path)
+        return default
+
+
+def _save_json(json_path: str, data: dict):
+    makedirs(path.dirname(json_path), exist_ok=True)
+    tmp_path = f'{json_path}.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(data, fp)
+    os.replace(tmp_path, json_path)
+
+
+class LocalTree:
+    """
+    A snapshot of the content in ``OUT_FOLDER`` - the SHA-256 of each file, the target of each symlink, and the
+    content served at each URL path (following the ``latest`` symlinks and root aliases).
+
+    Hidden files / folders (e.g. staging folders or locks left behind by older versions) are never synced.
+
+    Files are only hashed when their size / mtime changed since the last scan (cached in ``SYNC_STATE_FOLDER``),
+    or their hash isn't already known from the library's :class:`.OutputIndex`.
+    """
+    def __init__(self, out_folder: str = None, state_folder: str = None):
+        self.root = settings.OUT_FOLDER if empty(out_folder) else out_folder
+        self.cache_path = path.join(settings.SYNC_STATE_FOLDER if empty(state_folder) else state_folder, 'hashes.json')
+        self.files = {}     # type: Dict[str, str]
+        """Maps the relative path of each regular file to it's SHA-256"""
+        self.links = {}     # type: Dict[str, str]
+        """Maps the relative path of each symlink to it's target"""
+        self.served = {}    # type: Dict[str, str]
+        """Maps each URL path (relative, following symlinks) to the SHA-256 of the file served there"""
+        self.hashed = 0
+        self._cache = {}    # type: Dict[str, list]
+
+    def _index_hashes(self) -> Dict[str, Tuple[int, int, str]]:
+        """The ``(size, mtime, sha256)`` of each published file, from each library's index"""
+        known = {}
+        for lib in OutputIndex.load_root(self.root).get('libs', {}).keys():
+            for pkg in OutputIndex(lib, self.root).load().get('packages', {}).values():
+                for ver in pkg.get('versions', {}).values():
+                    for f in ver.get('files', {}).values():
+                        known[f['path']] = (f['size'], f['mtime'], f['sha256'])
+        return known
+
+    def scan(self) -> 'LocalTree':
+        cache = _load_json(self.cache_path, {})
+        known, new_cache = self._index_hashes(), {}
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            rel_root = path.relpath(root, self.root)
+            for name in sorted(files) + [d for d in dirs if path.islink(path.join(root, d))]:
+                if name.startswith('.'):
+                    continue
+                full = path.join(root, name)
+                rel = path.normpath(path.join(rel_root, name))
+                if path.islink(full):
+                    self.links[rel] = os.readlink(full)
+                    continue
+                st = os.stat(full)
+                cached = cache.get(rel)
+                if cached is not None and cached[:2] == [st.st_size, st.st_mtime_ns]:
+                    digest = cached[2]
+                elif rel in known and known[rel][:2] == (st.st_size, int(st.st_mtime)):
+                    digest = known[rel][2]
+                else:
+                    digest = file_digest(full)['sha256'].hexdigest()
+                    self.hashed += 1
+                self.files[rel] = digest
+                new_cache[rel] = [st.st_size, st.st_mtime_ns, digest]
+        # The content served through symlinks (e.g. 'latest/' and the root aliases)
+        self.served = dict(self.files)
+        for rel in self.links:
+            self._resolve(rel)
+        self._cache = new_cache
+        return self
+
+    def save_cache(self):
+        """Save the size / mtime and hash of each file found by :py:meth:`.scan`, so they aren't hashed next time"""
+        _save_json(self.cache_path, self._cache)
+
+    def _resolve(self, rel: str):
+        real_root = path.realpath(self.root)
+        real = path.realpath(path.join(self.root, rel))
+        if not path.isdir(real):
+            real_rel = path.relpath(real, real_root)
+            if real_rel in self.files:
+                self.served[rel] = self.files[real_rel]
+            return
+        for root, _, files in os.walk(real):
+            for name in files:
+                f = path.join(root, name)
+                real_rel = path.relpath(f, real_root)
+                # Only files which are synced themselves (e.g. not hidden files) are served
+                if real_rel in self.files:
+                    self.served[path.normpath(path.join(rel, path.relpath(f, real)))] = self.files[real_rel]
+
+
+class SyncTarget:
+    """
+    A target root (e.g. a mount of an origin server) which ``OUT_FOLDER`` is synced to, and the state of the
+    files / symlinks we last synced to it - stored in ``SYNC_STATE_FOLDER``, so we don't need to scan the target.
+    """
+    def __init__(self, root: str, state_folder: str = None):
+        self.root = root
+        state_folder = settings.SYNC_STATE_FOLDER if empty(state_folder) else state_folder
+        name = sha256(path.abspath(root).encode()).hexdigest()[:16]
+        self.state_path = path.join(state_folder, f'target-{name}.json')
+
+    def load_state(self) -> dict:
+        return _load_json(self.state_path, dict(root=self.root, files={}, links={}))
+
+    def save_state(self, state: dict):
+        _save_json(self.state_path, state)
+
+
+class Syncer:
+    """
+    Syncs ``OUT_FOLDER`` to each of the target roots in ``SYNC_TARGETS``, copying only the files which changed
+    since the last sync to that target (according to it's saved state), in parallel.
+
+    Each target is updated in an order which never exposes a half synced version: new / changed files are copied
+    first (each to a temporary name, then renamed into place), then symlinks such as ``latest`` are re-pointed,
+    then the ``index.json`` files are updated - and finally files which no longer exist locally are removed.
+
+    The URL paths whose content changed or was removed (including paths served through ``latest`` and the root
+    aliases) are returned, and written to ``SYNC_PURGE_FILE`` - ready to purge from a CDN.
+
+    Example:
+
+        >>> res = Syncer(['/mnt/origin1/cdn', '/mnt/origin2/cdn']).run()
+        >>> res['targets']['/mnt/origin1/cdn']
+        {'copied': 12, 'bytes': 482113, 'linked': 3, 'deleted': 0, 'errors': 0}
+        >>> res['purge']
+        ['/eosjs/eosjs-api.js', '/eosjs/latest/eosjs-api.js', ...]
+
+    """
+    def __init__(self, targets: List[str] = None, out_folder: str = None, jobs: int = None, delete: bool = None,
+                 dry_run=False, full=False, state_folder: str = None):
+        """
+        :param List[str] targets: Target root folders (default: :py:attr:`.settings.SYNC_TARGETS`)
+        :param str out_folder: The folder to sync from (default: :py:attr:`.settings.OUT_FOLDER`)
+        :param int jobs: Files to copy in parallel to each target (default: :py:attr:`.settings.SYNC_JOBS`)
+        :param bool delete: Remove files from the targets which no longer exist locally (default: ``SYNC_DELETE``)
+        :param bool dry_run: Only work out what would be synced, without changing any targets
+        :param bool full: Ignore the saved state of each target - files which already exist on the target with the
+                          same contents are still skipped, but have to be hashed
+        """
+        self.targets = list(settings.SYNC_TARGETS if empty(targets, itr=True) else targets)
+        self.out_folder = settings.OUT_FOLDER if empty(out_folder) else out_folder
+        self.jobs = settings.SYNC_JOBS if empty(jobs) else int(jobs)
+        self.delete = settings.SYNC_DELETE if delete is None else delete
+        self.dry_run, self.full = dry_run, full
+        self.state_folder = settings.SYNC_STATE_FOLDER if empty(state_folder) else state_folder
+        self.served_path = path.join(self.state_folder, 'served.json')
+
+    def _copy(self, target: SyncTarget, rel: str) -> int:
+        src, dst = path.join(self.out_folder, rel), path.join(target.root, rel)
+        makedirs(path.dirname(dst), exist_ok=True)
+        tmp = path.join(path.dirname(dst), f'.{path.basename(dst)}.sync{os.getpid()}')
+        transfer_file(src, tmp, mode=settings.SYNC_MODE, allow_hardlink=False)
+        os.replace(tmp, dst)
+        return os.path.getsize(dst)
+
+    def _link(self, target: SyncTarget, rel: str, link_target: str):
+        dst = path.join(target.root, rel)
+        if path.isdir(dst) and not path.islink(dst):
+            raise IsADirectoryError(f'"{dst}" is a folder on the target - cannot replace it with a symlink')
+        makedirs(path.dirname(dst), exist_ok=True)
+        replace_symlink(link_target, dst)
+
+    def _same_file(self, target: SyncTarget, rel: str, digest: str) -> bool:
+        dst = path.join(target.root, rel)
+        return path.isfile(dst) and not path.islink(dst) and file_digest(dst)['sha256'].hexdigest() == digest
+
+    def _remove(self, target: SyncTarget, rel: str):
+        dst = path.join(target.root, rel)
+        if path.lexists(dst):
+            os.remove(dst)
+        # Remove any folders left empty (e.g. a removed version), up to the target root
+        folder = path.dirname(dst)
+        while path.abspath(folder) != path.abspath(target.root):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = path.dirname(folder)
+
+    def plan(self, tree: LocalTree, state: dict) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Compare the local ``tree`` with a target's saved ``state``
+
+        :return tuple changes: ``(files_to_copy, links_to_update, paths_to_remove)`` - as paths relative to the root
+        """
+        copy = [rel for rel, digest in tree.files.items() if state['files'].get(rel) != digest]
+        links = [rel for rel, target in tree.links.items() if state['links'].get(rel) != target]
+        remove = []
+        if self.delete:
+            remove = sorted(
+                (set(state['files']) | set(state['links'])) - (set(tree.files) | set(tree.links)), reverse=True
+            )
+        return copy, links, remove
+
+    def sync_target(self, tree: LocalTree, root: str) -> dict:
+        """Sync the local ``tree`` to the target ``root``, returning counts of what was changed"""
+        target = SyncTarget(root, self.state_folder)
+        state = dict(root=root, files={}, links={}) if self.full else target.load_state()
+        copy, links, remove = self.plan(tree, state)
+        res = dict(copied=0, bytes=0, linked=0, deleted=0, errors=0)
+        if self.full:
+            copy = [rel for rel in copy if not self._same_file(target, rel, tree.files[rel])]
+            state['files'] = {rel: d for rel, d in tree.files.items() if rel not in copy}
+        if self.dry_run:
+            res.update(copied=len(copy), linked=len(links), deleted=len(remove))
+            return res
+        makedirs(root, exist_ok=True)
+
+        def copy_file(rel):
+            try:
+                return rel, self._copy(target, rel)
+            except OSError:
+                log.exception('Failed to copy "%s" to target "%s"', rel, root)
+                return rel, None
+
+        def copy_all(pool, batch):
+            for rel, size in pool.map(copy_file, batch):
+                if size is None:
+                    res['errors'] += 1
+                    continue
+                state['files'][rel] = tree.files[rel]
+                state['links'].pop(rel, None)
+                res['copied'] += 1
+                res['bytes'] += size
+
+        # Index files are copied last, so they never list files the target doesn't have yet
+        indexes = [rel for rel in copy if path.basename(rel) == INDEX_NAME]
+        content = [rel for rel in copy if path.basename(rel) != INDEX_NAME]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as pool:
+                copy_all(pool, content)
+                for rel in links:
+                    try:
+                        self._link(target, rel, tree.links[rel])
+                        state['links'][rel] = tree.links[rel]
+                        state['files'].pop(rel, None)
+                        res['linked'] += 1
+                    except OSError:
+                        log.exception('Failed to update symlink "%s" on target "%s"', rel, root)
+                        res['errors'] += 1
+                copy_all(pool, indexes)
+            for rel in remove:
+                try:
+                    self._remove(target, rel)
+                    state['files'].pop(rel, None)
+                    state['links'].pop(rel, None)
+                    res['deleted'] += 1
+                except OSError:
+                    log.exception('Failed to remove "%s" from target "%s"', rel, root)
+                    res['errors'] += 1
+        finally:
+            # Only what was actually synced is recorded, so anything which failed is retried next time
+            target.save_state(state)
+        log.info('Synced to "%s": %d files copied (%d bytes), %d symlinks updated, %d removed, %d errors',
+                 root, res['copied'], res['bytes'], res['linked'], res['deleted'], res['errors'])
+        return res
+
+    def purge_paths(self, tree: LocalTree) -> List[str]:
+        """The URL paths whose content changed (or which were removed) since the last sync"""
+        served = _load_json(self.served_path, {})
+        changed = [p for p, digest in served.items() if tree.served.get(p, digest) != digest]
+        removed = [p for p in served if p not in tree.served]
+        prefix = settings.SYNC_URL_PREFIX
+        return sorted(prefix + p for p in set(changed + removed))
+
+    def run(self) -> dict:
+        """
+        Sync ``OUT_FOLDER`` to every target in parallel
+
+        :return dict res: ``targets`` maps each target root to the counts from :py:meth:`.sync_target`, and ``purge``
+                          is the list of URL paths to purge from the CDN
+        """
+        tree = LocalTree(self.out_folder, self.state_folder).scan()
+        log.info('Scanned %d files and %d symlinks in "%s" (%d hashed)', len(tree.files), len(tree.links),
+                 self.out_folder, tree.hashed)
+        purge = self.purge_paths(tree)
+        if len(self.targets) == 0:
+            log.warning('No sync targets configured (SYNC_TARGETS)')
+            return dict(targets={}, purge=purge)
+        with ThreadPoolExecutor(max_workers=len(self.targets)) as pool:
+            results = dict(zip(self.targets, pool.map(lambda t: self.sync_target(tree, t), self.targets)))
+        if self.dry_run:
+            return dict(targets=results, purge=purge)
+        failed = [t for t, r in results.items() if r['errors'] > 0]
+        if len(failed) > 0:
+            # Keep the last fully synced state, so the same paths are synced and purged again on the next run
+            log.warning('Errors syncing to %s - not saving the served paths, they will be purged again next run',
+                        ', '.join(failed))
+        else:
+            tree.save_cache()
+            _save_json(self.served_path, tree.served)
+        if not empty(settings.SYNC_PURGE_FILE):
+            makedirs(path.dirname(settings.SYNC_PURGE_FILE), exist_ok=True)
+            with open(settings.SYNC_PURGE_FILE, 'w') as fp:
+                fp.writelines(p + '\n' for p in purge)
+        return dict(targets=results, purge=purge)
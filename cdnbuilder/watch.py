@@ -0,0 +1,162 @@
+"""
+
+Copyright::
+
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        CDN Builder                                |
+    |        License: GNU AGPL v3                       |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+    CDN Builder - A tool written in Python for building and version organising compiled JS/CSS assets
+    Copyright (c) 2019    Privex Inc. ( https://www.privex.io )
+
+    This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+    Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option)
+    any later version.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+    details.
+
+    You should have received a copy of the GNU Affero General Public License along with this program.
+    If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Dict, Tuple
+
+from privex.helpers import empty
+
+from cdnbuilder import settings
+from cdnbuilder.core import load_lib
+from cdnbuilder.jobqueue import JobQueue
+from cdnbuilder.manifest import BuildManifest
+from cdnbuilder.scheduler import build_libs
+
+log = logging.getLogger(__name__)
+
+
+class Watcher:
+    """
+    Polls the upstream repo of each library for new commits, and builds (or queues) only the libraries which changed.
+
+    Each poll only asks the library's downloader for it's :py:meth:`.BaseDownloader.remote_revision` (``git ls-remote``
+    for git repos) - the libraries are polled concurrently, and libraries sharing the same repo + ref are only looked
+    up once. A library is rebuilt when there's no successful build of that revision (with the same builder and args)
+    in it's :class:`.BuildManifest`.
+
+    If a build of a revision fails, that revision isn't retried until ``retry_after`` seconds later, so a broken
+    release doesn't trigger a full build on every poll.
+
+    Example:
+
+        >>> w = Watcher(['eosjs', 'scatterjs'])
+        >>> w.poll()
+        {'eosjs': '8a6c15ec1f0f3d7d0d4e8a3e6c5f3b6a7c1d2e3f'}
+        >>> w.run()     # Poll + build forever
+
+    """
+    def __init__(self, libs: List[str] = None, interval: float = None, jobs: int = None, build_jobs: int = None,
+                 retry_after: float = None, queue: JobQueue = None):
+        """
+        :param List[str] libs: Library modules to watch (default: :py:attr:`.settings.BUILD_LIBS`)
+        :param float interval: Seconds between each poll (default: :py:attr:`.settings.WATCH_INTERVAL`)
+        :param int jobs: Number of remotes to check at once (default: :py:attr:`.settings.WATCH_JOBS`)
+        :param int build_jobs: Number of changed libraries to build in parallel (default: ``BUILD_JOBS``)
+        :param float retry_after: Seconds before retrying a revision which failed to build (default: ``WATCH_RETRY``)
+        :param JobQueue queue: If passed, changed libraries are added to this build queue, instead of being built
+        """
+        self.libs = list(settings.BUILD_LIBS if empty(libs, itr=True) else libs)
+        self.interval = settings.WATCH_INTERVAL if interval is None else float(interval)
+        self.jobs = settings.WATCH_JOBS if empty(jobs) else int(jobs)
+        self.build_jobs = build_jobs
+        self.retry_after = settings.WATCH_RETRY if retry_after is None else float(retry_after)
+        self.queue = queue
+        self.failed = {}    # type: Dict[str, Tuple[str, float]]
+        """Maps each library whose last build failed to the revision which failed, and when it failed"""
+
+    def _check(self, name: str, revisions: dict, locks: dict) -> Optional[str]:
+        """Returns the remote revision of library ``name`` if it needs building, otherwise ``None``"""
+        lib = load_lib(name)()
+        try:
+            dl = lib.downloader
+            # Libraries sharing a repo and ref (e.g. different builds of the same repo) only need one lookup
+            remote = (type(dl).__name__, dl.url, getattr(dl, 'ref', None))
+            with locks.setdefault(remote, threading.Lock()):
+                if remote not in revisions:
+                    revisions[remote] = dl.remote_revision()
+            commit = revisions[remote]
+            if empty(commit):
+                log.warning('Cannot check library "%s" for changes - it\'s downloader can\'t identify revisions', name)
+                return None
+            if BuildManifest(lib.lib_name).is_built(lib.build_key(commit)):
+                return None
+            failed_commit, failed_at = self.failed.get(name, (None, 0))
+            if failed_commit == commit and time.time() - failed_at < self.retry_after:
+                log.debug('Library "%s" commit %s failed to build recently - not retrying yet', name, commit)
+                return None
+            return commit
+        finally:
+            lib.temp_dir_obj.cleanup()
+
+    def poll(self) -> Dict[str, str]:
+        """
+        Check every library's remote for a revision which hasn't been built yet
+
+        :return dict changed: Maps each library which needs building to the remote revision which will be built
+        """
+        revisions, locks, changed = {}, {}, {}
+
+        def check(name):
+            try:
+                return name, self._check(name, revisions, locks)
+            except Exception:
+                log.exception('Error while checking library "%s" for changes...', name)
+                return name, None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.jobs, len(self.libs)))) as pool:
+            for name, commit in pool.map(check, self.libs):
+                if commit is not None:
+                    changed[name] = commit
+        return changed
+
+    def run_once(self) -> Dict[str, str]:
+        """Poll every library once, then build (or queue) the libraries which changed. Returns :py:meth:`.poll`'s result"""
+        started = time.time()
+        changed = self.poll()
+        log.info('Checked %d libraries in %.2fs - %d changed%s', len(self.libs), time.time() - started, len(changed),
+                 '' if len(changed) == 0 else ': ' + ', '.join(f'{l} ({c[:10]})' for l, c in changed.items()))
+        if len(changed) == 0:
+            return changed
+        if self.queue is not None:
+            self.queue.enqueue(list(changed.keys()))
+            return changed
+        # Pass on the revisions we just polled, so the builds don't have to look them up again
+        results = build_libs(list(changed.keys()), jobs=self.build_jobs, revisions=changed)
+        for name, ok in results.items():
+            if ok:
+                self.failed.pop(name, None)
+            else:
+                self.failed[name] = (changed[name], time.time())
+        return changed
+
+    def run(self):
+        """Poll + build the changed libraries every :py:attr:`.interval` seconds, forever"""
+        log.info('Watching %d libraries for changes every %d seconds', len(self.libs), self.interval)
+        while True:
+            started = time.time()
+            self.run_once()
+            time.sleep(max(0.0, self.interval - (time.time() - started)))
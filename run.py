@@ -33,23 +33,48 @@ Copyright::
 
 
 """
+import json
 import sys
 import textwrap
 import argparse
-from os import path, makedirs, symlink
-from shutil import copyfile
+from datetime import datetime
 
 from privex.helpers import ErrHelpParser, empty
 
 from cdnbuilder import settings, VERSION
+from cdnbuilder.backfill import Backfill
+from cdnbuilder.build import build_lib
 from cdnbuilder.core import load_lib
+from cdnbuilder.gc import GarbageCollector
+from cdnbuilder.jobqueue import JobQueue, run_workers
+from cdnbuilder.manifest import BuildManifest
+from cdnbuilder.metrics import BuildMetrics, write_reports
+from cdnbuilder.pipeline import PipelineEngine
+from cdnbuilder.registry import get_registry
+from cdnbuilder.scheduler import build_libs
+from cdnbuilder.store import BlobStore
+from cdnbuilder.sync import Syncer
+from cdnbuilder.watch import Watcher
 import logging
 
 log = logging.getLogger('cdnbuilder.cli')
 
 
 CMD_DESC = {
-    'build': f'With no arguments, builds all libraries specified in BUILD_LIBS. Otherwise, builds (library)',
+    'build': f'With no arguments, builds all libraries specified in BUILD_LIBS. Otherwise, builds (library). '
+             f'Libraries which haven\'t changed upstream since their last build are skipped, unless --force is passed. '
+             f'With --versions, builds the matching tags of (library) in parallel.',
+    'cleanup': 'Remove files from the de-duplicated output blob store which are no longer used by any version',
+    'gc': 'Remove orphaned build folders, and old versions of libraries according to the retention policy / disk budget',
+    'list': 'List the available libraries (or builders with --builders), without importing any of them',
+    'plan': 'Show what building the libraries in BUILD_LIBS (or the passed libraries) would do, and their last build. '
+            'With --check, the upstream repos are checked to see which libraries would actually be rebuilt.',
+    'watch': 'Check the upstream repos of the libraries in BUILD_LIBS (or the passed libraries) for new commits every '
+             'WATCH_INTERVAL seconds, and build only the libraries which changed.',
+    'publish': 'Sync the output folder to each of the SYNC_TARGETS (or the passed targets), copying only the files '
+               'which changed since the last sync, and list the URL paths to purge from the CDN.',
+    'queue': 'Manage the multi-worker build queue: "add" queues library builds (default: BUILD_LIBS), "work" runs '
+             'workers which build queued libraries, and "status" shows the queue\'s jobs.',
 }
 
 HELP_TEXT = textwrap.dedent(f'''\
@@ -61,7 +86,14 @@ Official Repo: https://github.com/Privex/cdn-builder
 
 Sub-commands:
 
-    build  (library)                - {CMD_DESC['build']}
+    build  [options] (library)      - {CMD_DESC['build']}
+    cleanup  [--dry-run]            - {CMD_DESC['cleanup']}
+    gc  [options]                   - {CMD_DESC['gc']}
+    list  [--builders] [--json]     - {CMD_DESC['list']}
+    plan  [--check] (library...)    - {CMD_DESC['plan']}
+    publish  [options] (target...)  - {CMD_DESC['publish']}
+    queue  (add|work|status) [...]  - {CMD_DESC['queue']}
+    watch  [options] (library...)   - {CMD_DESC['watch']}
 
 ''')
 
@@ -74,48 +106,244 @@ parser = ErrHelpParser(
 
 def ap_build(opt):
     lib = opt.lib
-    # If no library name was passed on the CLI args, then just build all libraries listed in BUILD_LIBS
-    if empty(lib):
-        for l in settings.BUILD_LIBS:
-            try:
-                build_lib(l)
-            except:
-                log.exception('Unexpected error while building library "%s"...', l)
+    if not empty(opt.versions) and empty(lib):
+        parser.error('--versions requires a library to be specified')
+    try:
+        if not empty(opt.versions):
+            Backfill(lib, opt.versions, jobs=opt.jobs, force=opt.force).run()
+            return
+        # If no library name was passed on the CLI args, then just build all libraries listed in BUILD_LIBS
+        if empty(lib):
+            if opt.engine == 'async':
+                PipelineEngine(force=opt.force).run(settings.BUILD_LIBS)
+            else:
+                build_libs(settings.BUILD_LIBS, jobs=opt.jobs, force=opt.force)
+            return
+        metrics = BuildMetrics(lib)
+        try:
+            build_lib(lib, force=opt.force, metrics=metrics)
+        finally:
+            write_reports([metrics])
+    finally:
+        if settings.GC_AFTER_BUILD:
+            log.info('Running post-build garbage collection (GC_AFTER_BUILD)')
+            GarbageCollector().run()
+        if settings.SYNC_AFTER_BUILD:
+            log.info('Syncing the output folder to the sync targets (SYNC_AFTER_BUILD)')
+            Syncer().run()
+
+
+def ap_gc(opt):
+    budget = None if opt.budget is None else opt.budget * 1024 * 1024
+    gc = GarbageCollector(max_age=opt.max_age, keep_versions=opt.keep, budget=budget, dry_run=opt.dry_run)
+    res = gc.run()
+    verb = 'Would remove' if opt.dry_run else 'Removed'
+    print(f"{verb} {res['build_dirs'][0]} orphaned build folders ({res['build_dirs'][1]} bytes)")
+    print(f"{verb} {res['versions'][0]} old versions ({res['versions'][1]} bytes)")
+    print(f"{verb} {res['blobs'][0]} unused blobs ({res['blobs'][1]} bytes)")
+
+
+def ap_cleanup(opt):
+    removed, freed = BlobStore().cleanup(dry_run=opt.dry_run)
+    print(f"{'Would remove' if opt.dry_run else 'Removed'} {removed} unused blobs ({freed} bytes)")
+
+
+def ap_list(opt):
+    reg = get_registry()
+    items = reg.builders() if opt.builders else reg.libs()
+    if opt.json:
+        print(json.dumps(items, indent=2))
+        return
+    if opt.builders:
+        for name, b in items.items():
+            print(f"{name:<24} {b['target']:<48} {b.get('description') or ''}")
         return
-    build_lib(lib)
+    print(f"{'NAME':<24} {'LIB NAME':<24} {'BUILDER':<16} {'SUB-PKGS':<9} URL")
+    for name, l in items.items():
+        print(f"{name:<24} {l.get('lib_name') or '?':<24} {l.get('builder') or '?':<16} "
+              f"{len(l.get('subpackages') or []):<9} {l.get('url') or ''}")
 
 
-def build_lib(l, force=False):
-    # Load the library helper class and build it
-    lib = load_lib(l)()
-    files = lib.build()
-    
-    lib_folder = path.join(settings.OUT_FOLDER, lib.lib_name)
-    # Create the versioned directory structure for the library distribution files, and copy each file to the
-    # appropriate folder within the directory structure.
-    for f in files:
-        pkg_folder = path.join(lib_folder, f.pkg_folder)
-        out_file = path.join(pkg_folder, f.filename)
-        if not path.exists(pkg_folder):
-            makedirs(pkg_folder)
-        if path.exists(out_file) and not force:
-            log.warning('The file "%s" already exists. Skipping.', out_file)
+def ap_plan(opt):
+    reg = get_registry()
+    for name in (settings.BUILD_LIBS if empty(opt.libs, itr=True) else opt.libs):
+        try:
+            l = reg.describe('libs', name)
+        except Exception as e:
+            print(f'{name}: unknown library ({type(e).__name__}: {e})\n')
             continue
-        log.info('Copying "%s" to "%s"', f.src, out_file)
-        copyfile(f.src, out_file)
-        if lib.link_root:
-            link_dst = path.join(lib_folder, f.filename)
-            log.info('Creating symlink from "%s" to "%s"', out_file, link_dst)
-            symlink(out_file, link_dst)
+        lib_name = l.get('lib_name') or name
+        subs = l.get('subpackages') or []
+        outputs = [] if l.get('include_main') is False else ['main package']
+        if len(subs) > 0 and l.get('include_sub') is not False:
+            outputs.append(f"{len(subs)} sub-packages ({', '.join(subs)})")
+        print(f'{name} (lib_name: {lib_name})')
+        print(f"    source:     {l.get('url')} @ {l.get('ref') or 'latest'} (clone mode: {l.get('clone_mode') or 'full'})")
+        print(f"    builder:    {l.get('builder')} {json.dumps(l.get('args') or {})}")
+        print(f"    outputs:    {' + '.join(outputs) or 'nothing'}")
+        last = BuildManifest(lib_name).last
+        if last is None:
+            print('    last build: never')
+        else:
+            built_at = datetime.fromtimestamp(last['built_at']).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"    last build: commit {last['commit']} at {built_at} ({len(last['files'])} files)")
+        if opt.check:
+            # Checking the upstream revision needs the real library class (and it's downloader)
+            lib = load_lib(name)()
+            key = lib.build_key()
+            if key is None:
+                status = 'would build (the downloader can\'t identify revisions)'
+            elif BuildManifest(lib.lib_name).is_built(key):
+                status = f"up to date (commit {key['commit']}) - would be skipped"
+            else:
+                status = f"would build commit {key['commit']}"
+            print(f'    status:     {status}')
+        print()
+
+
+def ap_publish(opt):
+    res = Syncer(opt.targets, jobs=opt.jobs, delete=False if opt.no_delete else None, dry_run=opt.dry_run,
+                 full=opt.full).run()
+    verb = 'Would sync' if opt.dry_run else 'Synced'
+    for target, r in res['targets'].items():
+        print(f"{verb} {target}: {r['copied']} files copied ({r['bytes']} bytes), {r['linked']} symlinks updated, "
+              f"{r['deleted']} removed, {r['errors']} errors")
+    print(f"{len(res['purge'])} URL paths to purge" + ('' if opt.dry_run else f' (written to {settings.SYNC_PURGE_FILE})'))
+    if opt.print_purge:
+        for p in res['purge']:
+            print(p)
+    if any(r['errors'] > 0 for r in res['targets'].values()):
+        sys.exit(1)
+
+
+def ap_queue_add(opt):
+    libs = settings.BUILD_LIBS if empty(opt.libs, itr=True) else opt.libs
+    ids = JobQueue().enqueue(libs, force=opt.force)
+    for lib, job_id in zip(libs, ids):
+        print(f'Queued {lib} (job {job_id})')
+
+
+def ap_queue_work(opt):
+    run_workers(opt.workers, exit_when_empty=opt.exit_when_empty)
+
+
+def ap_queue_status(opt):
+    q = JobQueue()
+    q.reclaim_expired()
+    print('  '.join(f'{status}: {count}' for status, count in q.stats().items()))
+    print()
+    print(f"{'ID':<6} {'LIBRARY':<24} {'STATUS':<8} {'TRIES':<6} {'WORKER':<32} {'FINISHED':<20} ERROR")
+    for j in q.jobs(status=opt.status, limit=opt.limit):
+        finished = '' if j['finished_at'] is None else \
+            datetime.fromtimestamp(j['finished_at']).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{j['id']:<6} {j['lib']:<24} {j['status']:<8} {j['attempts']:<6} {j['worker'] or '':<32} "
+              f"{finished:<20} {j['error'] or ''}")
+
+
+def ap_watch(opt):
+    w = Watcher(opt.libs, interval=opt.interval, build_jobs=opt.jobs, queue=JobQueue() if opt.queue else None)
+    if opt.once:
+        w.run_once()
+        return
+    try:
+        w.run()
+    except KeyboardInterrupt:
+        log.info('Stopped watching')
 
 
 sp = parser.add_subparsers()
 
 parse_build = sp.add_parser('build', description=CMD_DESC['build'])
 parse_build.add_argument('lib', default=None, help='Library to build', nargs='?')
+parse_build.add_argument('-j', '--jobs', type=int, default=None, dest='jobs',
+                         help=f'Number of libraries to build in parallel (default: BUILD_JOBS = {settings.BUILD_JOBS})')
+parse_build.add_argument('-e', '--engine', choices=['process', 'async'], default=settings.BUILD_ENGINE, dest='engine',
+                         help=f'Build engine to use when building multiple libraries (default: {settings.BUILD_ENGINE})')
+parse_build.add_argument('-V', '--versions', default=None, dest='versions',
+                         help='Build these tags of (library) in parallel instead of the latest version - a comma '
+                              'separated list of tags / glob patterns, e.g. "v20.*,v21.0.0"')
+parse_build.add_argument('-f', '--force', action='store_true', default=False, dest='force',
+                         help='Rebuild libraries even if they are up to date, and overwrite existing output files')
 
 parse_build.set_defaults(func=ap_build)
 
+parse_cleanup = sp.add_parser('cleanup', description=CMD_DESC['cleanup'])
+parse_cleanup.add_argument('--dry-run', action='store_true', default=False, dest='dry_run',
+                           help='Only show what would be removed, without removing anything')
+parse_cleanup.set_defaults(func=ap_cleanup)
+
+parse_gc = sp.add_parser('gc', description=CMD_DESC['gc'])
+parse_gc.add_argument('--dry-run', action='store_true', default=False, dest='dry_run',
+                      help='Only show what would be removed, without removing anything')
+parse_gc.add_argument('--max-age', type=float, default=None, dest='max_age',
+                      help=f'Remove orphaned build folders older than this many hours '
+                           f'(default: GC_BUILD_MAX_AGE = {settings.GC_BUILD_MAX_AGE})')
+parse_gc.add_argument('-k', '--keep', type=int, default=None, dest='keep',
+                      help=f'Versions of each package to keep, 0 = all (default: GC_KEEP_VERSIONS = {settings.GC_KEEP_VERSIONS})')
+parse_gc.add_argument('-b', '--budget', type=int, default=None, dest='budget',
+                      help='Maximum size of the output folder in MB, 0 = unlimited (default: GC_OUTPUT_BUDGET)')
+parse_gc.set_defaults(func=ap_gc)
+
+parse_list = sp.add_parser('list', description=CMD_DESC['list'])
+parse_list.add_argument('--builders', action='store_true', default=False, dest='builders',
+                        help='List the available builders instead of libraries')
+parse_list.add_argument('--json', action='store_true', default=False, dest='json', help='Output the metadata as JSON')
+parse_list.set_defaults(func=ap_list)
+
+parse_plan = sp.add_parser('plan', description=CMD_DESC['plan'])
+parse_plan.add_argument('libs', default=None, help='Libraries to plan (default: BUILD_LIBS)', nargs='*')
+parse_plan.add_argument('-c', '--check', action='store_true', default=False, dest='check',
+                        help='Check the upstream repos, to see which libraries would actually be rebuilt')
+parse_plan.set_defaults(func=ap_plan)
+
+parse_publish = sp.add_parser('publish', description=CMD_DESC['publish'])
+parse_publish.add_argument('targets', default=None, help='Target folders to sync to (default: SYNC_TARGETS)', nargs='*')
+parse_publish.add_argument('-j', '--jobs', type=int, default=None, dest='jobs',
+                           help=f'Files to copy at once to each target (default: SYNC_JOBS = {settings.SYNC_JOBS})')
+parse_publish.add_argument('--dry-run', action='store_true', default=False, dest='dry_run',
+                           help='Only show what would be synced, without changing the targets')
+parse_publish.add_argument('--full', action='store_true', default=False, dest='full',
+                           help='Ignore the saved state of each target, and compare the file contents instead')
+parse_publish.add_argument('--no-delete', action='store_true', default=False, dest='no_delete',
+                           help='Don\'t remove files from the targets which no longer exist locally')
+parse_publish.add_argument('-p', '--print-purge', action='store_true', default=False, dest='print_purge',
+                           help='Print each URL path to purge from the CDN')
+parse_publish.set_defaults(func=ap_publish)
+
+parse_queue = sp.add_parser('queue', description=CMD_DESC['queue'])
+queue_sp = parse_queue.add_subparsers()
+parse_queue_add = queue_sp.add_parser('add', description='Queue builds of the passed libraries (default: BUILD_LIBS)')
+parse_queue_add.add_argument('libs', default=None, help='Libraries to queue (default: BUILD_LIBS)', nargs='*')
+parse_queue_add.add_argument('-f', '--force', action='store_true', default=False, dest='force',
+                             help='Rebuild the libraries even if they are up to date')
+parse_queue_add.set_defaults(func=ap_queue_add)
+
+parse_queue_work = queue_sp.add_parser('work', description='Run workers which build libraries from the queue')
+parse_queue_work.add_argument('-w', '--workers', type=int, default=1, dest='workers',
+                              help='Number of worker processes to run on this machine (default: 1)')
+parse_queue_work.add_argument('--exit-when-empty', action='store_true', default=False, dest='exit_when_empty',
+                              help='Exit once there are no more queued jobs, instead of waiting for new ones')
+parse_queue_work.set_defaults(func=ap_queue_work)
+
+parse_queue_status = queue_sp.add_parser('status', description='Show the number of jobs in each state, and recent jobs')
+parse_queue_status.add_argument('-s', '--status', choices=['queued', 'running', 'done', 'failed'], default=None,
+                                dest='status', help='Only show jobs with this status')
+parse_queue_status.add_argument('-n', '--limit', type=int, default=20, dest='limit',
+                                help='Number of recent jobs to show (default: 20)')
+parse_queue_status.set_defaults(func=ap_queue_status)
+
+parse_watch = sp.add_parser('watch', description=CMD_DESC['watch'])
+parse_watch.add_argument('libs', default=None, help='Libraries to watch (default: BUILD_LIBS)', nargs='*')
+parse_watch.add_argument('-i', '--interval', type=float, default=None, dest='interval',
+                         help=f'Seconds between each check (default: WATCH_INTERVAL = {settings.WATCH_INTERVAL})')
+parse_watch.add_argument('-j', '--jobs', type=int, default=None, dest='jobs',
+                         help=f'Number of changed libraries to build in parallel (default: BUILD_JOBS = {settings.BUILD_JOBS})')
+parse_watch.add_argument('-q', '--queue', action='store_true', default=False, dest='queue',
+                         help='Add changed libraries to the build queue (see "queue"), instead of building them')
+parse_watch.add_argument('--once', action='store_true', default=False, dest='once',
+                         help='Check (and build) the libraries once, then exit - e.g. for running from cron')
+parse_watch.set_defaults(func=ap_watch)
+
 
 # Resolves the error "'Namespace' object has no attribute 'func'
 # Taken from https://stackoverflow.com/a/54161510/2648583
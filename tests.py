@@ -1,6 +1,65 @@
 #!/usr/bin/env python3
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import time
 import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+from cdnbuilder import settings
+from cdnbuilder.backfill import Backfill, match_versions
+from cdnbuilder.cache import GitMirror, NodeModulesCache
+from cdnbuilder.compress import compress_files
+from cdnbuilder.core import CommandHelper, version_key
+from cdnbuilder.downloaders.GitDownloader import CLONE_MODES, GitDownloader
+from cdnbuilder.downloaders.NpmTarballDownloader import NpmTarballDownloader
+from cdnbuilder.exceptions import BuildError, DownloadError
+from cdnbuilder.files import file_lock
+from cdnbuilder.gc import GarbageCollector
+from cdnbuilder.index import OutputIndex
+from cdnbuilder.jobqueue import JobQueue, run_workers
+from cdnbuilder.libs.base import BaseLib, FileOutput
+from cdnbuilder.manifest import BuildManifest
+from cdnbuilder.metrics import BuildMetrics, prometheus_text
+from cdnbuilder.publish import publish_lib
+from cdnbuilder.registry import Registry, parse_module
+from cdnbuilder.resources import ResourceBudget, ResourceHistory
 from cdnbuilder.libs.scatterjs import ScatterJSLib
+from cdnbuilder.scheduler import build_libs
+from cdnbuilder.store import BlobStore
+from cdnbuilder.sync import Syncer
+from cdnbuilder.watch import Watcher
+
+_module_patches = []
+
+
+def setUpModule():
+    # Shared lock files, staging folders and the default registry's cache would otherwise be written into the real
+    # CACHE_FOLDER / next to the real OUT_FOLDER
+    tmp = TemporaryDirectory()
+    _module_patches.append(tmp)
+    for p in (mock.patch('cdnbuilder.settings.LOCK_FOLDER', tmp.name),
+              mock.patch('cdnbuilder.settings.STAGING_FOLDER', os.path.join(tmp.name, 'staging')),
+              mock.patch('cdnbuilder.settings.REGISTRY_CACHE', os.path.join(tmp.name, 'registry.json')),
+              mock.patch('cdnbuilder.registry._registry', None)):
+        p.start()
+        _module_patches.append(p)
+
+
+def tearDownModule():
+    while len(_module_patches) > 1:
+        _module_patches.pop().stop()
+    _module_patches.pop().cleanup()
 
 
 class TestLibScatterJS(unittest.TestCase):
@@ -11,6 +70,886 @@ class TestLibScatterJS(unittest.TestCase):
         pkg, ver = ScatterJSLib._get_version(self.version_header)
         self.assertEqual(pkg, 'plugin-eosjs2')
         self.assertEqual(ver, '1.5.28')
+    
+    def test_find_banners(self):
+        with TemporaryDirectory() as tmp:
+            head, tail, empty = [os.path.join(tmp, f) for f in ('head.js', 'tail.js', 'empty.js')]
+            with open(head, 'w') as fp:
+                fp.write(self.version_header + 'x' * 100000)
+            with open(tail, 'w') as fp:
+                # Banner is past the scanned header, so it should be found by the mmap fallback
+                fp.write('x' * 100000 + self.version_header)
+            open(empty, 'w').close()
+            res = ScatterJSLib.find_banners([head, tail, empty], ScatterJSLib.vreg)
+        self.assertEqual(res, {head: ('plugin-eosjs2', '1.5.28'), tail: ('plugin-eosjs2', '1.5.28'), empty: None})
+
+
+class TestRegistry(unittest.TestCase):
+    module = '''
+from cdnbuilder.libs.base import BaseLib
+
+class Common(BaseLib):
+    builder = 'YarnBuilder'
+    args = dict(yarn_args=['run', 'build'])
+
+class MyLib(Common):
+    """My example library"""
+    lib_name = 'my-lib'
+    url = 'https://example.com/my-lib.git'
+    subpackages = ['core']
+
+export = MyLib
+'''
+    
+    def test_parse_module(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'mylib.py')
+            with open(path, 'w') as fp:
+                fp.write(self.module)
+            meta = parse_module(path)
+        self.assertEqual(meta['class'], 'MyLib')
+        self.assertEqual(meta['description'], 'My example library')
+        self.assertEqual(meta['lib_name'], 'my-lib')
+        # Inherited from another class in the same module
+        self.assertEqual(meta['builder'], 'YarnBuilder')
+        self.assertEqual(meta['args'], dict(yarn_args=['run', 'build']))
+    
+    def test_builtin_libs(self):
+        with TemporaryDirectory() as tmp:
+            cache = os.path.join(tmp, 'registry.json')
+            libs = Registry(cache).libs()
+            self.assertEqual(libs['scatterjs']['lib_name'], 'scatter-js')
+            self.assertEqual(libs['eosjs']['url'], 'https://github.com/EOSIO/eosjs.git')
+            self.assertTrue(os.path.exists(cache))
+            # A second registry should get the same metadata from the cache
+            self.assertEqual(Registry(cache).libs(), libs)
+    
+    def test_discover_once(self):
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.registry._path_stamp', return_value=[]) as stamp:
+            reg = Registry(os.path.join(tmp, 'registry.json'))
+            for _ in range(3):
+                self.assertEqual(reg.resolve('libs', 'eosjs'), 'cdnbuilder.libs.eosjs:export')
+            self.assertEqual(stamp.call_count, 1)
+            # Unknown names are looked up again, in case they were installed since
+            reg.resolve('libs', 'nonexistent_lib')
+            self.assertEqual(stamp.call_count, 2)
+    
+    def test_list_plan_commands(self):
+        import subprocess
+        import sys
+        with TemporaryDirectory() as tmp:
+            env = dict(os.environ, REGISTRY_CACHE=os.path.join(tmp, 'registry.json'),
+                       MANIFEST_FOLDER=os.path.join(tmp, 'manifests'))
+            run_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+            out = subprocess.run([sys.executable, run_py, 'list', '--json'], env=env, stdout=subprocess.PIPE, check=True)
+            self.assertEqual(json.loads(out.stdout)['eosjs']['lib_name'], 'eosjs')
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'registry.json')))
+            out = subprocess.run([sys.executable, run_py, 'plan', 'scatterjs', 'nonexistent_lib'], env=env,
+                                 stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            self.assertIn('scatterjs (lib_name: scatter-js)', out.stdout)
+            self.assertIn('last build: never', out.stdout)
+            self.assertIn('nonexistent_lib: unknown library', out.stdout)
+
+
+def _timed_build(lib, force=False, revision=None):
+    start = time.time()
+    time.sleep(0.1)
+    with open(os.environ['TEST_BUILD_LOG'], 'a') as fp:
+        fp.write(f'{lib} {start} {time.time()}\n')
+    m = BuildMetrics(lib)
+    m.peak('peak_rss_bytes', 4096)
+    m.peak('avg_cpus', 1.5)
+    m.finish('built')
+    return True, m.to_dict()
+
+
+def _crash_build(lib, force=False, revision=None):
+    if lib == 'crash':
+        # Simulate the worker process being killed, e.g. by the OOM killer
+        os.kill(os.getpid(), signal.SIGKILL)
+    return _timed_build(lib, force, revision)
+
+
+class TestScheduler(unittest.TestCase):
+    def test_failures_isolated(self):
+        # Neither library exists, so both should fail - without the first failure stopping the second build
+        logging.disable(logging.CRITICAL)
+        try:
+            with TemporaryDirectory() as tmp, \
+                    mock.patch('cdnbuilder.settings.RESOURCES_FILE', os.path.join(tmp, 'res.json')), \
+                    mock.patch('cdnbuilder.settings.METRICS_REPORT', os.path.join(tmp, 'last-run.json')):
+                res = build_libs(['nonexistent_lib_a', 'nonexistent_lib_b'], jobs=2)
+                self.assertTrue(os.path.exists(os.path.join(tmp, 'last-run.json')))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(res, {'nonexistent_lib_a': False, 'nonexistent_lib_b': False})
+    
+    def test_resource_budget(self):
+        costs = {'big': (2.0, 1024), 'a': (1.0, 1024), 'b': (1.0, 1024), 'c': (1.0, 1024)}
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.RESOURCES_FILE', os.path.join(tmp, 'res.json')), \
+                mock.patch('cdnbuilder.settings.METRICS_REPORT', None), \
+                mock.patch('cdnbuilder.scheduler._build_worker', _timed_build), \
+                mock.patch('cdnbuilder.scheduler.estimate_cost', lambda l, h: costs[l]), \
+                mock.patch.dict(os.environ, TEST_BUILD_LOG=os.path.join(tmp, 'builds.log')):
+            res = build_libs(['big', 'a', 'b', 'c'], jobs=4, budget=ResourceBudget(cpus=2, memory=10240))
+            self.assertEqual(res, {l: True for l in costs})
+            with open(os.path.join(tmp, 'builds.log')) as fp:
+                runs = [(l, float(start), float(end)) for l, start, end in (line.split() for line in fp)]
+            # At no point should the running builds have used more than the 2 CPU budget
+            for _, t, _ in runs:
+                self.assertLessEqual(sum(costs[l][0] for l, start, end in runs if start <= t < end), 2)
+            self.assertEqual(ResourceHistory().measured('big'), (1.5, 4096))
+    
+    def test_worker_crash(self):
+        costs = {'crash': (2.0, 1024), 'a': (1.0, 1024), 'b': (1.0, 1024)}
+        logging.disable(logging.CRITICAL)
+        try:
+            with TemporaryDirectory() as tmp, \
+                    mock.patch('cdnbuilder.settings.RESOURCES_FILE', os.path.join(tmp, 'res.json')), \
+                    mock.patch('cdnbuilder.settings.METRICS_REPORT', None), \
+                    mock.patch('cdnbuilder.scheduler._build_worker', _crash_build), \
+                    mock.patch('cdnbuilder.scheduler.estimate_cost', lambda l, h: costs[l]), \
+                    mock.patch.dict(os.environ, TEST_BUILD_LOG=os.path.join(tmp, 'builds.log')):
+                # 'crash' needs the whole budget, so it runs alone - the other libraries are built in a new pool
+                res = build_libs(['crash', 'a', 'b'], jobs=2, budget=ResourceBudget(cpus=2, memory=10240))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(res, {'crash': False, 'a': True, 'b': True})
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stages_and_prometheus(self):
+        m = BuildMetrics('my"lib')
+        for _ in range(2):
+            with m.stage('identify'):
+                pass
+        m.add_time('download', 1.5)
+        m.incr('bytes_published', 100)
+        m.finish('built')
+        d = m.to_dict()
+        self.assertEqual(set(d['stages'].keys()), {'identify', 'download'})
+        self.assertEqual(d['counters'], {'bytes_published': 100})
+        text = prometheus_text([d], finished_at=1)
+        self.assertIn('cdnbuilder_stage_duration_seconds{lib="my\\"lib",stage="download"} 1.5\n', text)
+        self.assertIn('cdnbuilder_published_bytes{lib="my\\"lib"} 100\n', text)
+        self.assertIn('cdnbuilder_build_success{lib="my\\"lib"} 1\n', text)
+
+
+class TestCommandHelper(unittest.TestCase):
+    class Shell(CommandHelper):
+        default_command = 'sh'
+        out_dir = None
+    
+    def test_capture(self):
+        stdout, _, _ = self.Shell()._call('-c', 'echo hello; echo world')
+        self.assertEqual(stdout, b'hello\nworld\n')
+        # Without capture, only the tail of the output is kept
+        stdout, _, _ = self.Shell()._call('-c', 'seq 1 500', capture=False)
+        self.assertEqual(stdout.split(), [str(i).encode() for i in range(451, 501)])
+        stdout, _, _ = self.Shell()._call('-c', 'seq 1 500')
+        self.assertEqual(len(stdout.split()), 500)
+    
+    def test_missing_command(self):
+        from cdnbuilder import core
+        with TemporaryDirectory() as tmp, \
+                mock.patch.object(core._CommandOutput, 'close', autospec=True, side_effect=core._CommandOutput.close) \
+                as close, self.assertRaises(FileNotFoundError):
+            sh = self.Shell()
+            sh.log_file = os.path.join(tmp, 'build.log')
+            sh._call_raw('cdnbuilder-no-such-command')
+        # The log file is closed, even though the command never started
+        self.assertTrue(close.call_args[0][0].log_fp.closed)
+    
+    def test_error_output_tail(self):
+        with self.assertRaises(BuildError) as e:
+            self.Shell()._call('-c', 'seq 1 500; exit 3')
+        self.assertEqual(e.exception.returncode, 3)
+        self.assertEqual(len(e.exception.output), settings.CMD_TAIL_LINES)
+        self.assertEqual(e.exception.output[-1], '500')
+    
+    def test_long_lines_split(self):
+        with self.assertRaises(BuildError) as e:
+            self.Shell()._call('-c', "head -c 200000 /dev/zero | tr '\\0' a; exit 1")
+        self.assertEqual([len(l) for l in e.exception.output], [65536, 65536, 65536, 3392])
+    
+    def test_kill_on_error(self):
+        from cdnbuilder import core
+        call_sys, procs = core.call_sys, []
+        with mock.patch('cdnbuilder.core._CommandOutput.feed', side_effect=ValueError), \
+                mock.patch('cdnbuilder.core.call_sys', side_effect=lambda *a, **kw: procs.append(call_sys(*a, **kw))
+                           or procs[-1]), \
+                self.assertRaises(ValueError):
+            self.Shell()._call('-c', 'echo hello; exec sleep 30')
+        # The command was killed and reaped, rather than left running
+        self.assertEqual(procs[0].returncode, -9)
+    
+    def test_async_call(self):
+        stdout, _, h = asyncio.run(self.Shell()._acall('-c', 'echo hello; echo world', capture=True))
+        self.assertEqual(stdout, b'hello\nworld\n')
+        with self.assertRaises(BuildError):
+            asyncio.run(self.Shell()._acall('-c', 'exit 1'))
+    
+    def test_peak_usage(self):
+        sh = self.Shell()
+        sh.metrics = BuildMetrics('test')
+        # The shell waits for python, so python's memory usage counts towards the command's peak
+        sh._call('-c', 'python3 -c "x = bytearray(64 * 1024 * 1024)"')
+        self.assertGreaterEqual(sh.metrics.counters['peak_rss_bytes'], 64 * 1024 * 1024)
+        self.assertIn('avg_cpus', sh.metrics.counters)
+
+
+def _git(*args, cwd=None) -> str:
+    out = subprocess.run(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@localhost', '-c', 'init.defaultBranch=master', *args],
+        cwd=cwd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    return out.stdout.decode().strip()
+
+
+def _make_repo(folder: str) -> dict:
+    """
+    Create a git repo in ``folder`` with a lightweight tag ``v1.0.0``, an annotated tag ``v1.1.0`` and a branch
+    ``dev`` - returns the commit hash of each (and of ``master``)
+    """
+    os.makedirs(folder)
+    _git('init', '-q', cwd=folder)
+    commits = {}
+    for name in ['v1.0.0', 'v1.1.0', 'master']:
+        with open(os.path.join(folder, 'version.txt'), 'w') as fp:
+            fp.write(name)
+        _git('add', '-A', cwd=folder)
+        _git('commit', '-q', '-m', f'Release {name}', cwd=folder)
+        commits[name] = _git('rev-parse', 'HEAD', cwd=folder)
+    _git('tag', 'v1.0.0', commits['v1.0.0'], cwd=folder)
+    _git('tag', '-a', '-m', 'Version 1.1.0', 'v1.1.0', commits['v1.1.0'], cwd=folder)
+    _git('branch', 'dev', commits['v1.0.0'], cwd=folder)
+    commits['dev'] = commits['v1.0.0']
+    return commits
+
+
+class TestBackfill(unittest.TestCase):
+    def test_match_versions(self):
+        tags = ['v1.10.0', 'v1.9.0', 'v2.0.0-beta.1', 'v2.0.0', 'v2.1.0', 'other']
+        self.assertEqual(match_versions(tags, 'v1.*, v2.0.*'), ['v1.9.0', 'v1.10.0', 'v2.0.0-beta.1', 'v2.0.0'])
+        self.assertEqual(match_versions(tags, ['v2.1.0', 'v3.*']), ['v2.1.0'])
+        with self.assertRaises(DownloadError):
+            match_versions(tags, 'v3.0.0')
+    
+    def test_clone_tags(self):
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.BUILD_FOLDER', tmp), \
+                mock.patch('cdnbuilder.settings.GIT_MIRROR', False):
+            commits = _make_repo(os.path.join(tmp, 'upstream'))
+            lib = type('RepoLib', (DummyLib,), dict(url='file://' + os.path.join(tmp, 'upstream')))
+            with mock.patch('cdnbuilder.backfill.load_lib', return_value=lib):
+                bf = Backfill('dummy', 'v1.*')
+            try:
+                bf.clone()
+                self.assertEqual(bf.tags(), ['v1.0.0', 'v1.1.0'])
+                self.assertEqual(bf.commit('v1.1.0'), commits['v1.1.0'])
+            finally:
+                bf.lib.temp_dir_obj.cleanup()
+    
+    def test_cleanup_error_keeps_result(self):
+        from cdnbuilder import backfill
+        logging.disable(logging.CRITICAL)
+        try:
+            with mock.patch('cdnbuilder.backfill.load_lib', return_value=DummyLib), \
+                    mock.patch('cdnbuilder.backfill._Worktree.add'), \
+                    mock.patch('cdnbuilder.backfill._Worktree.remove', side_effect=OSError('prune failed')), \
+                    mock.patch('cdnbuilder.backfill.publish_lib', return_value=[]), \
+                    mock.patch('cdnbuilder.backfill.record_build'):
+                ok, metrics = backfill._backfill_worker('dummy', '/nonexistent', 'v1.0.0')
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertTrue(ok)
+        self.assertEqual(metrics['status'], 'built')
+
+
+class TestGitMirror(unittest.TestCase):
+    def test_update_clone(self):
+        with TemporaryDirectory() as tmp:
+            work, upstream = os.path.join(tmp, 'work'), os.path.join(tmp, 'upstream.git')
+            commits = _make_repo(work)
+            _git('clone', '-q', '--bare', work, upstream)
+            url = 'file://' + upstream
+            mirror = GitMirror(url, cache_dir=os.path.join(tmp, 'mirrors'))
+            mirror.update()
+            self.assertTrue(mirror.exists)
+            mirror.clone(os.path.join(tmp, 'clone1'))
+            self.assertEqual(_git('rev-parse', 'HEAD', cwd=os.path.join(tmp, 'clone1')), commits['master'])
+            
+            # Push a new commit upstream - the next update fetches it into the existing mirror
+            _git('commit', '-q', '--allow-empty', '-m', 'New commit', cwd=work)
+            _git('push', '-q', upstream, 'master', cwd=work)
+            new = _git('rev-parse', 'HEAD', cwd=work)
+            mirror.update()
+            clone = mirror.clone(os.path.join(tmp, 'clone2'), '--no-checkout')
+            self.assertEqual(_git('rev-parse', 'origin/master', cwd=clone), new)
+            self.assertEqual(_git('rev-parse', 'v1.1.0^{commit}', cwd=clone), commits['v1.1.0'])
+            # The clone's origin is the real upstream, not the local mirror
+            self.assertEqual(_git('remote', 'get-url', 'origin', cwd=clone), url)
+            
+            # Updates wait for the mirror's lock, e.g. while another build is cloning from it
+            with file_lock(mirror.lock_path, shared=True):
+                t = threading.Thread(target=mirror.update)
+                t.start()
+                t.join(0.3)
+                self.assertTrue(t.is_alive())
+            t.join(10)
+            self.assertFalse(t.is_alive())
+
+
+class TestGitDownloader(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = TemporaryDirectory()
+        cls.url = 'file://' + os.path.join(cls.tmp.name, 'upstream')
+        cls.commits = _make_repo(os.path.join(cls.tmp.name, 'upstream'))
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+    
+    def test_clone_modes(self):
+        refs = dict(branch='dev', lightweight='v1.0.0', annotated='v1.1.0', sha=self.commits['master'])
+        # Each commit writes it's own name into version.txt
+        names = {c: n for n, c in self.commits.items() if n != 'dev'}
+        with mock.patch('cdnbuilder.settings.GIT_MIRROR', False):
+            for mode in CLONE_MODES:
+                for kind, ref in refs.items():
+                    with self.subTest(mode=mode, ref=kind), TemporaryDirectory() as dest:
+                        dl = GitDownloader('repo', self.url, ref=ref, clone_mode=mode)
+                        dl.download(out_dir=dest)
+                        expected = self.commits.get(ref, ref)
+                        self.assertEqual(dl.revision(), expected)
+                        with open(os.path.join(dest, 'version.txt')) as fp:
+                            self.assertEqual(fp.read(), names[expected])
+                        if mode == 'shallow':
+                            self.assertEqual(_git('rev-list', '--count', 'HEAD', cwd=dest), '1')
+    
+    def test_abbreviated_commit(self):
+        short = self.commits['v1.1.0'][:10]
+        with TemporaryDirectory() as dest:
+            dl = GitDownloader('repo', self.url, ref=short, clone_mode='blobless')
+            dl.download(out_dir=dest)
+            self.assertEqual(dl.revision(), self.commits['v1.1.0'])
+        for mode in ['shallow', 'single-branch']:
+            with TemporaryDirectory() as dest, self.assertRaises(DownloadError):
+                GitDownloader('repo', self.url, ref=short, clone_mode=mode).download(out_dir=dest)
+    
+    def test_remote_revision(self):
+        for ref, expected in [('v1.1.0', self.commits['v1.1.0']), ('v1.0.0', self.commits['v1.0.0']),
+                              ('dev', self.commits['dev']), (None, self.commits['master']), ('missing', None)]:
+            self.assertEqual(GitDownloader('repo', self.url, ref=ref).remote_revision(), expected)
+        # The annotated tag is a separate object to the commit it points to
+        self.assertNotEqual(_git('rev-parse', 'v1.1.0', cwd=os.path.join(self.tmp.name, 'upstream')),
+                            self.commits['v1.1.0'])
+        sha = self.commits['master']
+        self.assertEqual(GitDownloader('repo', self.url, ref=sha).remote_revision(), sha)
+        self.assertIsNone(GitDownloader('repo', self.url, ref=sha[:10]).remote_revision())
+
+
+class TestBuildManifest(unittest.TestCase):
+    key = dict(lib='eosjs', commit='8a6c15ec616f0266d4d73fc4c8d405dba5fdf8fb', builder='YarnBuilder', args={})
+    
+    def test_record_is_built(self):
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.OUT_FOLDER', tmp):
+            m = BuildManifest('eosjs', folder=tmp)
+            self.assertFalse(m.is_built(self.key))
+            os.makedirs(os.path.join(tmp, 'eosjs', '1.0.0'))
+            open(os.path.join(tmp, 'eosjs', '1.0.0', 'eosjs-api.js'), 'w').close()
+            m.record(self.key, files=['eosjs/1.0.0/eosjs-api.js'], lockfile=None)
+            self.assertTrue(m.is_built(self.key))
+            self.assertFalse(m.is_built({**self.key, 'commit': 'f235203da7fc749cd2840be6f12142a4c7f32171'}))
+            # If the published output is deleted, the library needs to be built again
+            os.remove(os.path.join(tmp, 'eosjs', '1.0.0', 'eosjs-api.js'))
+            self.assertFalse(m.is_built(self.key))
+
+
+class TestNodeModulesCache(unittest.TestCase):
+    @staticmethod
+    def _make_project(folder: str, lock: str):
+        os.makedirs(os.path.join(folder, 'node_modules', 'dep'))
+        with open(os.path.join(folder, 'yarn.lock'), 'w') as fp:
+            fp.write(lock)
+        with open(os.path.join(folder, 'node_modules', 'dep', 'index.js'), 'w') as fp:
+            fp.write('module.exports = 1;')
+    
+    def test_save_restore_evict(self):
+        with TemporaryDirectory() as tmp:
+            cache = NodeModulesCache(cache_dir=os.path.join(tmp, 'cache'), max_size=2 ** 30, max_entries=1)
+            p1, p2, p3 = [os.path.join(tmp, f'proj{i}') for i in range(3)]
+            self._make_project(p1, 'lock-a')
+            self._make_project(p2, 'lock-b')
+            os.makedirs(p3)
+            key_a, key_b = cache.make_key(p1), cache.make_key(p2)
+            self.assertNotEqual(key_a, key_b)
+            
+            cache.save(key_a, p1)
+            self.assertTrue(cache.restore(key_a, p3))
+            self.assertTrue(os.path.exists(os.path.join(p3, 'node_modules', 'dep', 'index.js')))
+            # Builds may write to node_modules, so the restored files must never share the cached copy's inode
+            self.assertEqual(os.stat(os.path.join(p3, 'node_modules', 'dep', 'index.js')).st_nlink, 1)
+            # max_entries is 1, so saving a second entry should evict the first
+            cache.save(key_b, p2)
+            self.assertEqual(len(cache.entries()), 1)
+            self.assertFalse(cache.restore(key_a, p3))
+    
+    def test_failed_save_cleaned_up(self):
+        with TemporaryDirectory() as tmp:
+            cache = NodeModulesCache(cache_dir=os.path.join(tmp, 'cache'))
+            self._make_project(os.path.join(tmp, 'proj'), 'lock-a')
+            key = cache.make_key(os.path.join(tmp, 'proj'))
+            with mock.patch('cdnbuilder.cache.dir_size', side_effect=OSError(28, 'No space left on device')), \
+                    self.assertRaises(OSError):
+                cache.save(key, os.path.join(tmp, 'proj'))
+            self.assertEqual(os.listdir(os.path.join(tmp, 'cache')), [])
+
+    def test_key_ignores_version(self):
+        with TemporaryDirectory() as tmp:
+            cache, keys = NodeModulesCache(cache_dir=os.path.join(tmp, 'cache')), []
+            for i, pkg in enumerate(['{"version": "1.0.0", "dependencies": {"a": "^1"}}',
+                                     '{"version": "1.1.0", "dependencies": {"a": "^1"}}',
+                                     '{"version": "1.1.0", "dependencies": {"a": "^2"}}']):
+                folder = os.path.join(tmp, f'proj{i}')
+                self._make_project(folder, 'lock-a')
+                with open(os.path.join(folder, 'package.json'), 'w') as fp:
+                    fp.write(pkg)
+                keys.append(cache.make_key(folder))
+            self.assertEqual(keys[0], keys[1])
+            self.assertNotEqual(keys[1], keys[2])
+
+
+class TestBlobStore(unittest.TestCase):
+    def test_dedupe_cleanup(self):
+        with TemporaryDirectory() as tmp:
+            store = BlobStore(root=os.path.join(tmp, '.blobs'))
+            src = os.path.join(tmp, 'src.js')
+            with open(src, 'w') as fp:
+                fp.write('console.log(1);')
+            d1, _ = store.publish(src, os.path.join(tmp, 'v1.js'))
+            d2, mode = store.publish(src, os.path.join(tmp, 'v2.js'))
+            self.assertEqual(d1, d2)
+            self.assertEqual(mode, 'dedupe')
+            self.assertTrue(os.path.samefile(os.path.join(tmp, 'v1.js'), os.path.join(tmp, 'v2.js')))
+            # The blob is still referenced by v2.js, so it shouldn't be removed until that's gone too
+            os.remove(src)
+            os.remove(os.path.join(tmp, 'v1.js'))
+            self.assertEqual(store.cleanup()[0], 0)
+            os.remove(os.path.join(tmp, 'v2.js'))
+            self.assertEqual(store.cleanup()[0], 1)
+            self.assertFalse(os.path.exists(store.blob_path(d1)))
+
+
+class TestCompress(unittest.TestCase):
+    def test_gzip_variants(self):
+        import gzip
+        with TemporaryDirectory() as tmp:
+            js, txt = os.path.join(tmp, 'lib.js'), os.path.join(tmp, 'README.txt')
+            for f in (js, txt):
+                with open(f, 'w') as fp:
+                    fp.write('console.log(1);' * 100)
+            # Small chunks, so the file is compressed in many pieces
+            with mock.patch('cdnbuilder.compress.CHUNK_SIZE', 7):
+                self.assertEqual(compress_files([js, txt], formats=['gz'], jobs=1), [js + '.gz'])
+            with gzip.open(js + '.gz', 'rt') as fp:
+                self.assertEqual(fp.read(), 'console.log(1);' * 100)
+            # The variant is up to date, so it shouldn't be generated again
+            self.assertEqual(compress_files([js], formats=['gz'], jobs=1), [])
+
+
+class DummyLib(BaseLib):
+    builder = 'YarnBuilder'
+    lib_name = 'dummy'
+    
+    def identify(self, folder: str, package: str = None):
+        pass
+
+
+class TestPublish(unittest.TestCase):
+    def test_version_key(self):
+        versions = ['1.10.0', '1.9.2', 'v2.0.0', '2.0.0-beta.1']
+        self.assertEqual(sorted(versions, key=version_key), ['1.9.2', '1.10.0', '2.0.0-beta.1', 'v2.0.0'])
+    
+    def test_staged_publish_latest(self):
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.OUT_FOLDER', tmp), \
+                mock.patch('cdnbuilder.settings.DEDUPE_OUTPUT', False), mock.patch('cdnbuilder.settings.COMPRESS', False):
+            lib, src = DummyLib(), os.path.join(tmp, 'dummy.js')
+            for ver in ['2.0.0', '1.0.0']:
+                # Published files may be hardlinks to the source, so replace it rather than writing in-place
+                if os.path.exists(src):
+                    os.remove(src)
+                with open(src, 'w') as fp:
+                    fp.write(ver)
+                published = publish_lib(lib, [FileOutput(src=src, version=ver, link_root=True)])
+                self.assertEqual(published, [f'dummy/{ver}/dummy.js'])
+            # Publishing an older version shouldn't move the latest pointer backwards
+            with open(os.path.join(tmp, 'dummy', 'dummy.js')) as fp:
+                self.assertEqual(fp.read(), '2.0.0')
+            self.assertEqual(os.readlink(os.path.join(tmp, 'dummy', 'latest')), '2.0.0')
+            # No staging folders or lock files are left inside of the (served) output folder
+            self.assertEqual([d for d in os.listdir(os.path.join(tmp, 'dummy')) if d.startswith('.')], [])
+            self.assertEqual([d for d in os.listdir(tmp) if d.startswith('.')], [])
+            self.assertEqual(os.listdir(settings.STAGING_FOLDER), [])
+    
+    def test_prune_aliases(self):
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.OUT_FOLDER', tmp), \
+                mock.patch('cdnbuilder.settings.DEDUPE_OUTPUT', False), mock.patch('cdnbuilder.settings.COMPRESS', False):
+            lib, lib_folder = DummyLib(), os.path.join(tmp, 'dummy')
+            for ver, names in [('1.0.0', ['a.js', 'b.js']), ('2.0.0', ['a.js'])]:
+                files = []
+                for name in names:
+                    src = os.path.join(tmp, ver, name)
+                    os.makedirs(os.path.dirname(src), exist_ok=True)
+                    with open(src, 'w') as fp:
+                        fp.write(ver)
+                    files.append(FileOutput(src=src, version=ver, link_root=True))
+                publish_lib(lib, files)
+            # b.js isn't in the new latest version, so it's alias would be dangling
+            self.assertFalse(os.path.lexists(os.path.join(lib_folder, 'b.js')))
+            with open(os.path.join(lib_folder, 'a.js')) as fp:
+                self.assertEqual(fp.read(), '2.0.0')
+            self.assertTrue(os.path.exists(os.path.join(lib_folder, '1.0.0', 'b.js')))
+    
+    def test_output_index(self):
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.OUT_FOLDER', tmp), \
+                mock.patch('cdnbuilder.settings.DEDUPE_OUTPUT', False), mock.patch('cdnbuilder.settings.COMPRESS', False):
+            lib, src = DummyLib(), os.path.join(tmp, 'dummy.js')
+            with open(src, 'w') as fp:
+                fp.write('hello')
+            publish_lib(lib, [FileOutput(src=src, version='1.0.0', package='core')])
+            publish_lib(lib, [FileOutput(src=src, version='1.2.0', package='core')])
+            root = OutputIndex.load_root(tmp)
+            self.assertEqual(root['libs']['dummy']['packages']['core'], dict(latest='1.2.0', versions=['1.0.0', '1.2.0']))
+            entry = OutputIndex('dummy', tmp).load()['packages']['core']['versions']['1.0.0']['files']['dummy.js']
+            self.assertEqual(entry['path'], 'dummy/core/1.0.0/dummy.js')
+            self.assertEqual(entry['size'], 5)
+            self.assertEqual(entry['sha256'], hashlib.sha256(b'hello').hexdigest())
+            self.assertEqual(entry['sri'], 'sha384-' + base64.b64encode(hashlib.sha384(b'hello').digest()).decode())
+    
+    def test_streaming_outputs(self):
+        class SubLib(DummyLib):
+            subpackages = ['a', 'b', 'c']
+            include_main = False
+            
+            def identify(self, folder: str, package: str = None):
+                src = os.path.join(folder, f'{package}.js')
+                with open(src, 'w') as fp:
+                    fp.write(package)
+                return package, '1.0.0', [src]
+        
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.OUT_FOLDER', tmp), \
+                mock.patch('cdnbuilder.settings.DEDUPE_OUTPUT', False), mock.patch('cdnbuilder.settings.COMPRESS', False):
+            lib = SubLib()
+            published = publish_lib(lib, lib.iter_outputs(tmp))
+        self.assertEqual(sorted(published), ['dummy/a/1.0.0/a.js', 'dummy/b/1.0.0/b.js', 'dummy/c/1.0.0/c.js'])
+    
+    def test_stream_publish(self):
+        import gzip
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.OUT_FOLDER', tmp), \
+                mock.patch('cdnbuilder.settings.BLOB_FOLDER', os.path.join(tmp, '.blobs')), \
+                mock.patch('cdnbuilder.settings.COMPRESS_FORMATS', ['gz']), \
+                mock.patch('cdnbuilder.settings.STREAM_PUBLISH', True):
+            lib, src = DummyLib(), os.path.join(tmp, 'dummy.js')
+            data = b'console.log(1);' * 100000
+            with open(src, 'wb') as fp:
+                fp.write(data)
+            for ver in ['1.0.0', '1.1.0']:
+                publish_lib(lib, [FileOutput(src=src, version=ver)])
+            out_file = os.path.join(tmp, 'dummy', '1.0.0', 'dummy.js')
+            with gzip.open(out_file + '.gz', 'rb') as fp:
+                self.assertEqual(fp.read(), data)
+            # Both versions (and the blob) are the same file, and so are their variants
+            self.assertEqual(os.stat(out_file).st_nlink, 3)
+            self.assertEqual(os.stat(out_file + '.gz').st_nlink, 3)
+            entry = OutputIndex('dummy', tmp).load()['packages']['']['versions']['1.0.0']['files']['dummy.js']
+            self.assertEqual(entry['sha256'], hashlib.sha256(data).hexdigest())
+            self.assertEqual(entry['sri'], 'sha384-' + base64.b64encode(hashlib.sha384(data).digest()).decode())
+            self.assertEqual(entry['mtime'], int(os.stat(out_file).st_mtime))
+            with open(out_file + '.gz', 'rb') as fp:
+                gz = fp.read()
+            self.assertEqual(entry['variants']['gz'], dict(size=len(gz), sha256=hashlib.sha256(gz).hexdigest()))
+
+
+class TestGarbageCollector(unittest.TestCase):
+    def test_retention_and_orphans(self):
+        with TemporaryDirectory() as out, TemporaryDirectory() as build, \
+                mock.patch('cdnbuilder.settings.OUT_FOLDER', out), mock.patch('cdnbuilder.settings.BUILD_FOLDER', build), \
+                mock.patch('cdnbuilder.settings.BLOB_FOLDER', os.path.join(out, '.blobs')), \
+                mock.patch('cdnbuilder.settings.COMPRESS', False), \
+                mock.patch.object(GarbageCollector, '_lib_meta', return_value={}):
+            lib = DummyLib()
+            for ver in ['1.0.0', '1.1.0', '1.2.0', '1.3.0']:
+                src = os.path.join(build, f'src-{ver}.js')
+                with open(src, 'w') as fp:
+                    fp.write(ver)
+                publish_lib(lib, [FileOutput(src=src, version=ver, link_root=True)])
+            # An orphan from a process which no longer exists, and a folder from a build which is still running
+            orphan, running = os.path.join(build, 'cdnbuilder-dummy-999999999-abc'), lib.temp_dir
+            os.makedirs(orphan)
+            for d in (orphan, running):
+                os.utime(d, (0, 0))
+            
+            res = GarbageCollector(max_age=1, keep_versions=2, budget=0, pinned=['dummy@1.0.0']).run()
+            self.assertEqual(res['build_dirs'][0], 1)
+            self.assertEqual(res['versions'][0], 1)
+            self.assertFalse(os.path.exists(orphan))
+            self.assertTrue(os.path.exists(running))
+            self.assertEqual(sorted(d for d in os.listdir(os.path.join(out, 'dummy')) if d[0].isdigit()),
+                             ['1.0.0', '1.2.0', '1.3.0'])
+            self.assertEqual(OutputIndex.load_root(out)['libs']['dummy']['packages']['']['versions'],
+                             ['1.0.0', '1.2.0', '1.3.0'])
+            # The only remaining unpinned old version is removed to fit in the budget, but never the latest one
+            res = GarbageCollector(keep_versions=0, budget=1, pinned=['dummy@1.0.0']).run()
+            self.assertEqual(res['versions'][0], 1)
+            self.assertEqual(sorted(d for d in os.listdir(os.path.join(out, 'dummy')) if d[0].isdigit()),
+                             ['1.0.0', '1.3.0'])
+
+
+
+def _fake_build(lib, force=False, metrics=None):
+    if lib.startswith('bad'):
+        raise BuildError(f'{lib} failed')
+    metrics.incr('files_published', 1)
+
+
+class TestJobQueue(unittest.TestCase):
+    def test_lease_expiry(self):
+        with TemporaryDirectory() as tmp:
+            q = JobQueue(os.path.join(tmp, 'queue.sqlite3'), lease_time=0.05)
+            self.assertEqual(q.enqueue(['lib1', 'lib1']), [1, 1])
+            self.assertEqual(q.claim('dead-worker')['lib'], 'lib1')
+            self.assertIsNone(q.claim('worker-2'))
+            time.sleep(0.1)
+            # The dead worker's lease expired, so the job is handed to the next worker - and the late result ignored
+            job = q.claim('worker-2')
+            self.assertEqual((job['id'], job['attempts']), (1, 2))
+            self.assertFalse(q.complete(1, 'dead-worker', ok=True))
+            self.assertTrue(q.heartbeat(1, 'worker-2'))
+            self.assertTrue(q.complete(1, 'worker-2', ok=True, result={'status': 'built'}))
+            self.assertEqual(q.jobs()[0]['result'], {'status': 'built'})
+            self.assertEqual(q.stats(), {'queued': 0, 'running': 0, 'done': 1, 'failed': 0})
+
+    @mock.patch('cdnbuilder.jobqueue.build_lib', _fake_build)
+    def test_local_workers(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'queue.sqlite3')
+            q = JobQueue(path)
+            q.enqueue([f'lib{i}' for i in range(8)] + ['bad1'])
+            run_workers(3, path=path, exit_when_empty=True)
+            self.assertEqual(q.stats(), {'queued': 0, 'running': 0, 'done': 8, 'failed': 1})
+            jobs = {j['lib']: j for j in q.jobs()}
+            self.assertEqual(jobs['bad1']['error'], 'BuildError: bad1 failed')
+            self.assertEqual(jobs['lib0']['result']['counters'], {'files_published': 1})
+            self.assertTrue(all(j['attempts'] == 1 for j in jobs.values()))
+
+
+
+class TestWatcher(unittest.TestCase):
+    @mock.patch('cdnbuilder.watch.load_lib', side_effect=lambda name: type(name, (DummyLib,), dict(lib_name=name)))
+    def test_poll_changes(self, _):
+        commit = 'a' * 40
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.MANIFEST_FOLDER', tmp), \
+                mock.patch('cdnbuilder.settings.OUT_FOLDER', tmp), mock.patch('cdnbuilder.settings.BUILD_FOLDER', tmp), \
+                mock.patch('cdnbuilder.downloaders.GitDownloader.GitDownloader.remote_revision', return_value=commit) as remote, \
+                mock.patch('cdnbuilder.watch.build_libs', side_effect=lambda libs, **kw: {l: False for l in libs}) as build:
+            w = Watcher(['dummy', 'dummy2'], retry_after=3600)
+            self.assertEqual(w.poll(), {'dummy': commit, 'dummy2': commit})
+            # Both libraries share the same repo + ref, so it's only looked up once per poll
+            self.assertEqual(remote.call_count, 1)
+            # Failed builds of the same commit aren't retried straight away
+            w.run_once()
+            self.assertEqual(w.poll(), {})
+            w.failed.clear()
+            BuildManifest('dummy').record(DummyLib().build_key(commit), files=[])
+            self.assertEqual(w.run_once(), {'dummy2': commit})
+            self.assertEqual(build.call_count, 2)
+            # The builds are given the polled revisions, rather than running 'git ls-remote' again
+            self.assertEqual(build.call_args[1]['revisions'], {'dummy2': commit})
+
+
+
+def _make_tarball(files: dict) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+class NpmLib(BaseLib):
+    builder = 'NoopBuilder'
+    lib_name = 'npmlib'
+    url = '@test/pkg'
+    downloader_cls = NpmTarballDownloader
+    
+    def identify(self, folder: str, package: str = None):
+        pass
+
+
+class TestNpmTarballDownloader(unittest.TestCase):
+    """Tests against a local stand-in for the npm registry"""
+    routes = {}
+    auth = {}
+    connections = 0
+    
+    @classmethod
+    def setUpClass(cls):
+        test = cls
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def setup(self):
+                super().setup()
+                test.connections += 1
+            
+            def do_GET(self):
+                test.auth[self.path] = self.headers.get('Authorization')
+                status, body = test.routes.get(self.path, (404, b'{}'))
+                self.send_response(status)
+                if status in (301, 302):
+                    self.send_header('Location', body.decode())
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.registry = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+    
+    def _publish(self, tarballs: dict):
+        versions = {}
+        for ver, (tarball, integrity) in tarballs.items():
+            integrity = integrity or 'sha512-' + base64.b64encode(hashlib.sha512(tarball).digest()).decode()
+            self.routes[f'/pkg-{ver}.tgz'] = (200, tarball)
+            versions[ver] = dict(version=ver, dist=dict(tarball=f'{self.registry}/pkg-{ver}.tgz', integrity=integrity))
+        self.routes['/@test%2Fpkg'] = (200, json.dumps({'dist-tags': {'latest': '1.2.0'}, 'versions': versions}).encode())
+    
+    def test_download_prebuilt(self):
+        self._publish({'1.2.0': (_make_tarball({'package/package.json': b'{}', 'package/dist/pkg.js': b'x'}), None)})
+        with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.NPM_REGISTRY', self.registry), \
+                mock.patch('cdnbuilder.settings.BUILD_FOLDER', tmp):
+            conns = self.connections
+            lib = NpmLib()
+            self.assertEqual(lib.build_key()['commit'], '1.2.0')
+            dest = lib.run_builder(lib.download())
+            with open(os.path.join(dest, 'dist', 'pkg.js')) as fp:
+                self.assertEqual(fp.read(), 'x')
+            self.assertEqual(lib.downloader.revision(), '1.2.0')
+            # The metadata and tarball requests share a single pooled connection
+            self.assertEqual(self.connections - conns, 1)
+    
+    def test_rejects_bad_tarballs(self):
+        good = _make_tarball({'package/dist/pkg.js': b'x'})
+        self._publish({
+            '1.0.0': (good, 'sha512-' + base64.b64encode(hashlib.sha512(b'other').digest()).decode()),
+            '1.1.0': (_make_tarball({'package/../../evil.js': b'x'}), None),
+        })
+        for ver in ['1.0.0', '1.1.0', '9.9.9']:
+            with TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.BUILD_FOLDER', tmp):
+                dl = NpmTarballDownloader('npmlib', '@test/pkg', ref=ver, registry=self.registry)
+                with self.assertRaises(DownloadError):
+                    dl.download(out_dir=os.path.join(tmp, 'out'))
+                self.assertFalse(os.path.exists(os.path.join(tmp, 'evil.js')))
+    
+    def test_token_stays_on_registry(self):
+        # 'localhost' is the same server, but a different origin than the registry's '127.0.0.1'
+        other = self.registry.replace('127.0.0.1', 'localhost')
+        self.routes['/hop'] = (302, f'{other}/landed'.encode())
+        self.routes['/landed'] = (200, b'ok')
+        dl = NpmTarballDownloader('npmlib', '@test/pkg', registry=self.registry, token='s3cret')
+        with dl.pool.request('GET', f'{self.registry}/hop', headers=dl.headers(f'{self.registry}/hop')) as res:
+            self.assertEqual(res.read(), b'ok')
+        self.assertEqual(self.auth['/hop'], 'Bearer s3cret')
+        self.assertIsNone(self.auth['/landed'])
+        self.assertNotIn('Authorization', dl.headers(f'{other}/pkg-1.2.0.tgz'))
+        self.assertIn('Authorization', dl.headers(f'{self.registry}/pkg-1.2.0.tgz'))
+
+
+
+class TestSyncer(unittest.TestCase):
+    def test_delta_sync(self):
+        with TemporaryDirectory() as out, TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.OUT_FOLDER', out), \
+                mock.patch('cdnbuilder.settings.BUILD_FOLDER', tmp), mock.patch('cdnbuilder.settings.COMPRESS', False), \
+                mock.patch('cdnbuilder.settings.BLOB_FOLDER', os.path.join(out, '.blobs')), \
+                mock.patch('cdnbuilder.settings.SYNC_PURGE_FILE', os.path.join(tmp, 'purge.txt')):
+            lib, targets = DummyLib(), [os.path.join(tmp, 'origin1'), os.path.join(tmp, 'origin2')]
+            syncer = Syncer(targets, state_folder=os.path.join(tmp, 'state'))
+            
+            def publish(ver):
+                src = os.path.join(tmp, f'dummy-{ver}.js')
+                with open(src, 'w') as fp:
+                    fp.write(ver)
+                publish_lib(lib, [FileOutput(src=src, version=ver, link_root=True)])
+            
+            publish('1.0.0')
+            res = syncer.run()
+            self.assertEqual(res['targets'][targets[0]]['copied'], 3)   # The version file + 2 index files
+            self.assertEqual(res['purge'], [])
+            for t in targets:
+                with open(os.path.join(t, 'dummy', 'dummy-1.0.0.js')) as fp:
+                    self.assertEqual(fp.read(), '1.0.0')
+                self.assertFalse(os.path.exists(os.path.join(t, '.blobs')))
+                # Targets are independent copies, never hardlinked to the (de-duplicated) output files
+                self.assertEqual(os.stat(os.path.join(t, 'dummy', '1.0.0', 'dummy-1.0.0.js')).st_nlink, 1)
+            
+            # Only the new version and the index files are copied - and the paths served through 'latest' are purged
+            publish('1.1.0')
+            res = syncer.run()
+            self.assertEqual(res['targets'][targets[1]]['copied'], 3)
+            self.assertEqual(res['targets'][targets[1]]['linked'], 2)
+            self.assertEqual(os.readlink(os.path.join(targets[1], 'dummy', 'latest')), '1.1.0')
+            self.assertIn('/dummy/latest/dummy-1.0.0.js', res['purge'])
+            self.assertIn('/dummy/index.json', res['purge'])
+            
+            shutil.rmtree(os.path.join(out, 'dummy', '1.0.0'))
+            res = syncer.run()
+            self.assertEqual(res['targets'][targets[0]]['deleted'], 1)
+            self.assertFalse(os.path.exists(os.path.join(targets[0], 'dummy', '1.0.0')))
+            self.assertIn('/dummy/1.0.0/dummy-1.0.0.js', res['purge'])
+            with open(os.path.join(tmp, 'purge.txt')) as fp:
+                self.assertEqual(fp.read().split(), res['purge'])
+    
+    def test_state_kept_on_failure(self):
+        with TemporaryDirectory() as out, TemporaryDirectory() as tmp, mock.patch('cdnbuilder.settings.OUT_FOLDER', out), \
+                mock.patch('cdnbuilder.settings.BUILD_FOLDER', tmp), mock.patch('cdnbuilder.settings.COMPRESS', False), \
+                mock.patch('cdnbuilder.settings.BLOB_FOLDER', os.path.join(tmp, 'blobs')), \
+                mock.patch('cdnbuilder.settings.SYNC_PURGE_FILE', os.path.join(tmp, 'purge.txt')):
+            lib, target, state = DummyLib(), os.path.join(tmp, 'origin'), os.path.join(tmp, 'state')
+            
+            def publish(ver):
+                src = os.path.join(tmp, f'dummy-{ver}.js')
+                with open(src, 'w') as fp:
+                    fp.write(ver)
+                publish_lib(lib, [FileOutput(src=src, version=ver, link_root=True)])
+            
+            publish('1.0.0')
+            # A dry run doesn't write any state, hash cache or purge file
+            Syncer([target], dry_run=True, state_folder=state).run()
+            self.assertFalse(os.path.exists(state))
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'purge.txt')))
+            Syncer([target], state_folder=state).run()
+            self.assertTrue(os.path.exists(os.path.join(state, 'served.json')))
+            
+            # Paths changed by a failed sync are still purged once the sync succeeds
+            publish('1.1.0')
+            with mock.patch.object(Syncer, '_copy', side_effect=OSError('disk full')):
+                res = Syncer([target], state_folder=state).run()
+            self.assertGreater(res['targets'][target]['errors'], 0)
+            res = Syncer([target], state_folder=state).run()
+            self.assertEqual(res['targets'][target]['errors'], 0)
+            self.assertIn('/dummy/latest/dummy-1.0.0.js', res['purge'])
 
 
 if __name__ == "__main__":